@@ -0,0 +1,104 @@
+from decoders import decode_manufacturer_data, decode_service_data, is_ibeacon_frame
+
+# Windowed sensor aggregation.
+#
+# Sensor tags can advertise several times per second, while a report only
+# carries one value per sensor. Instead of publishing whichever advert arrived
+# last, every decoded sample is folded into a per-device, per-sensor running
+# [count, min, max, sum, last] as it is applied (O(1) per sample), and at report
+# time the window's aggregate replaces the point value:
+#   mean | min | max | last   publish that statistic as the sensor value
+#   full                      publish the mean, plus count/min/max/mean/last of
+#                             every sensor under "sensor_stats"
+# Windows are reset after every report. iBeacon fields are not aggregated.
+
+MODES = ("mean", "min", "max", "last", "full")
+
+# Decoder readings that are identifiers or calibration rather than sensor samples
+SKIPPED_READINGS = frozenset(("ibeacon_uuid", "ibeacon_major", "ibeacon_minor", "ibeacon_rssi_1m", "ibeacon_rssi"))
+
+COUNT, MIN, MAX, SUM, LAST = range(5)
+NUMERIC_TYPES = (int, float)  # exact types, so bools are skipped
+
+
+class SensorAggregator:
+    """Running per-sensor statistics of every device over the current report window."""
+
+    def __init__(self, mode="mean", precision=2):
+        if mode not in MODES:
+            raise ValueError(f"Unknown sensor aggregation '{mode}' (expected one of {', '.join(MODES)})")
+        self.mode = mode
+        self.precision = precision
+        self._windows = {}  # BLEDevice -> {sensor: [count, min, max, sum, last]}
+        self.samples = 0
+
+    def add(self, device, readings):
+        """Folds one advert's decoded readings into the device's window."""
+        window = self._windows.get(device)
+        if window is None:
+            window = self._windows[device] = {}
+        for name, value in readings.items():
+            if type(value) not in NUMERIC_TYPES or name in SKIPPED_READINGS:
+                continue
+            stats = window.get(name)
+            if stats is None:
+                window[name] = [1, value, value, value, value]
+                continue
+            stats[COUNT] += 1
+            if value < stats[MIN]:
+                stats[MIN] = value
+            elif value > stats[MAX]:
+                stats[MAX] = value
+            stats[SUM] += value
+            stats[LAST] = value
+        self.samples += 1
+
+    def add_frames(self, device, manufacturer_data, service_data):
+        """Decodes an advert's frames (memoized by the decode cache) and folds in the readings."""
+        for key, value in manufacturer_data.items():
+            if is_ibeacon_frame(key, value):
+                continue
+            readings = decode_manufacturer_data(key, value)
+            if readings:
+                self.add(device, readings)
+        for key, value in service_data.items():
+            readings = decode_service_data(key, value)
+            if readings:
+                self.add(device, readings)
+
+    def _mean(self, stats):
+        mean = stats[SUM] / stats[COUNT]
+        return round(mean, self.precision) if self.precision is not None else mean
+
+    def collect(self):
+        """
+        Returns [(device, readings, stats), ...] for the window and starts a new one.
+        `readings` maps each sensor to its published value; `stats` is the full summary
+        in "full" mode and None otherwise.
+        """
+        windows, self._windows = self._windows, {}
+        mode = self.mode
+        results = []
+        for device, window in windows.items():
+            if not window:
+                continue
+            if mode == "mean" or mode == "full":
+                readings = {name: self._mean(stats) for name, stats in window.items()}
+            elif mode == "min":
+                readings = {name: stats[MIN] for name, stats in window.items()}
+            elif mode == "max":
+                readings = {name: stats[MAX] for name, stats in window.items()}
+            else:
+                readings = {name: stats[LAST] for name, stats in window.items()}
+            summary = None
+            if mode == "full":
+                summary = {
+                    name: {"count": stats[COUNT], "min": stats[MIN], "max": stats[MAX],
+                           "mean": readings[name], "last": stats[LAST]}
+                    for name, stats in window.items()
+                }
+            results.append((device, readings, summary))
+        return results
+
+    def __len__(self):
+        return len(self._windows)
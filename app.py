@@ -1,31 +1,40 @@
 import asyncio
-import pandas as pd
-import struct
+import itertools
 import json
 import os
 import gc
 import logging
 import sys
-import psutil
-import requests
-import socket
-import netifaces
-import platform
-import netifaces
+import time
 import paho.mqtt.client as mqtt
 
 from paho.mqtt.client import CallbackAPIVersion
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
-from bleak import BleakScanner
 from ble_device import BLEDevice
-from flask import Flask, jsonify, render_template, request
 from datetime import datetime
-from devices import ble_devices_array, get_recent_devices, cleanup_old_devices
-from device_info import get_device_info
+from devices import ble_devices_array, get_recent_devices, cleanup_old_devices, apply_adverts, filter_rssi, aggregate_sensors
+from ingest import IngestQueue
+from spool import Spool, SpoolReplayer
+from publisher import MqttPublisher
+from reporter import get_active_interface
 import hostname
+import reporter
 import auth
+import decoders
+import telemetry_codec
+import scanner_source
+import devices
+import rssi_filter
+import history
+import presence
+import aggregation
+import snapshot
+import stream
+import filters
+import profiling
+import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -34,153 +43,546 @@ logging.basicConfig(
 )
 
 time_start = int(datetime.now().timestamp())
+startup_started = time.monotonic()  # reported with the first applied adverts
 mqtt_server_ip = "172.19.2.11"
 mqtt_client_instance = None
 proxy_url = os.getenv("PROXY")
 publish_count = 0
-app = Flask(__name__)
+latest_snapshot = None  # snapshot.Snapshot of the last report cycle, served by /api
+event_loop = None
 scan_count = 0
 gateway_mac = None
+sensor_aggregation = os.getenv("SENSOR_AGGREGATION", "off").lower()  # off | mean | min | max | last | full
+if sensor_aggregation not in aggregation.MODES + ("off",):
+    logging.error(f"scanner:: Unknown sensor aggregation '{sensor_aggregation}', publishing point values")
+    sensor_aggregation = "off"
+if sensor_aggregation != "off":
+    devices.sensor_aggregator = aggregation.SensorAggregator(sensor_aggregation)
+# Aggregation needs every advert's frames, not only the last one per device and batch
+ingest_queue = IngestQueue(int(os.getenv("INGEST_QUEUE_SIZE", 10000)), keep_frames=sensor_aggregation != "off")
+ingest_batch_interval = float(os.getenv("INGEST_BATCH_INTERVAL", 0.25))  # seconds
+ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", 2000))
+scan_mode = os.getenv("SCAN_MODE", "windowed").lower()  # windowed | continuous
+scan_window = float(os.getenv("SCAN_WINDOW", 10))  # seconds
+scanner_backend = os.getenv("SCANNER_BACKEND", "bleak").lower()  # bleak | fake
+report_interval = float(os.getenv("REPORT_INTERVAL", 10))  # seconds, continuous mode
+publish_mode = os.getenv("PUBLISH_MODE", "full").lower()  # full | delta
+keyframe_interval = max(1, int(os.getenv("KEYFRAME_INTERVAL", 6)))  # report cycles between full snapshots
+delta_fields = os.getenv("DELTA_FIELDS", "false").lower() in ("1", "true", "yes")
+report_cycle = 0
+device_message_expiry = 10  # seconds, per-device retained messages
+if publish_mode == "delta":
+    # Unchanged devices are only republished on keyframes, so their retained message must outlive that gap
+    device_message_expiry += int(keyframe_interval * (report_interval if scan_mode == "continuous" else scan_window))
+BLEDevice.rssi_change_threshold = int(os.getenv("DELTA_RSSI_THRESHOLD", 3))
+rssi_filter_kind = os.getenv("RSSI_FILTER", "ema").lower()  # legacy | ema | kalman | median
+if rssi_filter_kind not in rssi_filter.FILTERS + ("legacy",):
+    logging.error(f"scanner:: Unknown RSSI filter '{rssi_filter_kind}', falling back to ema")
+    rssi_filter_kind = "ema"
+if rssi_filter_kind != "legacy":
+    devices.rssi_filter = rssi_filter.RssiFilterBank(
+        rssi_filter_kind,
+        tau=float(os.getenv("RSSI_EMA_TAU", 1.0)),  # seconds
+        process_noise=float(os.getenv("RSSI_KALMAN_Q", 1.0)),  # dBm^2 per second
+        measurement_noise=float(os.getenv("RSSI_KALMAN_R", 16.0)),  # dBm^2
+        window=float(os.getenv("RSSI_MEDIAN_WINDOW", 5.0)),  # seconds
+    )
+telemetry_format = os.getenv("TELEMETRY_FORMAT", "json").lower()  # json | packed | msgpack | cbor
+telemetry_compression = os.getenv("TELEMETRY_COMPRESSION", "none").lower()  # none | zlib | zstd
+telemetry_compress_threshold = int(os.getenv("TELEMETRY_COMPRESS_THRESHOLD", 16384))  # bytes
+telemetry_max_chunk = int(os.getenv("TELEMETRY_MAX_CHUNK", 0))  # bytes per MQTT message, 0 = no chunking
+telemetry_message_ids = itertools.count(1)
+telemetry_spool = None
+spool_path = os.getenv("SPOOL_PATH", "telemetry_spool.db")  # empty disables store-and-forward
+spool_max_bytes = int(os.getenv("SPOOL_MAX_BYTES", 50 * 1024 * 1024))
+spool_replay_rate = float(os.getenv("SPOOL_REPLAY_RATE", 5))  # messages per second
+mqtt_device_qos = int(os.getenv("MQTT_DEVICE_QOS", 0))  # per-device retained messages
+publisher = MqttPublisher(
+    qos=int(os.getenv("MQTT_QOS", 1)),  # gateway telemetry
+    max_inflight=int(os.getenv("MQTT_MAX_INFLIGHT", 20)),
+    queue_size=int(os.getenv("MQTT_PUBLISH_QUEUE", 200)),
+    ack_timeout=float(os.getenv("MQTT_ACK_TIMEOUT", 30)),  # seconds
+)
 
-@app.route("/")
-def index():
-    return "EazyTrax Gateway"
+history_retention = float(os.getenv("HISTORY_RETENTION", 600))  # seconds, 0 disables sensor history
+if history_retention > 0:
+    devices.sensor_history = history.SensorHistory(
+        history_retention,
+        resolution=float(os.getenv("HISTORY_RESOLUTION", 5)),  # seconds between samples per device
+        max_devices=int(os.getenv("HISTORY_MAX_DEVICES", 1000)),
+    )
+presence_interval = float(os.getenv("PRESENCE_INTERVAL", 1))  # seconds, 0 disables presence events
+presence_engine = None
+if presence_interval > 0:
+    presence_engine = presence.PresenceEngine(
+        presence.parse_zones(os.getenv("PRESENCE_ZONES", "immediate:0.5,near:3,far:10")),  # zone:max metres
+        hysteresis=float(os.getenv("PRESENCE_HYSTERESIS", 0.2)),  # fraction of the zone boundary
+        confirm=float(os.getenv("PRESENCE_CONFIRM", 2)),  # seconds a new zone must hold
+        exit_timeout=float(os.getenv("PRESENCE_EXIT_TIMEOUT", 30)),  # seconds unseen before exit
+        dwell_interval=float(os.getenv("PRESENCE_DWELL", 60)),  # seconds between dwell events, 0 = off
+        path_loss=float(os.getenv("PRESENCE_PATH_LOSS", 2.0)),
+        default_rssi_1m=int(os.getenv("PRESENCE_RSSI_1M", -59)),  # for devices without iBeacon calibration
+        ibeacon_only=os.getenv("PRESENCE_TARGETS", "ibeacon").lower() != "all",  # ibeacon | all
+    )
+filter_min_rssi = os.getenv("FILTER_MIN_RSSI")  # dBm; weaker adverts are dropped in the scan callback
+advert_filter = filters.AdvertFilter(
+    min_rssi=int(filter_min_rssi) if filter_min_rssi else None,
+    allow=filters.RuleSet(
+        addresses=os.getenv("FILTER_ALLOW_ADDRESSES", ""),  # address prefixes, e.g. AC:23:3F
+        companies=os.getenv("FILTER_ALLOW_COMPANIES", ""),  # company IDs, e.g. 0x004C,1593
+        services=os.getenv("FILTER_ALLOW_SERVICES", ""),  # service UUIDs, 16-bit or full
+        ibeacon_uuids=os.getenv("FILTER_ALLOW_IBEACON_UUIDS", ""),
+        name=os.getenv("FILTER_ALLOW_NAME") or None,  # regular expression
+    ),
+    deny=filters.RuleSet(
+        addresses=os.getenv("FILTER_DENY_ADDRESSES", ""),
+        companies=os.getenv("FILTER_DENY_COMPANIES", ""),
+        services=os.getenv("FILTER_DENY_SERVICES", ""),
+        ibeacon_uuids=os.getenv("FILTER_DENY_IBEACON_UUIDS", ""),
+        name=os.getenv("FILTER_DENY_NAME") or None,
+    ),
+)
+# After the RSSI filter, aggregation and history are set up: the byte budget covers their per-device state
+devices.set_capacity(
+    int(os.getenv("MAX_DEVICES", 10000)),  # 0 = unbounded
+    int(float(os.getenv("DEVICE_MEMORY_BUDGET_MB", 0)) * 1024 * 1024),  # approximate, 0 = no budget
+)
+pin_rules = filters.RuleSet(
+    addresses=os.getenv("DEVICE_PIN_ADDRESSES", ""),
+    companies=os.getenv("DEVICE_PIN_COMPANIES", ""),
+    services=os.getenv("DEVICE_PIN_SERVICES", ""),
+    ibeacon_uuids=os.getenv("DEVICE_PIN_IBEACON_UUIDS", ""),
+    name=os.getenv("DEVICE_PIN_NAME") or None,
+)
+devices.pin_rules = pin_rules if pin_rules else None
+profiling_enabled = os.getenv("PROFILING_ENABLED", "true").lower() in ("1", "true", "yes")
+profile_max_seconds = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+profiler = profiling.SamplingProfiler(
+    interval=float(os.getenv("PROFILE_INTERVAL", 0.005)),  # seconds between stack samples
+    max_overhead=float(os.getenv("PROFILE_MAX_OVERHEAD", 0.02)),  # fraction of wall clock spent sampling
+    max_seconds=profile_max_seconds,
+)
+allocation_tracer = profiling.AllocationTracer(
+    max_seconds=profile_max_seconds,
+    max_memory=int(float(os.getenv("TRACEMALLOC_MAX_MB", 64)) * 1024 * 1024),  # tracemalloc's own memory
+)
+stream_interval = float(os.getenv("STREAM_INTERVAL", 0.5))  # seconds between /api/stream updates
+stream_heartbeat = float(os.getenv("STREAM_HEARTBEAT", 15))  # seconds of silence before a keepalive
+stream_hub = stream.StreamHub(
+    queue_size=int(os.getenv("STREAM_QUEUE_SIZE", 64)),  # updates a client may fall behind before it is dropped
+    max_clients=int(os.getenv("STREAM_MAX_CLIENTS", 16)),
+)
+RSSI_FILTER_SECONDS = metrics.histogram("eazytrax_rssi_filter_seconds", "Time spent in the batch RSSI filter").labels()
+PREPARE_SECONDS = metrics.histogram("eazytrax_prepare_payload_seconds", "Time spent building a gateway payload").labels()
+SERIALIZE_SECONDS = metrics.histogram(
+    "eazytrax_serialize_seconds", "Time spent serializing telemetry for MQTT", labels=("topic",),
+)
+SERIALIZE_GATEWAY = SERIALIZE_SECONDS.labels("gateway")
+SERIALIZE_SNAPSHOT = SERIALIZE_SECONDS.labels("snapshot")
+API_RESPONSES = metrics.counter("eazytrax_api_responses_total", "/api responses by how they were served", labels=("result",))
+# The scan callback already counts adverts in the ingest queue; export those counters at scrape time
+metrics.callback("eazytrax_adverts_received_total", "Adverts received by the scan callback", lambda: ingest_queue.received, "counter")
+metrics.callback("eazytrax_adverts_dropped_total", "Adverts dropped because the ingest queue was full", lambda: ingest_queue.dropped, "counter")
+metrics.callback("eazytrax_adverts_coalesced_total", "Adverts merged into an earlier advert of the same device", lambda: ingest_queue.coalesced, "counter")
+metrics.callback("eazytrax_ingest_queue_depth", "Adverts waiting in the ingest queue", lambda: len(ingest_queue))
+metrics.callback("eazytrax_mqtt_publish_queue_depth", "Messages waiting for the MQTT publisher", lambda: publisher.stats()["queued"])
+metrics.callback("eazytrax_mqtt_inflight", "MQTT messages awaiting acknowledgement", lambda: publisher.stats()["inflight"])
+metrics.callback("eazytrax_mqtt_connected", "1 while the MQTT client is connected", lambda: int(is_mqtt_connected()))
+metrics.callback("eazytrax_history_devices", "Devices with sensor history",
+                 lambda: len(devices.sensor_history) if devices.sensor_history is not None else 0)
+metrics.callback("eazytrax_presence_devices", "Devices currently inside a presence zone",
+                 lambda: len(presence_engine) if presence_engine is not None else 0)
+metrics.callback("eazytrax_presence_events_total", "Presence events emitted",
+                 lambda: presence_engine.events if presence_engine is not None else 0, "counter")
+metrics.callback("eazytrax_stream_clients", "Clients connected to /api/stream", lambda: len(stream_hub))
+metrics.callback("eazytrax_spool_messages", "Messages waiting in the store-and-forward spool",
+                 lambda: len(telemetry_spool) if telemetry_spool is not None else 0)
+
+def create_app():
+    """
+    Builds the Flask app with every HTTP route. Flask is imported here, from the HTTP
+    server thread, so scanning does not wait for it at startup.
+    """
+    from flask import Flask, Response, jsonify, request
+
+    app = Flask(__name__)
+
+    @app.route("/")
+    def index():
+        return "EazyTrax Gateway"
+
+    @app.route("/api")
+    def get_payload():
+        """API endpoint to get the last report, serialized once per report cycle"""
+        global latest_snapshot
+        current = latest_snapshot
+        if current is None:
+            # Nothing reported yet; the device table belongs to the event loop, so build it there
+            current = asyncio.run_coroutine_threadsafe(build_report_snapshot(), event_loop).result(timeout=30)
+            if latest_snapshot is None:
+                latest_snapshot = current
+
+        # The compressed body is a different representation, so it gets its own entity tag
+        gzipped = request.accept_encodings["gzip"] > 0
+        etag = current.etag + "-gzip" if gzipped else current.etag
+        if etag in request.if_none_match:
+            API_RESPONSES.labels("not_modified").inc()
+            response = Response(status=304)
+        elif gzipped:
+            API_RESPONSES.labels("gzip").inc()
+            response = Response(current.gzip_body(), content_type="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            API_RESPONSES.labels("identity").inc()
+            response = Response(current.body, content_type="application/json")
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    @app.route("/api/stream")
+    def get_stream():
+        """API endpoint streaming device updates as newline-delimited JSON or server-sent events"""
+        fmt = request.args.get("format")
+        if fmt is None:
+            fmt = "sse" if request.accept_mimetypes.best == "text/event-stream" else "ndjson"
+        if fmt not in stream.STREAM_FORMATS:
+            return jsonify({"success": False, "message": f"format must be one of {', '.join(stream.STREAM_FORMATS)}"}), 400
+
+        subscription = stream_hub.subscribe()
+        if subscription is None:
+            return jsonify({"success": False, "message": "Too many stream clients"}), 503
+        # Start from the last report's devices, then follow the live updates
+        current = latest_snapshot
+        initial = stream.Update(list(current.device_messages.values())) if current is not None else None
+        keepalive = b": keepalive\n\n" if fmt == "sse" else b"\n"
+
+        def generate():
+            try:
+                if initial is not None and initial.messages:
+                    yield initial.encode(fmt)
+                while not subscription.dropped:
+                    update = subscription.next(stream_heartbeat)
+                    yield update.encode(fmt) if update is not None else keepalive
+            finally:
+                stream_hub.unsubscribe(subscription)
+
+        response = Response(generate(), content_type="text/event-stream" if fmt == "sse" else "application/x-ndjson")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    @app.route("/api/ingest")
+    def get_ingest_stats():
+        """API endpoint to get the advert ingest queue counters"""
+        stats = ingest_queue.stats()
+        if advert_filter.active:
+            stats["filter"] = advert_filter.stats()
+        stats["device_table"] = devices.table_stats()
+        return jsonify(stats)
+
+    @app.route("/api/devices/<address>/history")
+    def get_device_history(address):
+        """API endpoint to get a device's recent sensor readings as min/max/mean buckets"""
+        sensor_history = devices.sensor_history
+        if sensor_history is None:
+            return jsonify({"success": False, "message": "Sensor history is disabled"}), 404
 
-@app.route("/api")
-def get_payload():
-    payLoad = prepare_payload()
-    return jsonify(payLoad)
+        try:
+            window = float(request.args.get("window", sensor_history.retention))
+            buckets = int(request.args.get("buckets", 60))
+        except ValueError:
+            return jsonify({"success": False, "message": "window and buckets must be numbers"}), 400
+        if window <= 0 or not 1 <= buckets <= 1000:
+            return jsonify({"success": False, "message": "window must be positive and buckets between 1 and 1000"}), 400
+        sensors = request.args.get("sensors")
+
+        address = address.replace(":", "").upper()
+        now = time.time()
+        series = sensor_history.query(address, now, window, buckets, sensors.split(",") if sensors else None)
+        if series is None:
+            return jsonify({"success": False, "message": f"No history for {address}"}), 404
+
+        window = min(window, sensor_history.retention)
+        return jsonify({
+            "success": True,
+            "address": address,
+            "window": window,
+            "bucket_seconds": window / buckets,
+            "sensors": series,
+        })
+
+    @app.route("/api/presence")
+    def get_presence():
+        """API endpoint to get the current zone of every present device"""
+        if presence_engine is None:
+            return jsonify({"success": False, "message": "Presence tracking is disabled"}), 404
+        return jsonify({"success": True, "devices": presence_engine.snapshot()})
+
+    @app.route("/metrics")
+    def get_metrics():
+        """Prometheus scrape endpoint"""
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    def profiling_disabled():
+        return jsonify({"success": False, "message": "Profiling is disabled"}), 404
+
+    def top_arg(default):
+        """The `top` query argument; raises ValueError unless it is a non-negative integer."""
+        top = int(request.args.get("top", default))
+        if top < 0:
+            raise ValueError("top must not be negative")
+        return top
+
+    def bad_top():
+        return jsonify({"success": False, "message": "top must be a non-negative integer"}), 400
+
+    @app.route("/api/debug/profile/start", methods=["POST"])
+    @auth.token_required
+    def start_profile():
+        """API endpoint to start sampling every thread's stack for `seconds` (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        try:
+            seconds = float(request.args.get("seconds", 10))
+            interval = float(request.args.get("interval", 0)) or None
+        except ValueError:
+            return jsonify({"success": False, "message": "seconds and interval must be numbers"}), 400
+        try:
+            profiler.start(seconds, interval)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({"success": False, "message": str(e)}), 409
+        logging.info(f"profile:: Sampling profiler started for {profiler.duration}s")
+        return jsonify({"success": True, "seconds": profiler.duration}), 202
+
+    @app.route("/api/debug/profile/stop", methods=["POST"])
+    @auth.token_required
+    def stop_profile():
+        """API endpoint to stop the sampling profiler and get its report (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        try:
+            top = top_arg(50)
+        except ValueError:
+            return bad_top()
+        profiler.stop()
+        return jsonify({"success": True, **profiler.report(top)})
+
+    @app.route("/api/debug/profile", methods=["GET"])
+    @auth.token_required
+    def get_profile():
+        """API endpoint to get the last profile as JSON or collapsed stacks (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        if request.args.get("format") == "collapsed":
+            return Response(profiler.collapsed(), content_type="text/plain; charset=utf-8")
+        try:
+            top = top_arg(50)
+        except ValueError:
+            return bad_top()
+        return jsonify({"success": True, **profiler.report(top)})
+
+    @app.route("/api/debug/allocations/start", methods=["POST"])
+    @auth.token_required
+    def start_allocation_trace():
+        """API endpoint to start tracing allocations for `seconds` (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        try:
+            seconds = float(request.args.get("seconds", 10))
+            frames = int(request.args.get("frames", 1))
+        except ValueError:
+            return jsonify({"success": False, "message": "seconds and frames must be numbers"}), 400
+        try:
+            allocation_tracer.start(seconds, frames)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({"success": False, "message": str(e)}), 409
+        logging.info(f"profile:: Allocation tracing started for {allocation_tracer.duration}s ({allocation_tracer.frames} frames)")
+        return jsonify({"success": True, "seconds": allocation_tracer.duration, "frames": allocation_tracer.frames}), 202
+
+    @app.route("/api/debug/allocations/stop", methods=["POST"])
+    @auth.token_required
+    def stop_allocation_trace():
+        """API endpoint to stop allocation tracing and get the top allocation sites (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        try:
+            top = top_arg(30)
+        except ValueError:
+            return bad_top()
+        return jsonify({"success": True, **allocation_tracer.stop(top)})
+
+    @app.route("/api/debug/allocations", methods=["GET"])
+    @auth.token_required
+    def get_allocation_trace():
+        """API endpoint to get the last allocation report (requires authentication)"""
+        if not profiling_enabled:
+            return profiling_disabled()
+        try:
+            top = top_arg(30)
+        except ValueError:
+            return bad_top()
+        return jsonify({"success": True, **allocation_tracer.report(top)})
+
+    @app.route("/api/Telemetry/Gateway/token", methods=["GET"])
+    def get_token():
+        """API endpoint to get a new bearer token based on the device MAC address"""
+        global gateway_mac
+
+        # Issuing tokens is cheap to ask for; keep a misbehaving client from hammering it
+        retry_after = auth.allow_token_request(request.remote_addr)
+        if retry_after:
+            response = jsonify({
+                "success": False,
+                "message": "Too many token requests"
+            })
+            response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+            return response, 429
+
+        # Default to using the gateway_mac if it's available
+        mac_address = gateway_mac
+
+        # Check if a MAC address was provided in the request
+        if request.args.get('mac'):
+            mac_address = request.args.get('mac').replace(':', '').upper()
+
+        # If we don't have a MAC address, return an error
+        if not mac_address:
+            return jsonify({
+                "success": False,
+                "message": "No MAC address available"
+            }), 400
+
+        # Generate a token
+        token = auth.generate_token(mac_address)
 
-@app.route("/api/Telemetry/Gateway/token", methods=["GET"])
-def get_token():
-    """API endpoint to get a new bearer token based on the device MAC address"""
-    global gateway_mac
-    
-    # Default to using the gateway_mac if it's available
-    mac_address = gateway_mac
-    
-    # Check if a MAC address was provided in the request
-    if request.args.get('mac'):
-        mac_address = request.args.get('mac').replace(':', '').upper()
-    
-    # If we don't have a MAC address, return an error
-    if not mac_address:
         return jsonify({
-            "success": False,
-            "message": "No MAC address available"
-        }), 400
-    
-    # Generate a token
-    token = auth.generate_token(mac_address)
-    
-    return jsonify({
-        "success": True,
-        "token": token,
-        "mac": mac_address,
-        "expires_in": auth.TOKEN_EXPIRY
-    })
-
-@app.route("/api/Telemetry/Gateway/hostname", methods=["GET"])
-@auth.token_required
-def get_hostname():
-    """API endpoint to get the current hostname (requires authentication)"""
-    return jsonify({
-        "hostname": hostname.get_current_hostname(),
-        "success": True
-    })
-
-@app.route("/api/Telemetry/Gateway/hostname/update", methods=["POST"])
-@auth.token_required
-def set_hostname():
-    """API endpoint to change the hostname (requires authentication)"""
-    data = request.get_json()
-    
-    if not data or 'hostname' not in data:
+            "success": True,
+            "token": token,
+            "mac": mac_address,
+            "expires_in": auth.TOKEN_EXPIRY
+        })
+
+    @app.route("/api/Telemetry/Gateway/hostname", methods=["GET"])
+    @auth.token_required
+    def get_hostname():
+        """API endpoint to get the current hostname (requires authentication)"""
         return jsonify({
-            "success": False,
-            "message": "Missing hostname parameter"
-        }), 400
-    
-    new_hostname = data['hostname']
-    success, message = hostname.change_hostname(new_hostname)
-    
-    return jsonify({
-        "success": success,
-        "message": message,
-        "hostname": hostname.get_current_hostname()
-    }), 200 if success else 400
+            "hostname": hostname.get_current_hostname(),
+            "success": True
+        })
+
+    @app.route("/api/Telemetry/Gateway/hostname/update", methods=["POST"])
+    @auth.token_required
+    def set_hostname():
+        """API endpoint to change the hostname (requires authentication)"""
+        data = request.get_json()
+
+        if not data or 'hostname' not in data:
+            return jsonify({
+                "success": False,
+                "message": "Missing hostname parameter"
+            }), 400
+
+        new_hostname = data['hostname']
+        success, message = hostname.change_hostname(new_hostname)
+        reporter.invalidate()
+
+        return jsonify({
+            "success": success,
+            "message": message,
+            "hostname": hostname.get_current_hostname()
+        }), 200 if success else 400
+
+    return app
 
 async def send_report_payload():
+        global report_cycle, publish_count, latest_snapshot
         try:
-            payload = prepare_payload()
-            publish_to_mqtt(payload)
-            
-            export_devices = get_recent_devices()
-            publish_each_device_to_mqtt(export_devices)
+            # In delta mode only every `keyframe_interval`-th report carries the full device list
+            keyframe = publish_mode != "delta" or report_cycle % keyframe_interval == 0
+            report_cycle += 1
+
+            started = time.perf_counter()
+            filter_rssi()
+            RSSI_FILTER_SECONDS.observe(time.perf_counter() - started)
+            aggregate_sensors()
+
+            # Each device is turned into a dict and serialized once; /api, the gateway report and
+            # the per-device topics all share the result
+            publish_count = publish_count + 1
+            records, report = await build_report_snapshot(with_records=True)
+            latest_snapshot = report
+            if keyframe:
+                await publish_to_mqtt(report.payload, report.body if telemetry_format == "json" else None)
+            else:
+                await publish_to_mqtt(prepare_payload(records[:len(report.payload["reported"])], delta=True))
+
+            export_devices = [device for device, _ in records]
+            if not keyframe:
+                export_devices = [device for device in export_devices if device.has_changes()]
+            await publish_each_device_to_mqtt(export_devices, report.device_messages)
+
+            if publish_mode == "delta":
+                for device in export_devices:
+                    device.mark_published()
+
+            logging.info(f"scanner:: Ingest queue: {ingest_queue.stats()}")
+            if advert_filter.active:
+                logging.info(f"scanner:: Ingress filter: {advert_filter.stats()}")
+            logging.info(f"scanner:: Device table: {devices.table_stats()}")
+            logging.info(f"mqtt:: Publisher: {publisher.stats()}")
+            if telemetry_spool is not None and len(telemetry_spool):
+                logging.info(f"spool:: {telemetry_spool.stats()}")
 
             # ?????????????????????????????????????? 30 ??????
             logging.info(f"mqtt:: Cleaning up old device data (older than 30 seconds)")
             removed_count = cleanup_old_devices(30)
+            if devices.sensor_history is not None:
+                devices.sensor_history.prune(time.time())
             
             # ??????????????????????????????
-            del payload
+            del records
             del export_devices
 
         except Exception as e:
             logging.info(f"Error sending payload: {e}")
         gc.collect()
         
-def get_active_interface():
+async def build_report_snapshot(with_records=False):
     """
-    Detects the active network interface (Wi-Fi prioritized on Linux).
-    Returns (interface_name, ip_address, mac_address)
+    Snapshots the devices seen in the last 90 seconds (the gateway payload covers the last 60)
+    and serializes it off the event loop. Returns the Snapshot, or (records, Snapshot).
     """
-    system = platform.system().lower()
-
-    def get_ip_mac(interface):
-        try:
-            ip = netifaces.ifaddresses(interface).get(netifaces.AF_INET, [{}])[0].get("addr")
-            mac = netifaces.ifaddresses(interface).get(netifaces.AF_LINK, [{}])[0].get("addr")
-            return ip, mac
-        except (KeyError, IndexError, ValueError):
-            return None, None
-
-    # First pass: prioritize wlan* on Linux
-    if system == "linux":
-        for iface in netifaces.interfaces():
-            if iface.startswith("wlan"):
-                ip, mac = get_ip_mac(iface)
-                if ip and mac:
-                    return iface, ip, mac
-
-    # Second pass: accept any interface with valid IP/MAC
-    for iface in netifaces.interfaces():
-        ip, mac = get_ip_mac(iface)
-        if ip and mac:
-            return iface, ip, mac
-
-def get_recent_devices(max_second=90):
-    """Returns a sorted list of BLE devices seen within the last `max_second` seconds."""
-    current_time = int(datetime.now().timestamp())
-
-    return sorted(
-        [
-            device
-            for device in ble_devices_array.values()
-            if (current_time - device.last_seen) <= max_second
-        ],
-        key=lambda d: d.last_seen,
-        reverse=True,
-    )
-
-def prepare_payload(max_second=60):
-    global publish_count
-    hostname_value = hostname.get_current_hostname()  # Use the hostname module
-    interface, ip, mac = get_active_interface()
-    export_devices = get_recent_devices(max_second)
-    device_info = get_device_info()
+    records = [(device, device.to_json()) for device in get_recent_devices(90)]
+    cutoff = int(datetime.now().timestamp()) - 60
+    # Most recent first, so the gateway payload's devices are a prefix of the records
+    reported = 0
+    while reported < len(records) and records[reported][0].last_seen >= cutoff:
+        reported += 1
+    payload = prepare_payload(records[:reported])
+
+    started = time.perf_counter()
+    report = await asyncio.to_thread(snapshot.Snapshot.build, publish_count, payload, records)
+    SERIALIZE_SNAPSHOT.observe(time.perf_counter() - started)
+    return (records, report) if with_records else report
+
+def prepare_payload(records, delta=False):
+    """
+    Builds the gateway telemetry payload from (device, device.to_json()) records. With `delta`
+    set, only devices changed since the last publish are reported (and only their changed
+    fields when DELTA_FIELDS is on).
+    """
+    started = time.perf_counter()
+    if delta:
+        reported = [device.to_delta_json() if delta_fields else record for device, record in records if device.has_changes()]
+    else:
+        reported = [record for _, record in records]
     token = os.getenv("TOKEN")
-    publish_count = publish_count + 1
 
     payload: str = {
         "meta": {
@@ -189,96 +591,160 @@ def prepare_payload(max_second=60):
             "api_version": "2.0",
             "gateway_mac": "NA"
         },
-        "reporter": {
-            "name": hostname_value,
-            "mac": mac if mac else "N/A",
-            "hw_type": f"{device_info['Hardware']} {device_info['Model']}", 
-            "revision": device_info["Revision"],
-            "model": device_info["Model"],
-            "sw_version": "1.0.50",
-            "ipv4": ip if ip else "N/A",
-            "uptime": int(psutil.boot_time()),
-            "time": int(datetime.now().timestamp()),
-            "publish_count": publish_count,
-        },
-        "reported": [device.to_json() for device in export_devices],
+        "reporter": reporter.build_reporter(publish_count),
+        "reported": reported,
     }
- 
+
+    if publish_mode == "delta":
+        payload["meta"]["report_type"] = "delta" if delta else "keyframe"
+
+    PREPARE_SECONDS.observe(time.perf_counter() - started)
     return payload
 
 def init_mqtt_client():
 
     global mqtt_client_instance, gateway_mac, mqtt_server_ip
     mqtt_client_instance = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, gateway_mac)
-    mqtt_client_instance.connect(mqtt_server_ip, 1883, 60)
+    mqtt_client_instance.reconnect_delay_set(min_delay=1, max_delay=30)
+    mqtt_client_instance.max_inflight_messages_set(publisher.max_inflight)
+    publisher.attach(mqtt_client_instance)
+    # The network thread connects and reconnects in the background; nothing here blocks the scan loop
+    mqtt_client_instance.connect_async(mqtt_server_ip, 1883, 60)
     mqtt_client_instance.loop_start()
 
 def ensure_mqtt_connection():
     global mqtt_client_instance, gateway_mac
     if mqtt_client_instance is None:
         init_mqtt_client()
-    elif not mqtt_client_instance.is_connected():
-        mqtt_client_instance.reconnect()
 
-def publish_to_mqtt(payload):
+def is_mqtt_connected():
+    return mqtt_client_instance is not None and mqtt_client_instance.is_connected()
+
+def spool_message(topic, payload, qos, retain):
+    """Publisher failure handler: keeps the message on disk until the broker is reachable again."""
+    if telemetry_spool is not None:
+        telemetry_spool.put(topic, payload, qos, retain)
+
+def encode_telemetry(payload, message=None):
+    started = time.perf_counter()
+    if message is None:
+        message = telemetry_codec.encode_payload(payload, telemetry_format)
+    # Large reports are compressed and/or split into sequence-numbered chunks
+    frames = telemetry_codec.frame_message(
+        message, next(telemetry_message_ids), telemetry_compression,
+        telemetry_compress_threshold, telemetry_max_chunk,
+    )
+    SERIALIZE_GATEWAY.observe(time.perf_counter() - started)
+    return len(message), frames
+
+async def publish_to_mqtt(payload, message=None):
+    """Publishes the gateway report; `message` is the payload already encoded in telemetry_format."""
     global gateway_mac
     try:
         ensure_mqtt_connection()
 
         topic = f"Gateways/{gateway_mac}/Telemetry"
-        message = json.dumps(payload)
-        message_size = len(message.encode("utf-8"))
-
-        mqtt_client_instance.publish(topic, message, qos=0)
+        # Serialization runs off the event loop so the scanner keeps receiving adverts
+        message_size, frames = await asyncio.to_thread(encode_telemetry, payload, message)
 
-        logging.info(f"mqtt:: Published payload to MQTT topic: {topic}")
-        logging.info(f"mqtt:: Payload size: {message_size} bytes")
+        # Undelivered frames (broker down, or no PUBACK in time) go to the spool
+        for frame in frames:
+            await publisher.submit(topic, frame, fallback=True)
     except Exception as e:
         logging.error(f"mqtt:: MQTT publish error: {e}")
+        return
 
-def publish_each_device_to_mqtt(devices):
+    wire_size = sum(len(frame) for frame in frames)
+    logging.info(f"mqtt:: Queued payload for MQTT topic: {topic}")
+    logging.info(
+        f"mqtt:: Payload size: {message_size} bytes ({telemetry_format}), sent {wire_size} bytes "
+        f"in {len(frames)} frame(s), ratio {wire_size / message_size:.2f}"
+    )
+
+async def publish_each_device_to_mqtt(devices, device_messages):
+    """Publishes each device's retained state; `device_messages` maps address -> serialized to_json()."""
     global gateway_mac
 
     props = mqtt.Properties(mqtt.PacketTypes.PUBLISH)
-    props.MessageExpiryInterval = 10  
+    props.MessageExpiryInterval = device_message_expiry
 
     try:
         ensure_mqtt_connection()
+        if not is_mqtt_connected():
+            # Retained per-device state is superseded by the next report, so it is not spooled
+            logging.warning(f"mqtt:: Broker unavailable, skipped {len(devices)} individual devices.")
+            return
 
+        # Never waits: a device's next report supersedes this one, so a stalled broker drops them instead
+        dropped = 0
         for device in devices:
             topic = f"Bles/{device.address}/Gateways/{gateway_mac}/Telemetry"
-            message = json.dumps(device.to_json())
-            mqtt_client_instance.publish(topic, message, qos=0, retain=True, properties=props)
+            if not publisher.submit_nowait(topic, device_messages[device.address], qos=mqtt_device_qos, retain=True, properties=props):
+                dropped += 1
 
-        logging.info(f"mqtt:: Published {len(devices)} individual devices to MQTT.")
+        logging.info(f"mqtt:: Queued {len(devices) - dropped} individual devices for MQTT.")
+        if dropped:
+            logging.warning(f"mqtt:: Publish queue full, dropped {dropped} individual devices.")
     except Exception as e:
         logging.error(f"mqtt:: MQTT individual publish error: {e}")
 
+def adverts_heard():
+    """Adverts the scanner has delivered, including the ones the ingress filter dropped."""
+    return advert_filter.checked if advert_filter.active else ingest_queue.received
+
 async def scan_ble_devices():
-    """Continuously scans for BLE devices with periodic pauses."""
+    """
+    Continuously scans for BLE devices.
+    SCAN_MODE=windowed stops the scanner every `scan_window` seconds to send a report;
+    SCAN_MODE=continuous keeps it running and reports from report_periodically().
+    """
     logging.info("Continuous BLE scanning started.")
 
-    def callback(device, advertisement_data):
-       device.address = device.address.replace(":", "")
-       # Scan all BLE devices without filtering
-       if device.address not in ble_devices_array:
-           ble_devices_array[device.address] = BLEDevice(device.address, device.name, advertisement_data.rssi)
-       else:
-           ble_devices_array[device.address].update(device.name, advertisement_data.rssi)
-       ble_devices_array[device.address].process_manufacturer_data(advertisement_data)
-       ble_devices_array[device.address].process_service_uuids(advertisement_data)
-       ble_devices_array[device.address].process_service_data(advertisement_data)
-
-    scanner = BleakScanner(callback)
+    # Unwanted adverts are dropped before they are queued; processing happens in consume_adverts()
+    callback = ingest_queue.on_advertisement
+    if advert_filter.active:
+        callback = advert_filter.wrap(callback)
+
+    scanner = scanner_source.create_scanner(
+        callback,
+        backend=scanner_backend,
+        rate=float(os.getenv("FAKE_ADVERT_RATE", 1000)),  # adverts per second, 0 = recorded timing
+        device_count=int(os.getenv("FAKE_DEVICES", 500)),
+        recording=os.getenv("FAKE_REPLAY") or None,
+        speed=float(os.getenv("FAKE_REPLAY_SPEED", 1.0)),
+        record_path=os.getenv("SCANNER_RECORD") or None,
+    )
+    consumer = asyncio.create_task(consume_adverts())
+    report_task = None
 
     try:
-        while True:
+        if scan_mode == "continuous":
+            # The scanner is never stopped; reporting runs on its own schedule
             await scanner.start()
-            logging.info("scanner:: Scanning started")
-            await asyncio.sleep(10)  # Scan for 10 seconds
-            await scanner.stop()
-            await send_report_payload()
-            gc.collect()  # Run garbage collection to free up memory
+            logging.info(f"scanner:: Continuous scanning started (report every {report_interval}s)")
+            report_task = asyncio.create_task(report_periodically())
+
+            while True:
+                heard = adverts_heard()
+                await asyncio.sleep(scan_window)
+                if adverts_heard() == heard:
+                    # BlueZ occasionally stops delivering discovery results; kick it
+                    logging.warning(f"scanner:: No adverts in the last {scan_window}s, restarting scanner")
+                    await scanner.stop()
+                    await scanner.start()
+        else:
+            while True:
+                await scanner.start()
+                logging.info("scanner:: Scanning started")
+                await asyncio.sleep(scan_window)
+                await scanner.stop()
+                apply_adverts(ingest_queue.drain())
+                # The report is sent while the next window scans, so a slow broker cannot keep the scanner stopped
+                if report_task is not None and not report_task.done():
+                    logging.warning("mqtt:: Previous report is still being sent, skipping this one")
+                else:
+                    report_task = asyncio.create_task(send_report_payload())
+                gc.collect()  # Run garbage collection to free up memory
 
     except asyncio.CancelledError:
         logging.info("scanner:: BLE scanning task cancelled.")
@@ -286,12 +752,96 @@ async def scan_ble_devices():
     except Exception as e:
         logging.info(f"scanner:: Error in BLE scanning: {e}")
         await scanner.stop()
+    finally:
+        consumer.cancel()
+        if report_task:
+            report_task.cancel()
+
+async def report_periodically():
+    """Sends a report every `report_interval` seconds while the scanner keeps running."""
+    loop = asyncio.get_running_loop()
+    next_report = loop.time() + report_interval
+
+    while True:
+        await asyncio.sleep(max(0.0, next_report - loop.time()))
+        # Apply whatever the consumer has not picked up yet so the report is current
+        apply_adverts(ingest_queue.drain())
+        await send_report_payload()
+
+        next_report += report_interval
+        if next_report < loop.time():
+            # A slow report overran the schedule; skip the missed slots instead of bursting
+            logging.warning("mqtt:: Report cycle overran the report interval")
+            next_report = loop.time() + report_interval
+
+async def track_presence():
+    """Evaluates presence every `presence_interval` seconds and publishes zone transitions."""
+    last_run = time.time()
+    while True:
+        await asyncio.sleep(presence_interval)
+        try:
+            now = time.time()
+            filter_rssi()
+            # last_seen has one-second resolution, so look back one extra second
+            events = presence_engine.evaluate(get_recent_devices(int(now - last_run) + 1), now)
+            last_run = now
+            if events:
+                await publish_presence_events(events, now)
+        except Exception as e:
+            logging.error(f"presence:: Error evaluating presence: {e}")
+
+async def publish_stream_updates():
+    """Sends the devices updated since the last tick to /api/stream clients every `stream_interval` seconds."""
+    while True:
+        await asyncio.sleep(stream_interval)
+        try:
+            if not len(stream_hub):
+                # Nobody is listening; stop collecting updated addresses
+                devices.stream_updates = None
+                continue
+            if devices.stream_updates is None:
+                devices.stream_updates = set()
+                continue
+
+            updated, devices.stream_updates = devices.stream_updates, set()
+            if not updated:
+                continue
+            filter_rssi()
+            records = [ble_devices_array[address].to_json() for address in updated if address in ble_devices_array]
+            update = await asyncio.to_thread(stream.Update.from_records, records)
+            stream_hub.publish(update)
+        except Exception as e:
+            logging.error(f"stream:: Error publishing stream update: {e}")
+
+async def publish_presence_events(events, now):
+    ensure_mqtt_connection()
+    topic = f"Gateways/{gateway_mac}/Presence"
+    message = json.dumps({"gateway_mac": gateway_mac, "time": int(now), "events": events})
+    await publisher.submit(topic, message, fallback=True)
+    logging.info(f"presence:: Queued {len(events)} presence events for MQTT topic: {topic}")
+
+async def consume_adverts():
+    """Drains the ingest queue in batches and applies them to the device table."""
+    first_batch = True
+    while True:
+        await asyncio.sleep(ingest_batch_interval)
+        try:
+            # Keep draining while the scanner is producing faster than one batch per interval
+            while len(ingest_queue):
+                apply_adverts(ingest_queue.drain(ingest_batch_size))
+                if first_batch:
+                    first_batch = False
+                    logging.info(f"scanner:: First adverts applied {time.monotonic() - startup_started:.2f}s after startup")
+                await asyncio.sleep(0)
+        except Exception as e:
+            logging.error(f"scanner:: Error applying advert batch: {e}")
 
 def run_flask_app():
-     app.run(host="0.0.0.0", port=os.getenv("PORT"))
+     create_app().run(host="0.0.0.0", port=os.getenv("PORT"))
 
 async def main():
-    global gateway_mac, mqtt_server_ip
+    global gateway_mac, mqtt_server_ip, telemetry_format, telemetry_compression, telemetry_spool, event_loop
+    event_loop = asyncio.get_running_loop()
     
     interface, ip, mac = get_active_interface()
     gateway_mac = mac.replace(':', '').upper() if mac else "defaultClientId"
@@ -301,6 +851,16 @@ async def main():
     
     mqtt_server_ip = os.getenv("MQTT_SERVER")
 
+    if telemetry_format not in telemetry_codec.available_formats():
+        logging.error(f"mqtt:: Telemetry format '{telemetry_format}' is not available, falling back to json")
+        telemetry_format = "json"
+    if telemetry_compression not in telemetry_codec.available_compressions():
+        logging.error(f"mqtt:: Telemetry compression '{telemetry_compression}' is not available, falling back to zlib")
+        telemetry_compression = "zlib"
+
+    # Third-party advertisement formats register themselves on import
+    decoder_plugins = decoders.load_plugins(os.getenv("DECODER_PLUGINS", "").split(","))
+
     print(f"---------------------------------------------------------")
     print(f"EazyTrax Gateway")
     print(f"---------------------------------------------------------")
@@ -310,11 +870,39 @@ async def main():
     print(f"IP: {ip}")
     print(f"Interface: {interface}")
     print(f"MQTT_SERVER_IP: {mqtt_server_ip}")
+    print(f"Scanner backend: {scanner_backend}")
+    print(f"RSSI filter: {rssi_filter_kind}" + (" (NumPy)" if devices.rssi_filter and devices.rssi_filter.use_numpy else ""))
+    print(f"Device table: {devices.max_devices or 'unbounded'} devices" + (" (pin rules set)" if devices.pin_rules else ""))
+    print(f"Scan mode: {scan_mode} (window {scan_window}s, report {report_interval}s)")
+    print(f"Publish mode: {publish_mode} (keyframe every {keyframe_interval} reports)")
+    print(f"Telemetry format: {telemetry_format} (compression {telemetry_compression}, max chunk {telemetry_max_chunk or 'off'})")
     print(f"Hostname: {hostname.get_current_hostname()}")
+    print(f"Decoder plugins: {', '.join(decoder_plugins) if decoder_plugins else 'none'}")
     print(f"---------------------------------------------------------")
 
-    # Start the BLE scanning task
+    # MQTT publishes go through a queue drained by a single worker task
+    publisher.on_failure = spool_message
+    publisher.start()
+    asyncio.create_task(metrics.monitor_event_loop())
+
+    # Scanning starts first: the spool, the other tasks and the HTTP server (which imports
+    # Flask) are set up while the scanner is already collecting adverts
     asyncio.create_task(scan_ble_devices())
+    await asyncio.sleep(0)
+
+    # Reports that could not be published are replayed from disk once the broker is back
+    if spool_path:
+        try:
+            telemetry_spool = Spool(spool_path, spool_max_bytes)
+            replayer = SpoolReplayer(telemetry_spool, publisher.submit, is_mqtt_connected, spool_replay_rate)
+            asyncio.create_task(replayer.run())
+            logging.info(f"spool:: Store-and-forward spool at {spool_path}: {telemetry_spool.stats()}")
+        except Exception as e:
+            logging.error(f"spool:: Could not open spool {spool_path}: {e}")
+
+    if presence_engine is not None:
+        asyncio.create_task(track_presence())
+    asyncio.create_task(publish_stream_updates())
 
     # Run Flask in a separate thread
     loop = asyncio.get_event_loop()
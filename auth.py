@@ -3,20 +3,48 @@ import hashlib
 import base64
 import time
 import os
+import threading
+from collections import OrderedDict
 from functools import wraps
-from flask import request, jsonify
 import logging
 
+import metrics
+
 # We'll use the device's MAC address as the SECRET_KEY
 # This will be set by app.py when it initializes
 _MAC_ADDRESS = None
 
+# HMAC-SHA256 state already keyed with the secret; each signature starts from a .copy()
+_KEYED_HMAC = None
+
+# Tokens that passed validation: token -> (mac, expiry). Repeat requests skip decoding and HMAC.
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 256))
+_verified_tokens = OrderedDict()
+_verified_lock = threading.Lock()
+
+# Token issuance per client address: a bucket of AUTH_TOKEN_BURST tokens refilled at AUTH_TOKEN_RATE per minute
+TOKEN_ISSUE_RATE = float(os.getenv("AUTH_TOKEN_RATE", 10)) / 60.0
+TOKEN_ISSUE_BURST = int(os.getenv("AUTH_TOKEN_BURST", 5))
+_MAX_RATE_CLIENTS = 1024
+_issue_buckets = OrderedDict()  # client -> [available, updated]
+_issue_lock = threading.Lock()
+
+TOKEN_CHECKS = metrics.counter("eazytrax_auth_token_checks_total", "Bearer token checks by outcome", labels=("result",))
+TOKEN_CHECKS_CACHED = TOKEN_CHECKS.labels("cached")
+TOKEN_CHECKS_VERIFIED = TOKEN_CHECKS.labels("verified")
+TOKEN_CHECKS_REJECTED = TOKEN_CHECKS.labels("rejected")
+TOKENS_RATE_LIMITED = metrics.counter(
+    "eazytrax_auth_token_requests_limited_total", "Token requests refused by the rate limit"
+).labels()
+
 def set_mac_address(mac_address):
     """Set the MAC address to be used as SECRET_KEY"""
-    global _MAC_ADDRESS
+    global _MAC_ADDRESS, _KEYED_HMAC
     if mac_address:
         # Clean the MAC address (remove colons, convert to uppercase)
         _MAC_ADDRESS = mac_address.replace(':', '').upper()
+        _KEYED_HMAC = hmac.new(get_secret_key().encode(), digestmod=hashlib.sha256)
+        clear_token_cache()
         logging.info(f"auth:: MAC address set for token generation: {_MAC_ADDRESS}")
     else:
         logging.warning("auth:: Attempted to set empty MAC address for token generation")
@@ -36,6 +64,42 @@ def get_secret_key():
     # Fallback to environment variable or default value
     return os.getenv("AUTH_SECRET_KEY", "eazytrax_gateway_default_secret")
 
+def sign(message):
+    """HMAC-SHA256 hex signature of `message` with the secret key."""
+    global _KEYED_HMAC
+    keyed = _KEYED_HMAC
+    if keyed is None:
+        # No MAC address set yet; key with the fallback secret
+        keyed = _KEYED_HMAC = hmac.new(get_secret_key().encode(), digestmod=hashlib.sha256)
+    signer = keyed.copy()
+    signer.update(message.encode())
+    return signer.hexdigest()
+
+def clear_token_cache():
+    """Forgets every verified token, e.g. after the secret key changed."""
+    with _verified_lock:
+        _verified_tokens.clear()
+
+def allow_token_request(client, now=None):
+    """Takes one token from `client`'s issuance bucket; returns 0 when allowed, else seconds to wait."""
+    now = time.monotonic() if now is None else now
+    with _issue_lock:
+        bucket = _issue_buckets.get(client)
+        if bucket is None:
+            bucket = _issue_buckets[client] = [float(TOKEN_ISSUE_BURST), now]
+            if len(_issue_buckets) > _MAX_RATE_CLIENTS:
+                _issue_buckets.popitem(last=False)
+        else:
+            _issue_buckets.move_to_end(client)
+            bucket[0] = min(TOKEN_ISSUE_BURST, bucket[0] + (now - bucket[1]) * TOKEN_ISSUE_RATE)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return 0
+        missing = 1.0 - bucket[0]
+    TOKENS_RATE_LIMITED.inc()
+    return missing / TOKEN_ISSUE_RATE if TOKEN_ISSUE_RATE > 0 else 60.0
+
 # Token expiration time in seconds (default: 24 hours)
 TOKEN_EXPIRY = int(os.getenv("AUTH_TOKEN_EXPIRY", 86400))
 
@@ -57,15 +121,8 @@ def generate_token(mac_address):
     # Create message to sign (mac:timestamp)
     message = f"{mac}:{timestamp}"
     
-    # Get the secret key (will use MAC address if set)
-    secret_key = get_secret_key()
-    
-    # Create signature using HMAC-SHA256
-    signature = hmac.new(
-        secret_key.encode(),
-        message.encode(),
-        hashlib.sha256
-    ).hexdigest()
+    # Create signature using HMAC-SHA256 (keyed with MAC address if set)
+    signature = sign(message)
     
     # Combine the elements and encode as base64
     token_data = f"{message}:{signature}"
@@ -78,6 +135,17 @@ def validate_token(token):
     Validate the token format, signature, and expiration time
     Returns (valid, mac_address, message)
     """
+    # A token verified before is valid until it expires
+    current_time = int(time.time())
+    with _verified_lock:
+        cached = _verified_tokens.get(token)
+        if cached is not None:
+            if current_time <= cached[1]:
+                _verified_tokens.move_to_end(token)
+                TOKEN_CHECKS_CACHED.inc()
+                return True, cached[0], "Valid token"
+            del _verified_tokens[token]
+
     try:
         # Decode from base64
         decoded = base64.b64decode(token).decode()
@@ -86,33 +154,34 @@ def validate_token(token):
         parts = decoded.split(':')
         
         if len(parts) != 3:
+            TOKEN_CHECKS_REJECTED.inc()
             return False, None, "Invalid token format"
         
         mac, timestamp, provided_signature = parts
         
         # Check if token has expired
-        current_time = int(time.time())
         if current_time > int(timestamp):
+            TOKEN_CHECKS_REJECTED.inc()
             return False, None, "Token expired"
         
-        # Get the secret key (will use MAC address if set)
-        secret_key = get_secret_key()
-        
         # Regenerate the signature to verify
-        message = f"{mac}:{timestamp}"
-        expected_signature = hmac.new(
-            secret_key.encode(),
-            message.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        expected_signature = sign(f"{mac}:{timestamp}")
         
         # Validate signature
         if not hmac.compare_digest(expected_signature, provided_signature):
+            TOKEN_CHECKS_REJECTED.inc()
             return False, None, "Invalid signature"
         
+        TOKEN_CHECKS_VERIFIED.inc()
+        if TOKEN_CACHE_SIZE > 0:
+            with _verified_lock:
+                _verified_tokens[token] = (mac, int(timestamp))
+                if len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                    _verified_tokens.popitem(last=False)
         return True, mac, "Valid token"
     
     except Exception as e:
+        TOKEN_CHECKS_REJECTED.inc()
         logging.error(f"Token validation error: {str(e)}")
         return False, None, f"Token validation error: {str(e)}"
 
@@ -122,6 +191,9 @@ def token_required(f):
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # Imported on use so that loading this module does not load Flask
+        from flask import request, jsonify
+
         token = None
         
         # Extract token from Authorization header
@@ -0,0 +1,99 @@
+"""
+Benchmark for the time-ordered device index in devices.py.
+
+Compares get_recent_devices() and cleanup_old_devices() against the previous
+filter-and-sort full scans at 10k, 50k and 100k tracked devices, with 5% of the
+table recent enough to be reported and 5% stale enough to be expired.
+The gc.collect() that both cleanup versions run afterwards is not timed.
+
+Run from the repository root:
+    python benchmarks/bench_device_index.py
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import devices
+from ble_device import BLEDevice
+
+SIZES = (10_000, 50_000, 100_000)
+RECENT_FRACTION = 0.05
+STALE_FRACTION = 0.05
+REPEAT = 20
+
+
+def full_scan_recent(max_second=60):
+    current_time = int(datetime.now().timestamp())
+    return sorted(
+        [d for d in devices.ble_devices_array.values() if (current_time - d.last_seen) <= max_second],
+        key=lambda d: d.last_seen,
+        reverse=True,
+    )
+
+
+def full_scan_cleanup(max_seconds=30):
+    current_time = int(datetime.now().timestamp())
+    stale = [a for a, d in devices.ble_devices_array.items() if (current_time - d.last_seen) > max_seconds]
+    for addr in stale:
+        del devices.ble_devices_array[addr]
+    return len(stale)
+
+
+def populate(size):
+    """Fills the table oldest-first: stale, then middle-aged, then recent devices."""
+    now = int(datetime.now().timestamp())
+    stale = int(size * STALE_FRACTION)
+    recent = int(size * RECENT_FRACTION)
+    devices.ble_devices_array.clear()
+    for i in range(size):
+        device = BLEDevice(f"{i:012X}", None, -70)
+        if i < stale:
+            device.last_seen = now - 120
+        elif i < size - recent:
+            device.last_seen = now - 20
+        else:
+            device.last_seen = now
+        devices.ble_devices_array[device.address] = device
+
+
+def timed(func, *args):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def timed_cleanup(func, size):
+    best = float("inf")
+    for _ in range(max(1, REPEAT // 4)):
+        populate(size)
+        start = time.perf_counter()
+        func(30)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    # Both cleanup paths end with the same gc.collect(); leave it out of the comparison
+    devices.gc.collect = lambda: 0
+    logging.disable(logging.INFO)
+
+    print(f"{'devices':>8} | {'recent scan':>12} {'recent index':>13} | {'cleanup scan':>13} {'cleanup index':>14}  (ms, best of runs)")
+    for size in SIZES:
+        populate(size)
+        assert {d.address for d in full_scan_recent(10)} == {d.address for d in devices.get_recent_devices(10)}
+        recent_scan = timed(full_scan_recent, 10)
+        recent_index = timed(devices.get_recent_devices, 10)
+        cleanup_scan = timed_cleanup(full_scan_cleanup, size)
+        cleanup_index = timed_cleanup(devices.cleanup_old_devices, size)
+        print(f"{size:>8} | {recent_scan:>12.2f} {recent_index:>13.2f} | {cleanup_scan:>13.2f} {cleanup_index:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
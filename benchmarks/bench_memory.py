@@ -0,0 +1,72 @@
+"""
+Memory benchmark for the device table.
+
+Fills ble_devices_array through the normal ingest path with a mix of iBeacons,
+EazyTrax sensor tags and phones advertising service UUIDs, then reports the
+traced bytes per tracked device (BLEDevice, its values and the table entry).
+
+Run from the repository root:
+    python benchmarks/bench_memory.py [device_count ...]
+"""
+import gc
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import devices
+from ingest import IngestQueue
+
+DEFAULT_COUNTS = (10_000, 50_000)
+FFE1 = "0000ffe1-0000-1000-8000-00805f9b34fb"
+PHONE_UUIDS = ["0000fe9f-0000-1000-8000-00805f9b34fb", "0000fd6f-0000-1000-8000-00805f9b34fb"]
+# Sites deploy beacons under a handful of proximity UUIDs, told apart by major/minor
+IBEACON_UUIDS = [bytes.fromhex("e2c56db5dffb48d2b060d0f5a71096e0"), bytes.fromhex("f7826da64fa24e988024bc5b71e0893e")]
+
+
+def advert(i, rng):
+    """Builds one raw advert tuple for device `i` (fresh objects, as the scanner delivers them)."""
+    address = f"{i:012X}"
+    rssi = rng.randint(-95, -40)
+    kind = i % 10
+    if kind < 4:
+        frame = bytes.fromhex("0215") + rng.choice(IBEACON_UUIDS) + rng.randbytes(4) + b"\xc5"
+        return address, None, rssi, {76: frame}, {}, []
+    if kind < 7:
+        frame = bytes.fromhex("ca05") + rng.randbytes(7)
+        return address, f"ETX-{i % 100}", rssi, {1593: frame}, {FFE1: bytes.fromhex("a101") + rng.randbytes(5)}, [FFE1]
+    return address, None, rssi, {6: rng.randbytes(10)}, {}, list(PHONE_UUIDS)
+
+
+def measure(count):
+    rng = random.Random(count)
+    queue = IngestQueue(count)
+    devices.clear_devices()
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(count):
+        queue.push(*advert(i, rng))
+    devices.apply_adverts(queue.drain())
+    del queue
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return total
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS
+    print(f"{'devices':>8} | {'traced MB':>10} | {'bytes/device':>12}")
+    for count in counts:
+        total = measure(count)
+        print(f"{count:>8} | {total / 1e6:>10.2f} | {total / count:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark for the scan path: scanner callback -> ingest queue -> device table -> report.
+
+Uses the fake scanner's generated advert pool (iBeacon, company 1593 ca05/ca00,
+ffe1 a101/a701 and phones), so it needs no Bluetooth adapter. For each advert
+rate it simulates one report cycle the way continuous mode runs it: adverts
+arrive through IngestQueue.on_advertisement, are drained every
+INGEST_BATCH_INTERVAL in INGEST_BATCH_SIZE batches, and the cycle ends with the
+gateway report (batch RSSI filter, recent devices to JSON and encoded). Reports:
+
+  callback   cost of the scan callback per advert
+  apply      draining and applying all adverts of the cycle
+  report     RSSI filter plus building and encoding the gateway report
+  cpu        (callback + apply + report) / cycle length; over 100% cannot keep up
+  dropped    adverts lost to a full ingest queue
+  peak MB    traced peak memory of the cycle (measured in a separate pass)
+
+Run from the repository root:
+    python benchmarks/bench_scan_path.py [--rates 1000 10000 50000 100000] [--devices 2000] [--cycle 10] [--no-memory]
+        [--rssi-filter legacy|ema|kalman|median] [--aggregation off|mean|min|max|last|full]
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregation
+import devices
+import telemetry_codec
+from ingest import IngestQueue
+from rssi_filter import RssiFilterBank
+from scanner_source import generate_adverts
+
+DEFAULT_RATES = (1_000, 10_000, 50_000, 100_000)
+BATCH_INTERVAL = float(os.getenv("INGEST_BATCH_INTERVAL", 0.25))
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 2000))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+
+
+def run_cycle(pool, rate, cycle):
+    """Runs one report cycle at `rate` adverts/s; returns timings in seconds and the queue."""
+    queue = IngestQueue(QUEUE_SIZE, keep_frames=devices.sensor_aggregator is not None)
+    callback = queue.on_advertisement
+    per_slice = int(rate * BATCH_INTERVAL)
+    slices = max(1, int(cycle / BATCH_INTERVAL))
+    position = 0
+    callback_time = apply_time = 0.0
+
+    for _ in range(slices):
+        started = time.perf_counter()
+        for _ in range(per_slice):
+            device, advertisement = pool[position]
+            callback(device, advertisement)
+            position = (position + 1) % len(pool)
+        callback_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        while len(queue):
+            devices.apply_adverts(queue.drain(BATCH_SIZE))
+        apply_time += time.perf_counter() - started
+
+    started = time.perf_counter()
+    devices.filter_rssi()
+    devices.aggregate_sensors()
+    payload = {"meta": {}, "reporter": {}, "reported": [device.to_json() for device in devices.get_recent_devices(60)]}
+    message = telemetry_codec.encode_payload(payload, "json")
+    report_time = time.perf_counter() - started
+
+    return callback_time, apply_time, report_time, queue, len(message)
+
+
+def reset(kind, aggregate):
+    devices.clear_devices()
+    devices.rssi_filter = None if kind == "legacy" else RssiFilterBank(kind)
+    devices.sensor_aggregator = None if aggregate == "off" else aggregation.SensorAggregator(aggregate)
+
+
+def measure(pool, rate, cycle, kind, aggregate, trace_memory=True):
+    reset(kind, aggregate)
+    gc.collect()
+    callback_time, apply_time, report_time, queue, size = run_cycle(pool, rate, cycle)
+
+    # Memory in a separate pass; tracing distorts the timings
+    peak = float("nan")
+    if trace_memory:
+        reset(kind, aggregate)
+        gc.collect()
+        tracemalloc.start()
+        run_cycle(pool, rate, cycle)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    adverts = queue.received
+    total = callback_time + apply_time + report_time
+    print(
+        f"{rate:>8} {adverts:>9} {callback_time / adverts * 1e6:>9.2f}us {apply_time * 1000:>9.1f}ms "
+        f"{report_time * 1000:>8.1f}ms {total / cycle * 100:>6.1f}% {queue.dropped:>9} "
+        f"{len(devices.ble_devices_array):>8} {size / 1024:>8.0f}KB {peak / 1024 / 1024:>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rates", type=int, nargs="+", default=DEFAULT_RATES, help="adverts per second")
+    parser.add_argument("--devices", type=int, default=2000, help="distinct devices in the generated stream")
+    parser.add_argument("--cycle", type=float, default=10.0, help="seconds per report cycle")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) traced memory pass")
+    parser.add_argument("--rssi-filter", default="ema", choices=("legacy", "ema", "kalman", "median"))
+    parser.add_argument("--aggregation", default="off", choices=("off",) + aggregation.MODES)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    pool = generate_adverts(args.devices)
+    print(f"{args.devices} devices, {args.cycle:g}s cycle, queue {QUEUE_SIZE}, "
+          f"batch {BATCH_SIZE} every {BATCH_INTERVAL}s, RSSI filter {args.rssi_filter}, aggregation {args.aggregation}")
+    print(f"{'rate/s':>8} {'adverts':>9} {'callback':>11} {'apply':>11} {'report':>10} {'cpu':>7} "
+          f"{'dropped':>9} {'devices':>8} {'payload':>10} {'peak MB':>8}")
+    for rate in args.rates:
+        measure(pool, rate, args.cycle, args.rssi_filter, args.aggregation, not args.no_memory)
+
+
+if __name__ == "__main__":
+    main()
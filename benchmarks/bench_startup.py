@@ -0,0 +1,165 @@
+"""
+Startup-time budget check for app.py.
+
+After a systemd restart or an OTA update the site is blind until the gateway
+scans again, so this measures how long that takes and fails when it regresses:
+
+  import        importing app (module configuration included) in a fresh interpreter
+  lazy          heavy dependencies that must not be loaded by that import
+  first advert  launching app.py until it logs the first applied adverts
+  http          launching app.py until its HTTP port accepts connections (reported only)
+
+Launches use the fake scanner (SCANNER_BACKEND=fake), so no Bluetooth adapter or
+MQTT broker is needed and the numbers are the gateway's own startup cost. The
+median of the runs is compared against the budgets. The exit status is 1 when
+any budget is exceeded or a lazy dependency is imported eagerly.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py [--runs 5] [--import-budget 0.5] [--first-advert-budget 2.0] [--timeout 30]
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed once the gateway is running (HTTP server, RSSI batch filter, device
+# connections, first report) or not at all; importing app must not load them
+LAZY_MODULES = ("pandas", "requests", "flask", "werkzeug", "numpy", "bleak", "psutil")
+
+FIRST_ADVERT = "scanner:: First adverts applied"
+PORT_LINE = re.compile(r"^PORT: (\d+)")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "eager": [name for name in %r if name in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def gateway_env():
+    env = dict(os.environ)
+    env.update({
+        "SCANNER_BACKEND": "fake",
+        "SCAN_MODE": "continuous",
+        "REPORT_INTERVAL": "60",  # no report during the measurement
+        "MQTT_SERVER": "127.0.0.1",
+        "SPOOL_PATH": "",
+        "PYTHONUNBUFFERED": "1",
+    })
+    return env
+
+
+def measure_import():
+    """Imports app in a fresh interpreter; returns (seconds, eagerly imported lazy modules)."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=gateway_env(),
+        capture_output=True, text=True, check=True,
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report["seconds"], report["eager"]
+
+
+def port_open(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.05):
+            return True
+    except OSError:
+        return False
+
+
+def measure_launch(timeout):
+    """Launches app.py; returns (seconds to the first applied adverts, seconds to HTTP ready)."""
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "app.py"], cwd=ROOT, env=gateway_env(),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    lines = queue.Queue()
+    threading.Thread(target=lambda: [lines.put(line) for line in process.stdout], daemon=True).start()
+
+    first_advert = http_ready = port = None
+    try:
+        while time.monotonic() - started < timeout and (first_advert is None or http_ready is None):
+            try:
+                line = lines.get(timeout=0.01)
+            except queue.Empty:
+                line = ""
+            now = time.monotonic() - started
+            if first_advert is None and FIRST_ADVERT in line:
+                first_advert = now
+            match = PORT_LINE.match(line)
+            if match:
+                port = int(match.group(1))
+            if http_ready is None and port is not None and port_open(port):
+                http_ready = time.monotonic() - started
+            if process.poll() is not None and lines.empty():
+                break
+    finally:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return first_advert, http_ready
+
+
+def seconds(value):
+    return f"{value:.3f}s" if value is not None else "timeout"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5, help="measurements of each kind; the median is checked")
+    parser.add_argument("--import-budget", type=float, default=0.5, help="seconds to import app")
+    parser.add_argument("--first-advert-budget", type=float, default=2.0,
+                        help="seconds from launch to the first applied adverts")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for each launch")
+    args = parser.parse_args()
+
+    failures = []
+
+    imports = []
+    eager = set()
+    for _ in range(args.runs):
+        elapsed, loaded = measure_import()
+        imports.append(elapsed)
+        eager.update(loaded)
+    import_time = statistics.median(imports)
+    print(f"{'import':<14} {seconds(import_time):>9}  (budget {args.import_budget:g}s, "
+          f"min {min(imports):.3f}s, max {max(imports):.3f}s)")
+    if import_time > args.import_budget:
+        failures.append(f"import took {import_time:.3f}s (budget {args.import_budget:g}s)")
+    print(f"{'lazy':<14} {'ok' if not eager else 'FAIL':>9}  ({', '.join(sorted(eager)) or 'none'} imported eagerly)")
+    if eager:
+        failures.append(f"imported eagerly: {', '.join(sorted(eager))}")
+
+    launches = [measure_launch(args.timeout) for _ in range(args.runs)]
+    first_adverts = [first for first, _ in launches if first is not None]
+    http_ready = [ready for _, ready in launches if ready is not None]
+    first_advert = statistics.median(first_adverts) if len(first_adverts) == len(launches) else None
+    print(f"{'first advert':<14} {seconds(first_advert):>9}  (budget {args.first_advert_budget:g}s)")
+    print(f"{'http':<14} {seconds(statistics.median(http_ready) if http_ready else None):>9}")
+    if first_advert is None:
+        failures.append(f"no adverts applied within {args.timeout:g}s in {len(launches) - len(first_adverts)} launches")
+    elif first_advert > args.first_advert_budget:
+        failures.append(f"first adverts took {first_advert:.3f}s (budget {args.first_advert_budget:g}s)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Size and throughput comparison of the telemetry wire formats in telemetry_codec.py.
+
+Builds a gateway payload from a mix of iBeacons, EazyTrax sensor tags, air-quality
+tags and anonymous phones, then encodes and decodes it in every available format
+(msgpack/cbor only when the optional packages are installed). zlib sizes are shown
+to compare against compressing the JSON instead. Throughput is normalized to the
+JSON payload size, so the MB/s columns compare directly across formats.
+
+Run from the repository root:
+    python benchmarks/bench_telemetry_codec.py [device_count]
+"""
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telemetry_codec
+from ble_device import BLEDevice
+
+REPEAT = 10
+
+
+def build_payload(count, seed=7):
+    rng = random.Random(seed)
+    now = int(time.time())
+    reported = []
+    for i in range(count):
+        device = BLEDevice(f"{rng.getrandbits(48):012X}", None, rng.randint(-95, -40))
+        device.last_seen = now - rng.randint(0, 30)
+        kind = i % 10
+        if kind < 4:
+            device.apply_readings({
+                "ibeacon_uuid": "e2c56db5dffb48d2b060d0f5a71096e0",
+                "ibeacon_major": rng.randint(1, 50),
+                "ibeacon_minor": rng.randint(1, 5000),
+                "ibeacon_rssi_1m": -59,
+            })
+            device.ibeacon_rssi = device.rssi
+        elif kind < 7:
+            device.name = f"ETX-{i}"
+            device.apply_readings({
+                "temperature": rng.randint(4000, 8000) / 256.0,
+                "humidity": rng.randint(5000, 20000) / 256.0,
+                "battery": rng.randint(10, 100),
+            })
+        elif kind < 8:
+            device.name = "AQ-Sensor"
+            device.apply_readings({
+                "co2": rng.randint(400, 2000), "formaldehyde": rng.randint(0, 50),
+                "tvoc": rng.randint(0, 500), "pm25": rng.randint(0, 80), "pm10": rng.randint(0, 120),
+                "temperature": rng.randint(15, 35) + rng.randint(0, 99) / 100,
+                "humidity": rng.randint(20, 80) + rng.randint(0, 99) / 100,
+            })
+        reported.append(device.to_json())
+
+    return {
+        "meta": {"access_token": "token", "topic": "telemetry", "api_version": "2.0", "gateway_mac": "NA"},
+        "reporter": {"name": "gateway", "mac": "dc:a6:32:00:00:01", "sw_version": "1.0.50", "time": now},
+        "reported": reported,
+    }
+
+
+def best_time(func, *args):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    payload = build_payload(count)
+    json_size = None
+
+    print(f"{count} devices")
+    print(f"{'format':>8} | {'bytes':>9} {'vs json':>8} {'zlib-6':>9} | {'encode MB/s':>12} {'decode MB/s':>12} {'encode ms':>10}")
+    for fmt in telemetry_codec.available_formats():
+        message = telemetry_codec.encode_payload(payload, fmt)
+        assert telemetry_codec.decode_payload(message) == payload, f"{fmt} round trip failed"
+        json_size = json_size or len(message)
+
+        encode = best_time(telemetry_codec.encode_payload, payload, fmt)
+        decode = best_time(telemetry_codec.decode_payload, message)
+        compressed = len(zlib.compress(message, 6))
+        print(f"{fmt:>8} | {len(message):>9} {len(message) / json_size:>7.0%} {compressed:>9} | "
+              f"{json_size / encode / 1e6:>12.1f} {json_size / decode / 1e6:>12.1f} {encode * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
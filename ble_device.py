@@ -2,13 +2,51 @@
 from math import fabs
 import struct
 import json
-from bleak import BleakClient
 import sys
 import os
 
+from decoders import decode_manufacturer_data, decode_service_data, is_ibeacon_frame
+
+
+def _bleak_client(address):
+    # bleak is only needed to connect to a device, so it is not imported at startup
+    from bleak import BleakClient
+    return BleakClient(address)
+
+
+# Attributes a decoder may set directly; any other reading name goes to extra_sensors
+READING_ATTRIBUTES = frozenset((
+    "battery", "temperature", "humidity", "co2", "formaldehyde", "tvoc", "pm25", "pm10",
+    "ibeacon_uuid", "ibeacon_major", "ibeacon_minor", "ibeacon_rssi_1m", "ibeacon_rssi",
+))
+
+# to_json() key for each attribute published under "sensors" / "ibeacon"
+SENSOR_FIELDS = ("temperature", "humidity", "battery", "co2", "formaldehyde", "tvoc", "pm25", "pm10")
+IBEACON_FIELDS = {
+    "ibeacon_uuid": "uuid",
+    "ibeacon_major": "major",
+    "ibeacon_minor": "minor",
+    "ibeacon_rssi": "rssi",
+    "ibeacon_rssi_1m": "rssi_1m",
+}
+
 
 class BLEDevice:
     """Represents a single BLE device."""
+
+    # Fixed layout without a per-instance __dict__; the device table holds one per address
+    __slots__ = (
+        "address", "name", "rssi", "battery", "temperature", "humidity", "co2",
+        "formaldehyde", "tvoc", "pm25", "pm10", "ibeacon_uuid", "ibeacon_major",
+        "ibeacon_minor", "ibeacon_rssi_1m", "ibeacon_rssi", "last_seen",
+        "service_uuids", "service_data_keys", "manufacture_data_keys",
+        "extra_sensors", "services", "changed", "published_rssi", "last_frames",
+        "filter_slot", "sensor_stats", "pinned",
+    )
+
+    # Smoothed RSSI must move at least this many dBm from the last published value to count as a change
+    rssi_change_threshold = 3
+
     def __init__(self, address: str, name: str, rssi: int):
         self.address = address
         self.name = name
@@ -27,32 +65,72 @@ class BLEDevice:
         self.ibeacon_rssi_1m = None
         self.ibeacon_rssi = None
         self.last_seen = int(datetime.now().timestamp())
-        self.service_uuids = []  # List to track unique service UUIDs
-        self.service_data_keys = []  # List to track unique service data keys
-        self.manufacture_data_keys = []  # List to track unique manufacturer data keys
+        self.service_uuids = ()  # Unique service UUIDs (interned strings)
+        self.service_data_keys = ()  # Unique service data keys (interned strings)
+        self.manufacture_data_keys = ()  # Unique manufacturer data keys
+        self.extra_sensors = None  # Readings from plugin decoders without a dedicated attribute
         self.services = None  # Cache services
+        self.changed = None  # Names of fields changed since the last publish (None when clean)
+        self.published_rssi = None  # RSSI at the last publish (None until first published)
+        self.last_frames = None  # (key, frame hash, key, frame hash, ...) of the last frame per data key
+        self.filter_slot = None  # Slot in the RSSI filter bank, when batch filtering is enabled
+        self.sensor_stats = None  # Last report window's per-sensor summary (SENSOR_AGGREGATION=full)
+        self.pinned = False  # Pinned devices are evicted from a full device table only as a last resort
 
     def add_service_uuid(self, uuid):
-        """Add a new service UUID if it's not already in the list."""
+        """Add a new service UUID if it's not already tracked."""
         if uuid not in self.service_uuids:
-            self.service_uuids.append(uuid)
+            self.service_uuids += (sys.intern(uuid),)
 
     def add_service_data_key(self, key):
-        """Add a new service data key if it's not already in the list."""
+        """Add a new service data key if it's not already tracked."""
         if key not in self.service_data_keys:
-            self.service_data_keys.append(key)
+            self.service_data_keys += (sys.intern(key),)
 
     def add_manufacture_data_key(self, key):
-        """Add a new manufacturer data key if it's not already in the list."""
+        """Add a new manufacturer data key if it's not already tracked."""
         if key not in self.manufacture_data_keys:
-            self.manufacture_data_keys.append(key)
+            self.manufacture_data_keys += (key,)
 
-    def update(self, name: str, rssi: int):
+    def update(self, name: str, rssi: int, timestamp: float = None):
         ALPHA = 0.6
         """Update device info with an EMA smoothing technique."""
-        self.name = name
+        if name != self.name:
+            self.name = name
+            self.mark_changed("name")
         self.rssi = int(ALPHA * rssi + (1 - ALPHA) * self.rssi) if self.rssi else rssi
-        self.last_seen = int(datetime.now().timestamp())
+        if self.published_rssi is not None and abs(self.rssi - self.published_rssi) >= self.rssi_change_threshold:
+            self.mark_changed("rssi")
+        self.last_seen = int(timestamp if timestamp is not None else datetime.now().timestamp())
+
+    def touch(self, name: str, timestamp: float):
+        """Records an advert whose RSSI is smoothed later by the batch RSSI filter."""
+        if name != self.name:
+            self.name = name
+            self.mark_changed("name")
+        self.last_seen = int(timestamp)
+
+    def set_filtered_rssi(self, rssi: float):
+        """Applies the batch RSSI filter output."""
+        self.rssi = int(round(rssi))
+        if self.published_rssi is not None and abs(self.rssi - self.published_rssi) >= self.rssi_change_threshold:
+            self.mark_changed("rssi")
+
+    def mark_changed(self, field: str):
+        """Record that `field` changed since the last publish."""
+        if self.changed is None:
+            self.changed = {field}
+        else:
+            self.changed.add(field)
+
+    def has_changes(self):
+        """True when the device was never published or has changed since the last publish."""
+        return self.published_rssi is None or self.changed is not None
+
+    def mark_published(self):
+        """Reset change tracking after the device has been published."""
+        self.changed = None
+        self.published_rssi = self.rssi
 
     def update_battery(self, battery: int):
         """Update the battery level."""
@@ -81,6 +159,28 @@ class BLEDevice:
     def update_pm10(self, value: float):
         self.pm10 = value
 
+    def apply_readings(self, readings: dict):
+        """Apply decoded readings (attribute name -> value) from a registered decoder."""
+        for name, value in readings.items():
+            if name in READING_ATTRIBUTES:
+                if getattr(self, name) == value:
+                    continue
+                setattr(self, name, value)
+            elif self.extra_sensors is None:
+                self.extra_sensors = {name: value}
+            elif self.extra_sensors.get(name) == value:
+                continue
+            else:
+                self.extra_sensors[name] = value
+            self.mark_changed(name)
+
+    def apply_aggregates(self, readings: dict, stats: dict = None):
+        """Replaces the point sensor values with the report window's aggregates."""
+        self.apply_readings(readings)
+        if stats is not None:
+            self.sensor_stats = stats
+            self.mark_changed("sensor_stats")
+
     def update_ibeacon(
         self, uuid: str, major: int, minor: int, rssi_1m: int, rssi: int
     ):
@@ -118,16 +218,51 @@ class BLEDevice:
             }.items() if v is not None},
         }
 
+        if self.extra_sensors:
+            json_data["sensors"].update(self.extra_sensors)
+
+        if self.sensor_stats:
+            json_data["sensor_stats"] = self.sensor_stats
+
         if include_service_manufacture_data:
             json_data.update({
-                "service_uuids": self.service_uuids,  
-                "service_data_keys": self.service_data_keys,  
-                "manufacture_data_keys": self.manufacture_data_keys,  
+                "service_uuids": list(self.service_uuids),
+                "service_data_keys": list(self.service_data_keys),
+                "manufacture_data_keys": list(self.manufacture_data_keys),
             })
 
         return json_data
 
 
+    def to_delta_json(self):
+        """
+        Like to_json(), but only with the fields changed since the last publish.
+        A device that was never published is returned in full.
+        """
+        if self.published_rssi is None:
+            return self.to_json()
+
+        changed = self.changed or ()
+        json_data = {"address": self.address, "last_seen": self.last_seen}
+        if "name" in changed:
+            json_data["name"] = self.name
+        if "rssi" in changed:
+            json_data["rssi"] = self.rssi
+
+        sensors = {k: getattr(self, k) for k in SENSOR_FIELDS if k in changed}
+        if self.extra_sensors:
+            sensors.update({k: v for k, v in self.extra_sensors.items() if k in changed})
+        if sensors:
+            json_data["sensors"] = sensors
+        if "sensor_stats" in changed:
+            json_data["sensor_stats"] = self.sensor_stats
+
+        ibeacon = {key: getattr(self, attr) for attr, key in IBEACON_FIELDS.items() if attr in changed}
+        if ibeacon:
+            json_data["ibeacon"] = ibeacon
+
+        return json_data
+
     def parse_ibeacon(self, data):
         if len(data) >= 46 and data[0:4] == "0215":
             uuid = data[4:36]
@@ -152,7 +287,7 @@ class BLEDevice:
         async def read_characteristic(self, service_uuid, char_uuid):
             """Reads a specific BLE characteristic from a given service UUID."""
             try:
-                async with BleakClient(self.address) as client:
+                async with _bleak_client(self.address) as client:
                     if not client.is_connected:
                         return {"error": "Failed to connect to BLE device"}
                 
@@ -182,92 +317,59 @@ class BLEDevice:
             except Exception as e:
                 return {"error": str(e)}
 
-    def process_service_uuids(self, advertisement_data):
+    def process_service_uuids(self, service_uuids):
         """Processes service UUIDs from advertisement data."""
-        for uuid in advertisement_data.service_uuids:
+        for uuid in service_uuids:
             self.add_service_uuid(uuid)
 
 
 
-    def process_service_data(self, advertisement_data):
+    def is_repeat_frame(self, key, value):
+        """True when `value` is identical to the last frame seen under `key`; remembers it otherwise."""
+        # A flat tuple of hashes is far smaller than a dict of frames, and devices carry one or two keys
+        digest = hash(bytes(value))
+        last_frames = self.last_frames
+        if last_frames is None:
+            self.last_frames = (key, digest)
+            return False
+        for i in range(0, len(last_frames), 2):
+            if last_frames[i] == key:
+                if last_frames[i + 1] == digest:
+                    return True
+                self.last_frames = last_frames[:i + 1] + (digest,) + last_frames[i + 2:]
+                return False
+        self.last_frames = last_frames + (key, digest)
+        return False
+
+    def process_service_data(self, service_data):
         """Processes service data from advertisement data."""
-
-        for key, value in advertisement_data.service_data.items():
+        for key, value in service_data.items():
+            # A repeated frame decodes to the readings already applied
+            if self.is_repeat_frame(key, value):
+                continue
             self.add_service_data_key(key)
-            #print(f"> value: {value}") 
-            
+
             # Check for specific data formats (e.g., custom sensor data)
-            if key == "0000ffe1-0000-1000-8000-00805f9b34fb" and value.hex().startswith("a101"):
-                self.update_battery(int(value.hex()[4:6], 16))
-                # Handle signed temperature value (support negative temperatures)
-                temp_raw = int(value.hex()[6:10], 16)
-                if temp_raw > 32767:  # Check if it's a negative value (2's complement for 16-bit)
-                    temp_raw = temp_raw - 65536
-                self.update_temperature(temp_raw / 256.0)
-                self.update_humidity(int(value.hex()[10:14], 16) / 256.0)
-
-            if key == "0000ffe1-0000-1000-8000-00805f9b34fb" and value.hex().startswith("a701"):
-                payload = value[2:]  # Skip 0xA7 + 0x01
-
-                #print("------------------------------------")
-                ##print(payload.hex())
-                #print(len(payload))
-                if len(payload) >= 14:
-                    eco2 = int.from_bytes(payload[0:2])
-                    ech2o = int.from_bytes(payload[2:4])
-                    tvoc = int.from_bytes(payload[4:6])
-                    pm25 = int.from_bytes(payload[6:8])
-                    pm10 = int.from_bytes(payload[8:10])
-                    # Handle signed temperature value (support negative temperatures)
-                    temp_raw = payload[10]
-                    if temp_raw > 127:  # Check if it's a negative value (2's complement for 8-bit)
-                        temp_raw = temp_raw - 256
-                    temperature = temp_raw + payload[11] / 100
-                    humidity = payload[12] + payload[13] / 100
-
-                    self.update_co2(eco2)
-                    self.update_formaldehyde(ech2o)
-                    self.update_tvoc(tvoc)
-                    self.update_pm25(pm25)
-                    self.update_pm10(pm10)
-                    self.update_temperature(temperature)
-                    self.update_humidity(humidity)
-
-                    #print(f"✅ Parsed Air Sensor — CO₂:{eco2}, HCHO:{ech2o}, TVOC:{tvoc}, PM2.5:{pm25}, PM10:{pm10}, Temp:{temperature:.2f}°C, RH:{humidity:.2f}%")
-
-            elif False:
-                print(f">---------process_service_data----------------")
-                #print(f"> process_service_data: {advertisement_data}")
-                print(f"> value: {value}")
-                print(f"> key: {key}")
-                print(f"> value.hex(): {value.hex()}")
-
-    def process_manufacturer_data(self, advertisement_data):
+            readings = decode_service_data(key, value)
+            if readings:
+                self.apply_readings(readings)
+
+    def process_manufacturer_data(self, manufacturer_data, rssi):
         """Processes manufacturer data from advertisement data."""
-        for key, value in advertisement_data.manufacturer_data.items():
+        for key, value in manufacturer_data.items():
+            if self.is_repeat_frame(key, value):
+                # Only the iBeacon RSSI depends on the advert rather than the frame
+                if is_ibeacon_frame(key, value):
+                    self.ibeacon_rssi = rssi
+                continue
             self.add_manufacture_data_key(key)
-            # Apple iBeacon
-            if key == 76:
-                uuid, major, minor, rssi_1m = self.parse_ibeacon(value.hex())
-                if uuid:
-                    self.update_ibeacon(uuid, major, minor, rssi_1m, advertisement_data.rssi)
-
-            # Custom Sensor Data
-            elif  key == 1593:
-                hex_value = value.hex()
-                if hex_value.startswith("ca05"):
-                    # Handle signed temperature value (support negative temperatures)
-                    temp_raw = int(hex_value[10:14], 16)
-                    if temp_raw > 32767:  # Check if it's a negative value (2's complement for 16-bit)
-                        temp_raw = temp_raw - 65536
-                    self.update_temperature(temp_raw / 256.0)
-                    self.update_humidity(int(hex_value[14:18], 16) / 256.0)
-                elif hex_value.startswith("ca00"):
-                    self.update_battery(int(hex_value[16:18], 16))
 
-            else:
-                # Process other manufacturer data silently
-                pass
+            # Apple iBeacon, custom sensor data and any registered plugin formats
+            readings = decode_manufacturer_data(key, value)
+            if readings:
+                self.apply_readings(readings)
+                if "ibeacon_uuid" in readings:
+                    self.ibeacon_rssi = rssi
 
     def debug_print(self, advertisement_data):
         """Prints debug information for the BLE device."""
@@ -286,7 +388,7 @@ class BLEDevice:
         #if self.services:  # Return cached services if available
             #return {"services": self.services}
         try:
-            async with BleakClient(self.address) as client:
+            async with _bleak_client(self.address) as client:
                 if not client.is_connected:
                     return {"error": "Failed to connect to BLE device"}
                 else:
@@ -328,7 +430,7 @@ class BLEDevice:
             return {"error": "No services available. Scan first."}
 
         try:
-            async with BleakClient(self.address) as client:
+            async with _bleak_client(self.address) as client:
                 if not client.is_connected:
                     return {"error": "Failed to connect to BLE device"}
 
@@ -0,0 +1,206 @@
+import importlib
+import logging
+import os
+from collections import OrderedDict
+import struct
+import sys
+import time
+
+import metrics
+
+# Advertisement decoder registry.
+#
+# Frames are dispatched on (company ID, first two bytes) for manufacturer data
+# and on (service UUID, first two bytes) for service data, so every advert costs
+# a single dict lookup. Each decoder owns a precompiled struct.Struct and reads
+# straight from the raw bytes; it returns a dict of reading names to values, or
+# None when the frame is too short. Names matching a BLEDevice attribute update
+# it directly; any other name is published as an extra sensor value.
+#
+# Third-party sensor formats register themselves with the decorators below and
+# are loaded at startup from the modules listed in DECODER_PLUGINS.
+#
+# Decoded readings are memoized in a bounded LRU keyed by the raw frame, so a
+# frame shared by several devices (or seen again after a device was expired) is
+# parsed once. Cached readings dicts are shared: callers must not mutate them.
+
+PREFIX_LENGTH = 2
+
+IBEACON_COMPANY_ID = 76
+IBEACON_PREFIX = b"\x02\x15"
+IBEACON_FRAME_LENGTH = 23
+EAZYTRAX_COMPANY_ID = 1593
+FFE1_SERVICE_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+
+_manufacturer_decoders = {}
+_service_data_decoders = {}
+
+DECODE_CACHE_SIZE = int(os.getenv("DECODE_CACHE_SIZE", 4096))  # frames, 0 disables the cache
+_decode_cache = OrderedDict()  # (company ID or service UUID, frame) -> readings
+
+DECODE_SECONDS = metrics.histogram(
+    "eazytrax_decode_seconds", "Time spent decoding one advertisement frame", labels=("decoder",),
+    buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001, 0.01),
+)
+DECODE_CACHE_HITS = metrics.counter("eazytrax_decode_cache_hits_total", "Frames answered from the decode cache").labels()
+DECODE_CACHE_MISSES = metrics.counter("eazytrax_decode_cache_misses_total", "Frames decoded because they were not cached").labels()
+
+
+class Decoder:
+    """A precompiled struct layout plus a converter from unpacked fields to readings."""
+
+    __slots__ = ("name", "struct", "convert", "timer")
+
+    def __init__(self, name, fmt, convert):
+        self.name = name
+        self.struct = struct.Struct(fmt)
+        self.convert = convert
+        self.timer = DECODE_SECONDS.labels(name)
+
+    def __call__(self, data):
+        if len(data) < self.struct.size:
+            return None
+        started = time.perf_counter()
+        readings = self.convert(*self.struct.unpack_from(data))
+        self.timer.observe(time.perf_counter() - started)
+        return readings
+
+    def __repr__(self):
+        return f"Decoder(name={self.name}, format={self.struct.format})"
+
+
+def _register(table, key, prefix, fmt, convert):
+    prefix = bytes(prefix)
+    if len(prefix) != PREFIX_LENGTH:
+        raise ValueError(f"Decoder prefix must be {PREFIX_LENGTH} bytes, got {prefix.hex()}")
+
+    decoder = Decoder(convert.__name__, fmt, convert)
+    if (key, prefix) in table:
+        logging.warning(f"decoders:: Replacing decoder for {key}/{prefix.hex()} with {decoder.name}")
+        clear_decode_cache()
+    table[(key, prefix)] = decoder
+    return decoder
+
+
+def register_manufacturer_decoder(company_id, prefix, fmt, convert):
+    """Register `convert` for manufacturer data of `company_id` starting with `prefix`."""
+    return _register(_manufacturer_decoders, company_id, prefix, fmt, convert)
+
+
+def register_service_data_decoder(service_uuid, prefix, fmt, convert):
+    """Register `convert` for service data of `service_uuid` starting with `prefix`."""
+    return _register(_service_data_decoders, service_uuid.lower(), prefix, fmt, convert)
+
+
+def manufacturer_decoder(company_id, prefix, fmt):
+    """Decorator form of register_manufacturer_decoder."""
+    def wrapper(convert):
+        register_manufacturer_decoder(company_id, prefix, fmt, convert)
+        return convert
+    return wrapper
+
+
+def service_data_decoder(service_uuid, prefix, fmt):
+    """Decorator form of register_service_data_decoder."""
+    def wrapper(convert):
+        register_service_data_decoder(service_uuid, prefix, fmt, convert)
+        return convert
+    return wrapper
+
+
+def decode_manufacturer_data(company_id, data):
+    """Decodes a manufacturer data frame into readings, or returns None."""
+    decoder = _manufacturer_decoders.get((company_id, bytes(data[:PREFIX_LENGTH])))
+    return _decode_cached(decoder, company_id, data) if decoder else None
+
+
+def decode_service_data(service_uuid, data):
+    """Decodes a service data frame into readings, or returns None."""
+    decoder = _service_data_decoders.get((service_uuid, bytes(data[:PREFIX_LENGTH])))
+    return _decode_cached(decoder, service_uuid, data) if decoder else None
+
+
+def _decode_cached(decoder, key, data):
+    if not DECODE_CACHE_SIZE:
+        return decoder(data)
+    cache_key = (key, bytes(data))
+    readings = _decode_cache.get(cache_key)
+    if readings is not None:
+        _decode_cache.move_to_end(cache_key)
+        DECODE_CACHE_HITS.inc()
+        return readings
+
+    DECODE_CACHE_MISSES.inc()
+    readings = decoder(data)
+    if readings is not None:
+        _decode_cache[cache_key] = readings
+        if len(_decode_cache) > DECODE_CACHE_SIZE:
+            _decode_cache.popitem(last=False)
+    return readings
+
+
+def clear_decode_cache():
+    """Drops memoized readings, e.g. after a decoder was replaced."""
+    _decode_cache.clear()
+
+
+def is_ibeacon_frame(company_id, data):
+    """True when the frame decodes as an iBeacon (so its RSSI is the iBeacon RSSI)."""
+    return company_id == IBEACON_COMPANY_ID and len(data) >= IBEACON_FRAME_LENGTH and data.startswith(IBEACON_PREFIX)
+
+
+def load_plugins(module_names):
+    """Imports decoder plugin modules; each registers its decoders on import."""
+    loaded = []
+    for name in module_names:
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception as e:
+            logging.error(f"decoders:: Failed to load decoder plugin {name}: {e}")
+    return loaded
+
+
+# ---------------------------------------------------------------------------
+# Built-in formats
+# ---------------------------------------------------------------------------
+
+@manufacturer_decoder(IBEACON_COMPANY_ID, IBEACON_PREFIX, ">2x16sHHb")
+def ibeacon(uuid, major, minor, rssi_1m):
+    return {
+        "ibeacon_uuid": sys.intern(uuid.hex()),
+        "ibeacon_major": major,
+        "ibeacon_minor": minor,
+        "ibeacon_rssi_1m": rssi_1m,
+    }
+
+
+@manufacturer_decoder(EAZYTRAX_COMPANY_ID, b"\xca\x05", ">5xhH")
+def eazytrax_ca05(temperature, humidity):
+    return {"temperature": temperature / 256.0, "humidity": humidity / 256.0}
+
+
+@manufacturer_decoder(EAZYTRAX_COMPANY_ID, b"\xca\x00", ">8xB")
+def eazytrax_ca00(battery):
+    return {"battery": battery}
+
+
+@service_data_decoder(FFE1_SERVICE_UUID, b"\xa1\x01", ">2xBhH")
+def ffe1_a101(battery, temperature, humidity):
+    return {"battery": battery, "temperature": temperature / 256.0, "humidity": humidity / 256.0}
+
+
+@service_data_decoder(FFE1_SERVICE_UUID, b"\xa7\x01", ">2xHHHHHbBBB")
+def ffe1_a701(co2, formaldehyde, tvoc, pm25, pm10, temp_int, temp_frac, hum_int, hum_frac):
+    return {
+        "co2": co2,
+        "formaldehyde": formaldehyde,
+        "tvoc": tvoc,
+        "pm25": pm25,
+        "pm10": pm10,
+        "temperature": temp_int + temp_frac / 100,
+        "humidity": hum_int + hum_frac / 100,
+    }
@@ -1,41 +1,252 @@
+from collections import OrderedDict
 from datetime import datetime
 from ble_device import BLEDevice
 import gc
 import logging
 
-# Dictionary to store BLE devices
-ble_devices_array = {}
+import metrics
+
+# Dictionary to store BLE devices, kept in last_seen order (oldest first).
+# Every update moves the device to the end, so recency queries walk back from
+# the end and expiry pops from the front, each touching only the devices involved.
+ble_devices_array = OrderedDict()
+
+DEVICES_EVICTED = metrics.counter("eazytrax_devices_evicted_total", "Devices removed from the device table")
+DEVICES_CAPACITY_EVICTED = metrics.counter(
+    "eazytrax_devices_capacity_evicted_total", "Devices evicted to make room in a full device table", labels=("kind",),
+)
+DEVICES_EVICTED_UNPINNED = DEVICES_CAPACITY_EVICTED.labels("unpinned")
+DEVICES_EVICTED_PINNED = DEVICES_CAPACITY_EVICTED.labels("pinned")
+DEVICES_CREATED = metrics.counter("eazytrax_devices_created_total", "Devices added to the device table")
+metrics.callback("eazytrax_devices", "Devices in the device table", lambda: len(ble_devices_array))
+
+# Device table bound (0 = unbounded). A full table evicts at insert time: the least
+# recently seen unpinned device, or the oldest device once only pinned devices are
+# left. set_capacity() turns a byte budget into an entry count, counting the per-device
+# state of the features enabled at that point (filter slots, aggregation windows and
+# sensor histories, which are bounded separately by their own max_devices).
+max_devices = 0
+# Approximate bytes per tracked device, including its table entry (see benchmarks/bench_memory.py)
+DEVICE_BYTES_ESTIMATE = 1024
+FILTER_SLOT_BYTES_ESTIMATE = 64  # RssiFilterBank slot; its arrays grow by doubling
+MEDIAN_SAMPLE_BYTES = 24  # one sample carried over in the median window (slot, rssi, time)
+MEDIAN_ADVERT_RATE_ESTIMATE = 2.0  # adverts per second per device assumed for the median window
+AGGREGATOR_BYTES_ESTIMATE = 768  # one device's SensorAggregator window
+HISTORY_SERIES_ESTIMATE = 4  # sensor arrays assumed per DeviceHistory, besides its timestamps
+HISTORY_OVERHEAD_ESTIMATE = 1024  # DeviceHistory object, its dict and its entry in SensorHistory
+# filters.RuleSet selecting the devices to pin, or None; set before any advert is applied
+pin_rules = None
+pinned_count = 0
+# The unpinned devices in last_seen order, so the eviction victim is always the first entry.
+# Only kept while pin rules are set; without them every device is unpinned and
+# ble_devices_array itself is that order.
+unpinned_devices = OrderedDict()
+
+# RssiFilterBank smoothing RSSI once per report, or None for the per-advert EMA in BLEDevice.update()
+rssi_filter = None
+# SensorHistory sampling sensor values as adverts are applied, or None when disabled
+sensor_history = None
+# Addresses updated since /api/stream last took them, or None while nobody is streaming
+stream_updates = None
+# SensorAggregator folding every decoded sample into the report window, or None to publish point values
+sensor_aggregator = None
+
+def apply_adverts(batch):
+    """
+    Applies a coalesced batch from IngestQueue.drain() to the device table.
+    Each device is created or updated once, with its RSSI samples folded in order.
+    The batch is ordered by last advert time, which keeps the table in last_seen order.
+    """
+    created = 0
+    bank = rssi_filter
+    history = sensor_history
+    aggregator = sensor_aggregator
+    pins = pin_rules
+    unpinned = unpinned_devices
+    global pinned_count
+    for address, (name, rssi_samples, manufacturer_data, service_data, service_uuids, timestamp, sample_times,
+                  frames) in batch.items():
+        latest_rssi = rssi_samples[-1]
+        device = ble_devices_array.get(address)
+        if device is None:
+            if max_devices and len(ble_devices_array) >= max_devices:
+                evict_device()
+            device = ble_devices_array[address] = BLEDevice(address, name, rssi_samples[0])
+            device.last_seen = int(timestamp)
+            created += 1
+            if pins is not None:
+                if pins.match_fields(address, name, manufacturer_data, service_data, service_uuids) is not None:
+                    device.pinned = True
+                    pinned_count += 1
+                else:
+                    unpinned[address] = device
+            if bank is None:
+                rssi_samples = rssi_samples[1:]
+        else:
+            ble_devices_array.move_to_end(address)
+            if pins is not None and not device.pinned:
+                # Identifying data can arrive after the first advert (scan responses, late names)
+                if (manufacturer_data or service_data or service_uuids or name) and pins.match_fields(
+                        address, name or device.name, manufacturer_data, service_data, service_uuids) is not None:
+                    device.pinned = True
+                    pinned_count += 1
+                    del unpinned[address]
+                else:
+                    unpinned.move_to_end(address)
+
+        if bank is not None:
+            # Raw samples are smoothed for all devices at once by filter_rssi()
+            if device.filter_slot is None:
+                device.filter_slot = bank.acquire(device)
+            bank.add_samples(device.filter_slot, rssi_samples, sample_times)
+            device.touch(name, timestamp)
+        else:
+            for rssi in rssi_samples:
+                device.update(name, rssi, timestamp)
+
+        device.process_manufacturer_data(manufacturer_data, latest_rssi)
+        device.process_service_uuids(service_uuids)
+        device.process_service_data(service_data)
+        if aggregator is not None:
+            # Every advert's frames count, including the ones coalescing merged away and repeats
+            if frames is None:
+                aggregator.add_frames(device, manufacturer_data, service_data)
+            else:
+                for frame_manufacturer_data, frame_service_data in frames:
+                    aggregator.add_frames(device, frame_manufacturer_data, frame_service_data)
+        if history is not None:
+            history.record(device, timestamp)
+
+    if stream_updates is not None:
+        stream_updates.update(batch)
+    if created:
+        DEVICES_CREATED.inc(created)
+    return len(batch)
+
+def memory_estimate():
+    """
+    Returns (bytes per device, bytes per sensor history, most histories kept) for the
+    features currently enabled; history memory stops growing at that history count.
+    """
+    per_device = DEVICE_BYTES_ESTIMATE
+    if rssi_filter is not None:
+        per_device += FILTER_SLOT_BYTES_ESTIMATE
+        if rssi_filter.kind == "median":
+            per_device += int(rssi_filter.window * MEDIAN_ADVERT_RATE_ESTIMATE) * MEDIAN_SAMPLE_BYTES
+    if sensor_aggregator is not None:
+        per_device += AGGREGATOR_BYTES_ESTIMATE
+    if sensor_history is None:
+        return per_device, 0, 0
+    per_history = 8 * sensor_history.capacity * (1 + HISTORY_SERIES_ESTIMATE) + HISTORY_OVERHEAD_ESTIMATE
+    return per_device, per_history, sensor_history.max_devices
+
+def set_capacity(max_count=0, max_bytes=0):
+    """
+    Bounds the device table to `max_count` devices and about `max_bytes` bytes (0 = no limit).
+    Call it once the optional per-device features are set, since the byte budget covers them.
+    """
+    global max_devices
+    limits = [max_count] if max_count else []
+    if max_bytes:
+        per_device, per_history, history_limit = memory_estimate()
+        # Every device may have a sensor history until the history bound is reached
+        count = max_bytes // (per_device + per_history)
+        if history_limit and count > history_limit:
+            count = (max_bytes - history_limit * per_history) // per_device
+        limits.append(max(1, count))
+    max_devices = min(limits) if limits else 0
+    return max_devices
+
+def _forget(device):
+    """Releases what a device removed from the table holds elsewhere."""
+    global pinned_count
+    if rssi_filter is not None:
+        rssi_filter.release(device.filter_slot)
+    if device.pinned:
+        pinned_count -= 1
+    else:
+        unpinned_devices.pop(device.address, None)
+
+def evict_device():
+    """Removes the least recently seen unpinned device, or the oldest one when all are pinned; returns it."""
+    if unpinned_devices:
+        address, device = unpinned_devices.popitem(last=False)
+        del ble_devices_array[address]
+    else:
+        # No pin rules (so nothing is pinned), or only pinned devices are left and the table bound wins
+        address, device = ble_devices_array.popitem(last=False)
+    _forget(device)
+    if device.pinned:
+        DEVICES_EVICTED_PINNED.inc()
+    else:
+        DEVICES_EVICTED_UNPINNED.inc()
+    return device
+
+def clear_devices():
+    """Empties the device table (benchmarks and tests)."""
+    global pinned_count
+    ble_devices_array.clear()
+    unpinned_devices.clear()
+    pinned_count = 0
+
+def table_stats():
+    """Returns the device table size, bound and eviction counters as a JSON-serializable dictionary."""
+    return {
+        "devices": len(ble_devices_array),
+        "max_devices": max_devices,
+        "pinned": pinned_count,
+        "evicted_stale": DEVICES_EVICTED.labels().value,
+        "evicted_unpinned": DEVICES_EVICTED_UNPINNED.value,
+        "evicted_pinned": DEVICES_EVICTED_PINNED.value,
+    }
+
+def filter_rssi():
+    """Runs the batch RSSI filter over the samples collected since the last call."""
+    if rssi_filter is None:
+        return 0
+    results = rssi_filter.run()
+    for device, rssi in results:
+        device.set_filtered_rssi(rssi)
+    return len(results)
+
+def aggregate_sensors():
+    """Publishes the report window's sensor aggregates into the devices and starts a new window."""
+    if sensor_aggregator is None:
+        return 0
+    results = sensor_aggregator.collect()
+    for device, readings, stats in results:
+        device.apply_aggregates(readings, stats)
+    return len(results)
 
 def get_recent_devices(max_second=60):
-    """Returns a sorted list of BLE devices seen within the last `max_second` seconds."""
-    current_time = int(datetime.now().timestamp())
-
-    return sorted(
-        [
-            device
-            for device in ble_devices_array.values()
-            if (current_time - device.last_seen) <= max_second
-        ],
-        key=lambda d: d.last_seen,
-        reverse=True,
-    )
+    """Returns a list of BLE devices seen within the last `max_second` seconds, most recent first."""
+    cutoff = int(datetime.now().timestamp()) - max_second
+    recent = []
+
+    for device in reversed(ble_devices_array.values()):
+        if device.last_seen < cutoff:
+            break
+        recent.append(device)
+
+    return recent
 
 def cleanup_old_devices(max_seconds=30):
     """Removes BLE devices that have not been seen in the last `max_seconds` seconds."""
-    current_time = int(datetime.now().timestamp())
-    devices_to_remove = []
-    
-    # ??????????????????????????????? max_seconds ???????????????
-    for addr, device in ble_devices_array.items():
-        if (current_time - device.last_seen) > max_seconds:
-            devices_to_remove.append(addr)
-    
-    # ????????????????????
-    for addr in devices_to_remove:
-        del ble_devices_array[addr]
-    
-    if devices_to_remove:
-        logging.info(f"scanner:: Removed {len(devices_to_remove)} stale BLE devices older than {max_seconds} seconds. Remaining: {len(ble_devices_array)}")
+    cutoff = int(datetime.now().timestamp()) - max_seconds
+    removed_count = 0
+
+    # The oldest devices are at the front; stop at the first one that is still fresh
+    while ble_devices_array:
+        oldest = next(iter(ble_devices_array.values()))
+        if oldest.last_seen >= cutoff:
+            break
+        ble_devices_array.popitem(last=False)
+        _forget(oldest)
+        removed_count += 1
+
+    if removed_count:
+        DEVICES_EVICTED.inc(removed_count)
+        logging.info(f"scanner:: Removed {removed_count} stale BLE devices older than {max_seconds} seconds. Remaining: {len(ble_devices_array)}")
         gc.collect()
-    
-    return len(devices_to_remove)
\ No newline at end of file
+
+    return removed_count
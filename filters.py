@@ -0,0 +1,160 @@
+import re
+
+import metrics
+
+# Ingress filtering at the top of the scan callback.
+#
+# Rules are compiled once into set lookups, so an unwanted advert is dropped
+# before it is queued, decoded or given a BLEDevice. Rules are checked in this order:
+#   min_rssi   adverts weaker than this are dropped
+#   deny       an advert matching any deny rule is dropped
+#   allow      when any allow rule is configured, only adverts matching at
+#              least one of them are kept
+# A rule set matches on address prefix, manufacturer company ID, service UUID
+# (advertised or carrying service data), iBeacon proximity UUID or a name
+# regular expression. Address prefixes are grouped by length: each length is one
+# slice and one set lookup, which covers what a prefix trie would for the handful
+# of OUI-style prefixes a deployment configures.
+
+BLUETOOTH_BASE_UUID = "0000{}-0000-1000-8000-00805f9b34fb"
+APPLE_COMPANY_ID = 76
+IBEACON_TYPE = b"\x02\x15"
+
+RULES = ("rssi", "address", "company", "service", "ibeacon", "name", "allowlist")
+
+FILTER_PASSED = metrics.counter("eazytrax_filter_passed_total", "Adverts that passed the ingress filter").labels()
+FILTER_DROPPED = metrics.counter("eazytrax_filter_dropped_total", "Adverts dropped by the ingress filter", labels=("rule",))
+
+
+def _items(value):
+    """Splits a comma-separated string (or passes through an iterable), skipping blanks."""
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item and item.strip()]
+
+
+def normalize_service_uuid(uuid):
+    """Expands 16/32-bit UUIDs onto the Bluetooth base UUID; lowercase like bleak reports them."""
+    uuid = uuid.lower()
+    if len(uuid) == 4:
+        return BLUETOOTH_BASE_UUID.format(uuid)
+    if len(uuid) == 8:
+        return f"{uuid}-0000-1000-8000-00805f9b34fb"
+    return uuid
+
+
+class AddressPrefixes:
+    """Address prefixes grouped by length; matches addresses with or without colons."""
+
+    def __init__(self, prefixes):
+        by_length = {}
+        for prefix in prefixes:
+            digits = prefix.replace(":", "").replace("-", "").upper()
+            # The same prefix written the way the scanner reports addresses (AA:BB:CC:...)
+            coloned = ":".join(digits[i:i + 2] for i in range(0, len(digits), 2))
+            for form in {digits, coloned}:
+                by_length.setdefault(len(form), set()).add(form)
+        self._lengths = tuple(sorted((length, frozenset(forms)) for length, forms in by_length.items()))
+
+    def __bool__(self):
+        return bool(self._lengths)
+
+    def match(self, address):
+        for length, forms in self._lengths:
+            if address[:length] in forms:
+                return True
+        return False
+
+
+class RuleSet:
+    """One allow or deny list."""
+
+    def __init__(self, addresses=(), companies=(), services=(), ibeacon_uuids=(), name=None):
+        self.addresses = AddressPrefixes(_items(addresses))
+        self.companies = frozenset(int(company, 0) for company in _items(companies))
+        self.services = frozenset(normalize_service_uuid(uuid) for uuid in _items(services))
+        self.ibeacon_uuids = frozenset(bytes.fromhex(uuid.replace("-", "")) for uuid in _items(ibeacon_uuids))
+        self.name = re.compile(name) if name else None
+
+    def __bool__(self):
+        return bool(self.addresses or self.companies or self.services or self.ibeacon_uuids or self.name)
+
+    def match(self, device, advertisement_data):
+        """Returns the name of the first rule the advert matches, or None."""
+        return self.match_fields(
+            device.address, device.name or advertisement_data.local_name, advertisement_data.manufacturer_data,
+            advertisement_data.service_data, advertisement_data.service_uuids,
+        )
+
+    def match_fields(self, address, name, manufacturer_data, service_data, service_uuids):
+        """match() for an advert already taken apart, e.g. from the ingest queue."""
+        if self.addresses and self.addresses.match(address):
+            return "address"
+        if self.companies and not self.companies.isdisjoint(manufacturer_data):
+            return "company"
+        if self.services and not (self.services.isdisjoint(service_uuids) and self.services.isdisjoint(service_data)):
+            return "service"
+        if self.ibeacon_uuids:
+            frame = manufacturer_data.get(APPLE_COMPANY_ID)
+            if frame is not None and frame[:2] == IBEACON_TYPE and bytes(frame[2:18]) in self.ibeacon_uuids:
+                return "ibeacon"
+        if self.name is not None and name and self.name.search(name):
+            return "name"
+        return None
+
+
+class AdvertFilter:
+    """Compiled ingress filter with per-rule drop counters."""
+
+    def __init__(self, min_rssi=None, allow=None, deny=None):
+        self.min_rssi = min_rssi
+        self.allow = allow if allow else None
+        self.deny = deny if deny else None
+        # The metric children are the counters; nothing is counted twice on the hot path
+        self._passed = FILTER_PASSED
+        self._dropped = {rule: FILTER_DROPPED.labels(rule) for rule in RULES}
+
+    @property
+    def active(self):
+        return self.min_rssi is not None or self.allow is not None or self.deny is not None
+
+    @property
+    def checked(self):
+        """Adverts checked so far, kept or dropped; read from the counters, so the hot path pays nothing."""
+        return self._passed.value + sum(counter.value for counter in self._dropped.values())
+
+    def check(self, device, advertisement_data):
+        """Returns None when the advert passes, else the rule that dropped it."""
+        if self.min_rssi is not None and advertisement_data.rssi < self.min_rssi:
+            return self._drop("rssi")
+        if self.deny is not None:
+            rule = self.deny.match(device, advertisement_data)
+            if rule is not None:
+                return self._drop(rule)
+        if self.allow is not None and self.allow.match(device, advertisement_data) is None:
+            return self._drop("allowlist")
+        self._passed.inc()
+        return None
+
+    def _drop(self, rule):
+        self._dropped[rule].inc()
+        return rule
+
+    def wrap(self, callback):
+        """Returns a scan callback that forwards only the adverts passing the filter."""
+        check = self.check
+
+        def filtered_callback(device, advertisement_data):
+            if check(device, advertisement_data) is None:
+                callback(device, advertisement_data)
+
+        return filtered_callback
+
+    def stats(self):
+        """Returns the filter counters as a JSON-serializable dictionary."""
+        dropped = {rule: counter.value for rule, counter in self._dropped.items() if counter.value}
+        return {
+            "passed": self._passed.value,
+            "dropped": sum(dropped.values()),
+            "dropped_by_rule": dropped,
+        }
@@ -0,0 +1,161 @@
+import math
+from array import array
+from collections import OrderedDict
+
+from ble_device import SENSOR_FIELDS
+
+# Short-term sensor history for local troubleshooting.
+#
+# Each device with sensor readings gets a fixed-size ring of samples taken at
+# most every `resolution` seconds: one preallocated array of timestamps plus one
+# preallocated array per sensor (NaN where the sensor had no value). History is
+# kept apart from the device table, so a device that drops out of
+# ble_devices_array keeps its history until `retention` seconds after its last
+# sample. At most `max_devices` histories are kept; the least recently sampled
+# device is dropped first.
+
+
+class DeviceHistory:
+    """Ring buffer of sensor samples for one device."""
+
+    __slots__ = ("times", "values", "index", "count", "last")
+
+    def __init__(self, capacity):
+        self.times = array("d", bytes(8 * capacity))
+        self.values = {}  # sensor -> array("d") of the same capacity
+        self.index = 0
+        self.count = 0
+        self.last = -math.inf
+
+    def append(self, timestamp, readings):
+        capacity = len(self.times)
+        index = self.index
+        self.times[index] = timestamp
+        for sensor, series in self.values.items():
+            series[index] = readings.pop(sensor, math.nan)
+        # Sensors seen for the first time get a NaN-filled series
+        for sensor, value in readings.items():
+            series = self.values[sensor] = array("d", [math.nan]) * capacity
+            series[index] = value
+        self.index = (index + 1) % capacity
+        self.count = min(self.count + 1, capacity)
+        self.last = timestamp
+
+    def snapshot(self):
+        """Returns copies of (times, {sensor: values}) for the filled part of the ring."""
+        count = self.count
+        times = self.times[:count]
+        return times, {sensor: series[:count] for sensor, series in list(self.values.items())}
+
+
+class SensorHistory:
+    """Sensor histories of all devices, keyed by address."""
+
+    def __init__(self, retention=600.0, resolution=5.0, max_devices=1000):
+        self.retention = retention
+        self.resolution = resolution
+        self.max_devices = max_devices
+        self.capacity = max(1, int(math.ceil(retention / resolution)))
+        self._devices = OrderedDict()  # address -> DeviceHistory, least recently sampled first
+        self.evicted = 0
+
+    def record(self, device, timestamp):
+        """Samples the device's current sensor values, at most once per `resolution` seconds."""
+        history = self._devices.get(device.address)
+        if history is not None and timestamp - history.last < self.resolution:
+            return
+
+        readings = {}
+        for field in SENSOR_FIELDS:
+            value = getattr(device, field)
+            if value is not None:
+                readings[field] = value
+        if device.extra_sensors:
+            for name, value in device.extra_sensors.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    readings[name] = value
+        if not readings:
+            return
+
+        if history is None:
+            history = self._devices[device.address] = DeviceHistory(self.capacity)
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._devices.move_to_end(device.address)
+        history.append(timestamp, readings)
+
+    def prune(self, now):
+        """Drops histories whose last sample is older than the retention period."""
+        cutoff = now - self.retention
+        removed = 0
+        while self._devices:
+            oldest = next(iter(self._devices.values()))
+            if oldest.last >= cutoff:
+                break
+            self._devices.popitem(last=False)
+            removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, address):
+        return address in self._devices
+
+    def query(self, address, now, window=None, buckets=60, sensors=None):
+        """
+        Downsamples the last `window` seconds of `address` into `buckets` equal buckets.
+        Returns {sensor: [{"start", "min", "max", "mean", "count"}, ...]}, or None for an unknown device.
+        Buckets without samples have count 0 and null values.
+        """
+        history = self._devices.get(address)
+        if history is None:
+            return None
+        window = self.retention if window is None else min(window, self.retention)
+        start = now - window
+        width = window / buckets
+
+        times, series = history.snapshot()
+        if sensors:
+            series = {sensor: values for sensor, values in series.items() if sensor in sensors}
+
+        result = {}
+        for sensor, values in series.items():
+            low = [math.inf] * buckets
+            high = [-math.inf] * buckets
+            total = [0.0] * buckets
+            count = [0] * buckets
+            for timestamp, value in zip(times, values):
+                if timestamp < start or value != value:  # outside the window, or NaN
+                    continue
+                bucket = min(int((timestamp - start) / width), buckets - 1)
+                if value < low[bucket]:
+                    low[bucket] = value
+                if value > high[bucket]:
+                    high[bucket] = value
+                total[bucket] += value
+                count[bucket] += 1
+            result[sensor] = [
+                {
+                    "start": round(start + i * width, 3),
+                    "min": low[i] if count[i] else None,
+                    "max": high[i] if count[i] else None,
+                    "mean": round(total[i] / count[i], 3) if count[i] else None,
+                    "count": count[i],
+                }
+                for i in range(buckets)
+            ]
+        return result
+
+    def stats(self):
+        """Returns the history counters as a JSON-serializable dictionary."""
+        return {
+            "devices": len(self._devices),
+            "max_devices": self.max_devices,
+            "capacity": self.capacity,
+            "resolution": self.resolution,
+            "retention": self.retention,
+            "evicted": self.evicted,
+        }
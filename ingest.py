@@ -0,0 +1,120 @@
+import time
+from collections import deque
+
+# Bounded ring buffer between the BleakScanner callback and device processing.
+#
+# The scan callback only appends raw advert tuples here; a consumer task on the
+# event loop drains them in batches, coalescing repeated adverts from the same
+# device so that decoding and BLEDevice updates run once per device per batch.
+# When the buffer is full the oldest advert is overwritten and counted as dropped.
+# With `keep_frames` set, the (manufacturer_data, service_data) of every advert is
+# also kept, so the sensor aggregation sees the frames coalescing would overwrite.
+
+# Index of each field in a queued advert tuple
+ADDRESS, NAME, RSSI, MANUFACTURER_DATA, SERVICE_DATA, SERVICE_UUIDS, TIMESTAMP = range(7)
+
+
+class IngestQueue:
+    """Fixed-size ring buffer of raw adverts with depth and drop counters."""
+
+    def __init__(self, maxlen=10000, keep_frames=False):
+        self.maxlen = maxlen
+        self.keep_frames = keep_frames
+        self._buffer = deque(maxlen=maxlen)
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    def push(self, address, name, rssi, manufacturer_data, service_data, service_uuids, timestamp=None):
+        """Queue one raw advert. Called from the scan callback, so keep it minimal."""
+        buffer = self._buffer
+        depth = len(buffer)
+        if depth == self.maxlen:
+            self.dropped += 1
+        elif depth >= self.max_depth:
+            self.max_depth = depth + 1
+        buffer.append((address, name, rssi, manufacturer_data, service_data, service_uuids,
+                       timestamp if timestamp is not None else time.time()))
+        self.received += 1
+
+    def on_advertisement(self, device, advertisement_data):
+        """Scanner callback: queues the advert with the colons stripped from the address."""
+        self.push(
+            device.address.replace(":", ""),
+            device.name,
+            advertisement_data.rssi,
+            advertisement_data.manufacturer_data,
+            advertisement_data.service_data,
+            advertisement_data.service_uuids,
+        )
+
+    def drain(self, max_items=None):
+        """
+        Pops up to `max_items` adverts and returns them coalesced per address:
+        {address: [name, rssi_samples, manufacturer_data, service_data, service_uuids, timestamp, sample_times, frames]}
+        Later adverts win for the name and for each manufacturer/service data key,
+        and the result is ordered by each address's most recent advert. `frames` is the
+        [(manufacturer_data, service_data), ...] of every advert with keep_frames, else None.
+        """
+        buffer = self._buffer
+        count = len(buffer) if max_items is None else min(max_items, len(buffer))
+        batch = {}
+        popleft = buffer.popleft
+        keep_frames = self.keep_frames
+
+        for _ in range(count):
+            advert = popleft()
+            entry = batch.get(advert[ADDRESS])
+            if entry is None:
+                batch[advert[ADDRESS]] = [
+                    advert[NAME],
+                    [advert[RSSI]],
+                    advert[MANUFACTURER_DATA],
+                    advert[SERVICE_DATA],
+                    advert[SERVICE_UUIDS],
+                    advert[TIMESTAMP],
+                    [advert[TIMESTAMP]],
+                    [(advert[MANUFACTURER_DATA], advert[SERVICE_DATA])] if keep_frames else None,
+                ]
+                continue
+
+            # Move to the end so the batch stays ordered by each device's last advert
+            del batch[advert[ADDRESS]]
+            batch[advert[ADDRESS]] = entry
+
+            # Merge into copies so the scanner's own dicts are never mutated
+            if advert[NAME]:
+                entry[0] = advert[NAME]
+            entry[1].append(advert[RSSI])
+            if advert[MANUFACTURER_DATA]:
+                entry[2] = {**entry[2], **advert[MANUFACTURER_DATA]}
+            if advert[SERVICE_DATA]:
+                entry[3] = {**entry[3], **advert[SERVICE_DATA]}
+            if advert[SERVICE_UUIDS] and advert[SERVICE_UUIDS] != entry[4]:
+                entry[4] = list(dict.fromkeys([*entry[4], *advert[SERVICE_UUIDS]]))
+            entry[5] = advert[TIMESTAMP]
+            entry[6].append(advert[TIMESTAMP])
+            if keep_frames:
+                entry[7].append((advert[MANUFACTURER_DATA], advert[SERVICE_DATA]))
+
+        if count:
+            self.batches += 1
+            self.coalesced += count - len(batch)
+        return batch
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def stats(self):
+        """Returns the queue counters as a JSON-serializable dictionary."""
+        return {
+            "depth": len(self._buffer),
+            "capacity": self.maxlen,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+        }
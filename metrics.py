@@ -0,0 +1,215 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+# Prometheus text-format metrics without a client library.
+#
+# Metrics are created once at import time and kept in a module-level registry.
+# Updating one is a plain attribute or list-slot increment: no locks, no label
+# lookups on the hot path (callers hold on to the child returned by labels()).
+# Increments made from paho's network thread or Flask threads can in theory
+# race with the event loop and lose a count, which is acceptable for telemetry.
+# Values that another component already counts (ingest queue, spool, device
+# table) are exported through a callback evaluated only when /metrics is scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; tuned for sub-millisecond decode and multi-second publish latencies
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+_registry = {}
+
+
+class Counter:
+    """Monotonically increasing value."""
+
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """Value that can go up and down."""
+
+    __slots__ = ("value",)
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and three increments."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+        yield f"{name}_bucket", labels + (("le", "+Inf"),), self.count
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class _Callback:
+    """Metric whose value is read from `function()` at scrape time."""
+
+    __slots__ = ("function",)
+
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self.function()
+
+
+class Family:
+    """A named metric, optionally split by label values."""
+
+    def __init__(self, name, help, metric_class, label_names=(), **kwargs):
+        self.name = name
+        self.help = help
+        self.kind = metric_class.kind
+        self.label_names = tuple(label_names)
+        self._metric_class = metric_class
+        self._kwargs = kwargs
+        self._children = {}
+        if not self.label_names:
+            self._children[()] = metric_class(**kwargs)
+
+    def labels(self, *values):
+        """Returns the child metric for `values`; keep the result rather than calling this per event."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}, got {values}")
+            child = self._children[values] = self._metric_class(**self._kwargs)
+        return child
+
+    def __getattr__(self, attribute):
+        # Unlabelled families forward inc()/set()/observe() to their only child
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        return getattr(self._children[()], attribute)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in list(self._children.items()):
+            labels = tuple(zip(self.label_names, values))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(f"{name}{_format_labels(sample_labels)} {_format_value(value)}")
+
+
+def _register(family):
+    if family.name in _registry:
+        raise ValueError(f"Metric {family.name} is already registered")
+    _registry[family.name] = family
+    return family
+
+
+def counter(name, help, labels=()):
+    return _register(Family(name, help, Counter, labels))
+
+
+def gauge(name, help, labels=()):
+    return _register(Family(name, help, Gauge, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Family(name, help, Histogram, labels, buckets=buckets))
+
+
+def callback(name, help, function, kind="gauge"):
+    """Exports `function()` (evaluated per scrape) as a counter or gauge."""
+    family = Family(name, help, Gauge)
+    family.kind = kind
+    family._children[()] = _Callback(function)
+    return _register(family)
+
+
+def unregister(name):
+    _registry.pop(name, None)
+
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for family in list(_registry.values()):
+        try:
+            family.render(lines)
+        except Exception as e:
+            lines.append(f"# {family.name} unavailable: {e}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value is None or value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+# ---------------------------------------------------------------------------
+# Event loop lag
+# ---------------------------------------------------------------------------
+
+EVENT_LOOP_LAG = histogram(
+    "eazytrax_event_loop_lag_seconds", "Delay between a scheduled wake-up and the event loop running it",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+EVENT_LOOP_LAG_LAST = gauge("eazytrax_event_loop_lag_last_seconds", "Most recently measured event loop lag")
+
+
+async def monitor_event_loop(interval=0.5):
+    """Samples event loop lag every `interval` seconds; a saturated loop wakes up late."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
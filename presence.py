@@ -0,0 +1,164 @@
+import math
+from collections import OrderedDict
+
+# On-gateway presence engine.
+#
+# Each evaluation estimates the distance of every device seen since the last one
+# from its smoothed RSSI (log-distance path loss, using the iBeacon's calibrated
+# rssi_1m when it has one) and maps it onto the configured zones. Transitions
+# are damped twice: a zone boundary must be crossed by `hysteresis` (a fraction
+# of the boundary distance) and the new zone must hold for `confirm` seconds.
+# Only transitions produce events:
+#   enter   device appeared in a zone
+#   move    device changed zone
+#   dwell   device has stayed in its zone for another `dwell_interval` seconds
+#   exit    device was not seen (or out of range) for `exit_timeout` seconds
+# Tracked devices are kept in last-seen order, so finding exits only touches
+# the devices that actually timed out.
+
+DEFAULT_ZONES = (("immediate", 0.5), ("near", 3.0), ("far", 10.0))
+
+
+def parse_zones(spec):
+    """Parses "name:max_distance,..." into ((name, max_distance), ...) sorted by distance."""
+    zones = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, distance = item.partition(":")
+        zones.append((name.strip(), float(distance)))
+    if not zones:
+        raise ValueError("At least one presence zone is required")
+    return tuple(sorted(zones, key=lambda zone: zone[1]))
+
+
+def estimate_distance(rssi, rssi_1m, path_loss=2.0):
+    """Distance in metres from the log-distance path loss model."""
+    return 10 ** ((rssi_1m - rssi) / (10.0 * path_loss))
+
+
+class PresenceState:
+    __slots__ = ("zone", "distance", "entered", "last_seen", "last_dwell", "candidate", "candidate_since")
+
+    def __init__(self, zone, distance, now):
+        self.zone = zone
+        self.distance = distance
+        self.entered = now
+        self.last_seen = now
+        self.last_dwell = now
+        self.candidate = None
+        self.candidate_since = None
+
+
+class PresenceEngine:
+    """Turns smoothed RSSI into zone enter/move/dwell/exit events."""
+
+    def __init__(self, zones=DEFAULT_ZONES, hysteresis=0.2, confirm=0.0, exit_timeout=30.0,
+                 dwell_interval=60.0, path_loss=2.0, default_rssi_1m=-59, ibeacon_only=True):
+        self.zones = tuple(zones)
+        self.hysteresis = hysteresis
+        self.confirm = confirm
+        self.exit_timeout = exit_timeout
+        self.dwell_interval = dwell_interval
+        self.path_loss = path_loss
+        self.default_rssi_1m = default_rssi_1m
+        self.ibeacon_only = ibeacon_only
+        self._index = {name: i for i, (name, _) in enumerate(self.zones)}
+        self._states = OrderedDict()  # address -> PresenceState, least recently seen first
+        self.events = 0
+
+    def _zone_for(self, distance, current):
+        """Zone for `distance`, keeping `current` until a boundary is crossed by the hysteresis margin."""
+        for i, (name, limit) in enumerate(self.zones):
+            if current is not None:
+                # Boundaries next to the current zone are widened, so small swings do not flip it
+                current_index = self._index[current]
+                if i < current_index:
+                    limit *= 1.0 - self.hysteresis
+                else:
+                    limit *= 1.0 + self.hysteresis
+            if distance <= limit:
+                return name
+        return None
+
+    def evaluate(self, devices, now):
+        """Updates presence from devices seen since the last call; returns the resulting events."""
+        events = []
+        states = self._states
+        for device in devices:
+            if device.rssi is None:
+                continue
+            rssi_1m = device.ibeacon_rssi_1m
+            if rssi_1m is None:
+                if self.ibeacon_only:
+                    continue
+                rssi_1m = self.default_rssi_1m
+            distance = estimate_distance(device.rssi, rssi_1m, self.path_loss)
+            state = states.get(device.address)
+            zone = self._zone_for(distance, state.zone if state else None)
+
+            if state is None:
+                if zone is not None:
+                    states[device.address] = PresenceState(zone, distance, now)
+                    events.append(self._event("enter", device.address, zone, None, distance, device.rssi, now, 0.0))
+                continue
+
+            if zone is None:
+                # Out of range counts as not seen, so the device exits after exit_timeout
+                continue
+            states.move_to_end(device.address)
+            state.last_seen = now
+            state.distance = distance
+            if zone == state.zone:
+                state.candidate = None
+            elif zone != state.candidate:
+                state.candidate, state.candidate_since = zone, now
+            if state.candidate is not None and now - state.candidate_since >= self.confirm:
+                previous = state.zone
+                events.append(self._event("move", device.address, state.candidate, previous, distance, device.rssi,
+                                          now, now - state.entered))
+                state.zone, state.entered, state.last_dwell = state.candidate, now, now
+                state.candidate = None
+            elif self.dwell_interval and now - state.last_dwell >= self.dwell_interval:
+                state.last_dwell = now
+                events.append(self._event("dwell", device.address, state.zone, None, distance, device.rssi,
+                                          now, now - state.entered))
+
+        # Devices not seen for exit_timeout have left; the oldest are at the front
+        cutoff = now - self.exit_timeout
+        while states:
+            address, state = next(iter(states.items()))
+            if state.last_seen >= cutoff:
+                break
+            states.popitem(last=False)
+            events.append(self._event("exit", address, state.zone, None, state.distance, None, now, now - state.entered))
+
+        self.events += len(events)
+        return events
+
+    def _event(self, kind, address, zone, previous, distance, rssi, now, dwell):
+        event = {
+            "event": kind,
+            "address": address,
+            "zone": zone,
+            "distance": round(distance, 2) if distance is not None and math.isfinite(distance) else None,
+            "dwell": int(dwell),
+            "time": int(now),
+        }
+        if previous is not None:
+            event["previous_zone"] = previous
+        if rssi is not None:
+            event["rssi"] = rssi
+        return event
+
+    def snapshot(self):
+        """Returns the current zone of every present device."""
+        return [
+            {"address": address, "zone": state.zone, "distance": round(state.distance, 2),
+             "since": int(state.entered), "last_seen": int(state.last_seen)}
+            for address, state in list(self._states.items())
+        ]
+
+    def __len__(self):
+        return len(self._states)
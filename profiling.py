@@ -0,0 +1,311 @@
+import gc
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# On-demand profiling of the running gateway.
+#
+# SamplingProfiler is a wall-clock sampler: a daemon thread wakes every
+# `interval` seconds, walks every other thread's stack via sys._current_frames()
+# and counts each distinct stack. The result is reported in collapsed-stack
+# form ("thread;outer;...;inner count"), ready for flamegraph.pl or speedscope.
+# Walking the stacks holds the GIL, so the sampler times itself and waits before
+# each sample until the time spent sampling so far, plus one more sample, stays
+# within `max_overhead` of the session.
+#
+# AllocationTracer runs tracemalloc for a while and reports the top allocation
+# sites by growth between its start and stop snapshots. tracemalloc slows every
+# allocation, so sessions are bounded in time and the tracer stops itself
+# early once its own bookkeeping exceeds `max_memory`.
+#
+# Both sessions also record garbage collector pauses, which is what the
+# per-cycle gc.collect() calls cost. A session stops by itself after its
+# duration, and only one session of each kind can run at a time.
+
+
+def _check_positive(name, value):
+    if not (math.isfinite(value) and value > 0):
+        raise ValueError(f"{name} must be a positive number")
+
+
+class GcMonitor:
+    """Counts collections and pause time per generation while installed."""
+
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.pause = [0.0, 0.0, 0.0]
+        self.max_pause = 0.0
+        self._started = None
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._started = time.perf_counter()
+        elif self._started is not None:
+            elapsed = time.perf_counter() - self._started
+            generation = info["generation"]
+            self.collections[generation] += 1
+            self.pause[generation] += elapsed
+            self.max_pause = max(self.max_pause, elapsed)
+            self._started = None
+
+    def install(self):
+        gc.callbacks.append(self._callback)
+
+    def remove(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def report(self):
+        return {
+            "collections": list(self.collections),
+            "pause_seconds": [round(pause, 6) for pause in self.pause],
+            "max_pause_seconds": round(self.max_pause, 6),
+        }
+
+
+class SamplingProfiler:
+    """Samples every thread's stack for a bounded time; one session at a time."""
+
+    def __init__(self, interval=0.005, max_overhead=0.02, max_seconds=60.0, max_depth=64, max_stacks=5000):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._labels = {}  # code object -> "function (file:line)"
+        self._reset()
+
+    def _reset(self):
+        self._labels.clear()
+        self.counts = {}
+        self.samples = 0
+        self.busy = 0.0
+        self.effective_interval = self.interval
+        self.started = None
+        self.stopped = None
+        self.truncated = 0
+        self.gc = GcMonitor()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=None):
+        """
+        Starts a session of at most max_seconds. Raises ValueError for a bad duration or
+        interval and RuntimeError if a session is already running.
+        """
+        _check_positive("seconds", seconds)
+        if interval is not None:
+            _check_positive("interval", interval)
+        with self._lock:
+            if self.running:
+                raise RuntimeError("A profiling session is already running")
+            self._reset()
+            if interval:
+                self.effective_interval = max(interval, 0.001)
+            self.duration = min(seconds, self.max_seconds)
+            self.started = time.time()
+            self._stop.clear()
+            self.gc.install()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the running session (if any) and returns its report."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.report()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        max_depth = self.max_depth
+        counts = self.counts
+        label = self._label
+        names = {}
+        session_started = time.perf_counter()
+        wait = self.effective_interval
+        try:
+            while not self._stop.wait(wait) and time.monotonic() < deadline:
+                started = time.perf_counter()
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    name = names.get(ident)
+                    if name is None:
+                        names = {thread.ident: thread.name for thread in threading.enumerate()}
+                        name = names.get(ident, str(ident))
+                    stack = []
+                    while frame is not None and len(stack) < max_depth:
+                        stack.append(label(frame.f_code))
+                        frame = frame.f_back
+                    frame = None  # do not keep another thread's frames alive between samples
+                    stack.append(name)
+                    stack.reverse()
+                    key = ";".join(stack)
+                    if key in counts:
+                        counts[key] += 1
+                    elif len(counts) < self.max_stacks:
+                        counts[key] = 1
+                    else:
+                        self.truncated += 1
+                cost = time.perf_counter() - started
+                self.busy += cost
+                self.samples += 1
+                # Overhead cap: sampling may take at most max_overhead of the wall clock
+                if cost > self.effective_interval * self.max_overhead:
+                    self.effective_interval = cost / self.max_overhead
+                # Over the whole session too: the first samples ran before their cost was known
+                elapsed = time.perf_counter() - session_started
+                wait = max(self.effective_interval, (self.busy + cost) / self.max_overhead - elapsed - cost)
+                wait = min(wait, max(0.0, deadline - time.monotonic()))
+        finally:
+            self.stopped = time.time()
+            self.gc.remove()
+
+    def collapsed(self):
+        """The session's stacks in collapsed form, most frequent first."""
+        counts = dict(self.counts)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+    def report(self, top=50):
+        end = self.stopped if self.stopped is not None else time.time()
+        elapsed = end - self.started if self.started else 0.0
+        counts = dict(self.counts)
+        return {
+            "running": self.running,
+            "started": self.started,
+            "seconds": round(elapsed, 3),
+            "samples": self.samples,
+            "interval": round(self.effective_interval, 6),
+            "overhead": round(self.busy / elapsed, 4) if elapsed else 0.0,
+            "distinct_stacks": len(counts),
+            "truncated_samples": self.truncated,
+            "gc": self.gc.report(),
+            "top": [
+                {"stack": stack, "samples": count}
+                for stack, count in sorted(counts.items(), key=lambda item: -item[1])[:top]
+            ],
+        }
+
+
+class AllocationTracer:
+    """tracemalloc session reporting the top allocation sites; one session at a time."""
+
+    def __init__(self, max_seconds=60.0, max_memory=64 * 1024 * 1024, max_frames=25):
+        self.max_seconds = max_seconds
+        self.max_memory = max_memory
+        self.max_frames = max_frames
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._before = None
+        self._summary = None
+        self._differences = ()
+        self.gc = GcMonitor()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, frames=1):
+        """
+        Starts tracing. Raises ValueError for a bad duration and RuntimeError when a session
+        (or anything else) is already tracing.
+        """
+        _check_positive("seconds", seconds)
+        with self._lock:
+            if self.running or tracemalloc.is_tracing():
+                raise RuntimeError("Allocation tracing is already running")
+            self.frames = max(1, min(frames, self.max_frames))
+            self.duration = min(seconds, self.max_seconds)
+            self.started = time.time()
+            self.stop_reason = None
+            self.gc = GcMonitor()
+            self.gc.install()
+            tracemalloc.start(self.frames)
+            self._before = tracemalloc.take_snapshot()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="alloc-tracer", daemon=True)
+            self._thread.start()
+
+    def stop(self, top=30):
+        """Stops the running session (if any) and returns its report."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.report(top)
+
+    def _run(self):
+        deadline = time.monotonic() + self.duration
+        reason = "duration"
+        while not self._stop.wait(0.5):
+            if time.monotonic() >= deadline:
+                break
+            if tracemalloc.get_tracemalloc_memory() > self.max_memory:
+                reason = "memory cap"
+                break
+        else:
+            reason = "stopped"
+        self.stop_reason = reason
+        self._finish()
+
+    def _finish(self):
+        try:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            overhead = tracemalloc.get_tracemalloc_memory()
+        finally:
+            tracemalloc.stop()
+            self.gc.remove()
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        before, after = self._before.filter_traces(ignore), after.filter_traces(ignore)
+        self._before = None
+        self._differences = after.compare_to(before, "traceback" if self.frames > 1 else "lineno")
+        self._summary = {
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "frames": self.frames,
+            "stop_reason": self.stop_reason,
+            "traced_bytes": current,
+            "peak_traced_bytes": peak,
+            "tracemalloc_overhead_bytes": overhead,
+            "gc": self.gc.report(),
+        }
+
+    def report(self, top=30):
+        if self.running:
+            return {"running": True, "started": self.started, "seconds": round(time.time() - self.started, 3)}
+        if self._thread is None:
+            return {"running": False}
+        differences = sorted(self._differences, key=lambda stat: -stat.size_diff)[:top]
+        return {
+            "running": False,
+            **self._summary,
+            "top": [
+                {
+                    "traceback": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                    "size": stat.size,
+                    "count": stat.count,
+                }
+                for stat in differences
+            ],
+        }
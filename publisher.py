@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import metrics
+
+# Asynchronous MQTT publish pipeline.
+#
+# Producers await submit(), which blocks once `queue_size` messages are waiting,
+# so a slow broker pushes back on the report task instead of piling up memory.
+# A single worker task hands messages to paho while at most `max_inflight` are
+# unacknowledged; paho's on_publish callback (called from its network thread
+# once a QoS 0 message is written or a QoS 1 PUBACK arrives) frees the slot and
+# records the publish latency. Messages that cannot be published, or are not
+# acknowledged within `ack_timeout` seconds, are passed to `on_failure`. A message
+# submitted with `on_delivered` reports its outcome there instead: True once it is
+# acknowledged, False when it failed or timed out.
+#
+# Messages that the next report supersedes (per-device retained state) use
+# submit_nowait() instead, which never waits. A message still queued for the
+# same topic is replaced in place, and when the queue is full the message is
+# dropped. A broker that stops acknowledging therefore cannot stall the report,
+# and with it the scanner.
+
+(_QUEUE_TOPIC, _QUEUE_PAYLOAD, _QUEUE_QOS, _QUEUE_RETAIN, _QUEUE_PROPERTIES, _QUEUE_FALLBACK,
+ _QUEUE_DELIVERED) = range(7)
+
+PUBLISH_LATENCY = metrics.histogram(
+    "eazytrax_mqtt_publish_latency_seconds", "Time from handing a message to paho until it is acknowledged",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+).labels()
+PUBLISH_BYTES = metrics.counter("eazytrax_mqtt_published_bytes_total", "Payload bytes handed to the broker connection").labels()
+PUBLISH_MESSAGES = metrics.counter("eazytrax_mqtt_published_messages_total", "Messages handed to the broker connection").labels()
+PUBLISH_FAILURES = metrics.counter(
+    "eazytrax_mqtt_publish_failures_total", "Messages that could not be published or were not acknowledged", labels=("reason",),
+)
+_FAILED_DISCONNECTED = PUBLISH_FAILURES.labels("disconnected")
+_FAILED_ERROR = PUBLISH_FAILURES.labels("error")
+_FAILED_TIMEOUT = PUBLISH_FAILURES.labels("timeout")
+PUBLISH_SUPERSEDED = metrics.counter(
+    "eazytrax_mqtt_publish_superseded_total", "Queued messages replaced by a newer one for the same topic",
+).labels()
+PUBLISH_DROPPED = metrics.counter(
+    "eazytrax_mqtt_publish_dropped_total", "Supersedable messages dropped because the publish queue was full",
+).labels()
+
+
+class MqttPublisher:
+    """Queue-fed publisher with a bounded in-flight window and delivery feedback."""
+
+    def __init__(self, qos=1, max_inflight=20, queue_size=200, ack_timeout=30.0, on_failure=None):
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self.on_failure = on_failure
+        self.client = None
+        self._queue = None
+        self._queue_size = queue_size
+        self._slots = None
+        self._loop = None
+        self._worker = None
+        self._pending = {}  # mid -> (publish time, message)
+        self._latest = {}  # topic -> newest message submitted with submit_nowait(); the queue holds the topic
+        self._latencies = deque(maxlen=1000)
+        self.submitted = 0
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.superseded = 0
+        self.dropped = 0
+
+    def attach(self, client):
+        """Uses `client` for publishing and routes its acknowledgements here."""
+        self.client = client
+        client.on_publish = self.on_publish
+
+    def start(self):
+        """Starts the worker task on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self._queue_size)
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._worker = asyncio.create_task(self._run())
+        return self._worker
+
+    async def submit(self, topic, payload, qos=None, retain=False, properties=None, fallback=False, on_delivered=None):
+        """
+        Queues one message, waiting while the queue is full.
+        With `fallback` set, the message is passed to on_failure if it cannot be delivered.
+        `on_delivered(ok)` is called on the event loop once the message is acknowledged or has failed.
+        """
+        await self._queue.put((topic, payload, self.qos if qos is None else qos, retain, properties, fallback, on_delivered))
+        self.submitted += 1
+
+    def submit_nowait(self, topic, payload, qos=None, retain=False, properties=None):
+        """
+        Queues a message that a later one for the same topic supersedes, without waiting.
+        Returns False when the queue was full and the message was dropped.
+        """
+        message = (topic, payload, self.qos if qos is None else qos, retain, properties, False, None)
+        if topic in self._latest:
+            self._latest[topic] = message
+            self.superseded += 1
+            PUBLISH_SUPERSEDED.inc()
+            return True
+        try:
+            self._queue.put_nowait(topic)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            PUBLISH_DROPPED.inc()
+            return False
+        self._latest[topic] = message
+        self.submitted += 1
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(self._queue.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                self._expire()  # Idle; still hand lost messages to on_failure promptly
+                continue
+            if isinstance(message, str):
+                # Queued by submit_nowait(); publish the newest message for the topic
+                message = self._latest.pop(message)
+
+            while True:
+                self._expire()
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), timeout=1.0)
+                    break
+                except asyncio.TimeoutError:
+                    continue  # Window still full; check for timed-out acks again
+
+            try:
+                client = self.client
+                if client is None or not client.is_connected():
+                    self._fail(message, _FAILED_DISCONNECTED)
+                    continue
+
+                sent_at = time.perf_counter()
+                info = client.publish(
+                    message[_QUEUE_TOPIC], message[_QUEUE_PAYLOAD], qos=message[_QUEUE_QOS],
+                    retain=message[_QUEUE_RETAIN], properties=message[_QUEUE_PROPERTIES],
+                )
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logging.error(f"mqtt:: Publish to {message[_QUEUE_TOPIC]} failed: {mqtt.error_string(info.rc)}")
+                    self._fail(message, _FAILED_ERROR)
+                    continue
+
+                self.published += 1
+                PUBLISH_MESSAGES.inc()
+                PUBLISH_BYTES.inc(len(message[_QUEUE_PAYLOAD]))
+                self._pending[info.mid] = (sent_at, message)
+            except Exception as e:
+                logging.error(f"mqtt:: Publish error: {e}")
+                self._fail(message, _FAILED_ERROR)
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        """paho callback; runs on the network thread, so hand the ack to the event loop."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._acknowledge, mid)
+
+    def _acknowledge(self, mid):
+        pending = self._pending.pop(mid, None)
+        if pending is None:
+            return  # Already timed out
+        latency = time.perf_counter() - pending[0]
+        self._latencies.append(latency)
+        PUBLISH_LATENCY.observe(latency)
+        self.acked += 1
+        self._slots.release()
+        self._notify(pending[1], True)
+
+    def _fail(self, message, reason):
+        self.failed += 1
+        reason.inc()
+        self._slots.release()
+        self._notify(message, False)
+        if message[_QUEUE_FALLBACK] and self.on_failure is not None:
+            try:
+                self.on_failure(message[_QUEUE_TOPIC], message[_QUEUE_PAYLOAD], message[_QUEUE_QOS], message[_QUEUE_RETAIN])
+            except Exception as e:
+                logging.error(f"mqtt:: Failure handler error: {e}")
+
+    def _notify(self, message, delivered):
+        if message[_QUEUE_DELIVERED] is None:
+            return
+        try:
+            message[_QUEUE_DELIVERED](delivered)
+        except Exception as e:
+            logging.error(f"mqtt:: Delivery callback error: {e}")
+
+    def _expire(self):
+        # Unacknowledged messages (e.g. lost with a dropped connection) must not hold slots forever
+        if not self._pending:
+            return
+        deadline = time.perf_counter() - self.ack_timeout
+        expired = [mid for mid, (sent_at, _) in self._pending.items() if sent_at < deadline]
+        for mid in expired:
+            _, message = self._pending.pop(mid)
+            self.timed_out += 1
+            self._fail(message, _FAILED_TIMEOUT)
+
+    def latency_percentiles(self, percentiles=(50, 95, 99)):
+        """Returns {"p50": seconds, ...} over the most recent acknowledged publishes."""
+        samples = sorted(self._latencies)
+        if not samples:
+            return {f"p{p}": None for p in percentiles}
+        return {f"p{p}": samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in percentiles}
+
+    def stats(self):
+        """Returns the publisher counters as a JSON-serializable dictionary."""
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "inflight": len(self._pending),
+            "submitted": self.submitted,
+            "published": self.published,
+            "acked": self.acked,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "latency": {k: round(v * 1000, 2) if v is not None else None
+                        for k, v in self.latency_percentiles().items()},
+        }
@@ -0,0 +1,128 @@
+import os
+import platform
+import time
+import logging
+import threading
+
+import netifaces
+
+import hostname
+from device_info import get_device_info
+
+# Cached "reporter" block of the gateway telemetry payload.
+#
+# Hardware details and boot time cannot change while the process runs, so they
+# are read once. Hostname and network details are refreshed every
+# REPORTER_NETWORK_TTL seconds, or immediately after invalidate() (called when
+# the hostname is changed through the API). The block itself is pre-built, so a
+# report only copies it and fills in the time and publish count.
+
+SW_VERSION = "1.0.50"
+NETWORK_TTL = float(os.getenv("REPORTER_NETWORK_TTL", 60))  # seconds
+
+_static_info = None
+_reporter_base = None
+_network_info = (None, None, None)
+_network_expires = 0.0
+_lock = threading.Lock()
+
+
+def get_active_interface():
+    """
+    Detects the active network interface (Wi-Fi prioritized on Linux).
+    Returns (interface_name, ip_address, mac_address)
+    """
+    system = platform.system().lower()
+
+    def get_ip_mac(interface):
+        try:
+            addresses = netifaces.ifaddresses(interface)
+            ip = addresses.get(netifaces.AF_INET, [{}])[0].get("addr")
+            mac = addresses.get(netifaces.AF_LINK, [{}])[0].get("addr")
+            return ip, mac
+        except (KeyError, IndexError, ValueError):
+            return None, None
+
+    interfaces = netifaces.interfaces()
+
+    # First pass: prioritize wlan* on Linux
+    if system == "linux":
+        for iface in interfaces:
+            if iface.startswith("wlan"):
+                ip, mac = get_ip_mac(iface)
+                if ip and mac:
+                    return iface, ip, mac
+
+    # Second pass: accept any interface with valid IP/MAC
+    for iface in interfaces:
+        ip, mac = get_ip_mac(iface)
+        if ip and mac:
+            return iface, ip, mac
+
+    return None, None, None
+
+
+def get_static_info():
+    """Returns the hardware details that never change while the gateway runs."""
+    global _static_info
+    if _static_info is None:
+        import psutil  # only needed once, for the first report
+
+        device_info = get_device_info()
+        _static_info = {
+            "hw_type": f"{device_info['Hardware']} {device_info['Model']}",
+            "revision": device_info["Revision"],
+            "model": device_info["Model"],
+            "sw_version": SW_VERSION,
+            "uptime": int(psutil.boot_time()),
+        }
+    return _static_info
+
+
+def get_network_info():
+    """Returns the cached (interface, ip, mac), refreshing it when the TTL has passed."""
+    _refresh()
+    return _network_info
+
+
+def invalidate():
+    """Forces the hostname and network details to be re-read on the next report."""
+    global _network_expires
+    _network_expires = 0.0
+
+
+def build_reporter(publish_count):
+    """Returns the reporter block for one payload."""
+    _refresh()
+    reporter = dict(_reporter_base)
+    reporter["time"] = int(time.time())
+    reporter["publish_count"] = publish_count
+    return reporter
+
+
+def _refresh():
+    global _reporter_base, _network_info, _network_expires
+    if time.monotonic() < _network_expires:
+        return
+
+    with _lock:
+        if time.monotonic() < _network_expires:
+            return
+
+        static_info = get_static_info()
+        interface, ip, mac = get_active_interface()
+        _network_info = (interface, ip, mac)
+        _reporter_base = {
+            "name": hostname.get_current_hostname(),
+            "mac": mac if mac else "N/A",
+            "hw_type": static_info["hw_type"],
+            "revision": static_info["revision"],
+            "model": static_info["model"],
+            "sw_version": static_info["sw_version"],
+            "ipv4": ip if ip else "N/A",
+            "uptime": static_info["uptime"],
+            "time": None,
+            "publish_count": None,
+        }
+        _network_expires = time.monotonic() + NETWORK_TTL
+        logging.debug(f"reporter:: Refreshed network details: {interface} {ip} {mac}")
@@ -0,0 +1,267 @@
+import importlib.util
+import math
+from array import array
+
+# NumPy is optional; the pure-Python path gives the same results, only slower.
+# It is only looked up here and imported by the first run(), so it does not delay startup.
+HAVE_NUMPY = importlib.util.find_spec("numpy") is not None
+np = None
+
+
+def _import_numpy():
+    global np
+    try:
+        import numpy
+    except ImportError:
+        return False
+    np = numpy
+    return True
+
+# Batch RSSI filtering.
+#
+# Instead of smoothing every advert as it arrives, raw (rssi, time) samples are
+# appended to flat array buffers tagged with the device's slot, and all devices
+# are filtered together once per report. Filter state lives in per-slot arrays;
+# a slot is taken when a device is first seen and released when it is expired.
+#
+# All filters use the sample timestamps, so the result does not depend on how
+# often a device advertises:
+#   ema     exponential moving average with time constant `tau` seconds:
+#           each sample moves the value by 1 - exp(-dt / tau)
+#   kalman  1-D random-walk Kalman filter; the process noise grows with dt
+#   median  median of the device's samples from the last `window` seconds; the
+#           samples still inside the window are carried over to the next run(),
+#           so the median does not depend on how often run() is called
+
+FILTERS = ("ema", "kalman", "median")
+
+
+class RssiFilterBank:
+    """Filter state for every tracked device, indexed by slot."""
+
+    def __init__(self, kind="ema", tau=1.0, process_noise=1.0, measurement_noise=16.0, window=5.0,
+                 capacity=1024, use_numpy=True):
+        if kind not in FILTERS:
+            raise ValueError(f"Unknown RSSI filter '{kind}' (expected one of {', '.join(FILTERS)})")
+        self.kind = kind
+        self.tau = tau
+        self.process_noise = process_noise  # dBm^2 per second
+        self.measurement_noise = measurement_noise  # dBm^2
+        self.window = window
+        self.use_numpy = use_numpy and HAVE_NUMPY
+        self._owners = []  # slot -> device (None when free)
+        self._free = []
+        self._released = []  # freed slots that may still have pending samples; reusable after run()
+        self._value = array("d")  # filtered RSSI, NaN until the first sample
+        self._variance = array("d")  # Kalman estimate variance
+        self._time = array("d")  # time of the last sample folded into the state
+        self._reserve(capacity)
+        self._clear_pending()
+        # Median filter: earlier samples still inside `window`, in arrival order
+        self._window_slot = array("q")
+        self._window_rssi = array("d")
+        self._window_time = array("d")
+
+    def _reserve(self, count):
+        start = len(self._owners)
+        self._owners.extend([None] * count)
+        self._value.extend([math.nan] * count)
+        self._variance.extend([0.0] * count)
+        self._time.extend([0.0] * count)
+        self._free.extend(range(start + count - 1, start - 1, -1))
+
+    def _clear_pending(self):
+        self._pending_slot = array("q")
+        self._pending_rssi = array("d")
+        self._pending_time = array("d")
+
+    def acquire(self, owner):
+        """Returns a free slot for `owner` (its results are reported against it)."""
+        if not self._free:
+            self._reserve(len(self._owners))
+        slot = self._free.pop()
+        self._owners[slot] = owner
+        self._value[slot] = math.nan
+        self._variance[slot] = 0.0
+        self._time[slot] = 0.0
+        return slot
+
+    def release(self, slot):
+        """Frees a slot; samples for it that are still pending are ignored."""
+        if slot is not None and self._owners[slot] is not None:
+            self._owners[slot] = None
+            # Reusing the slot before run() would hand its pending samples to the next owner
+            self._released.append(slot)
+
+    def add_samples(self, slot, rssi_samples, sample_times):
+        """Queues raw samples (oldest first) for the next run()."""
+        self._pending_slot.extend([slot] * len(rssi_samples))
+        self._pending_rssi.extend(rssi_samples)
+        self._pending_time.extend(sample_times)
+
+    def pending(self):
+        return len(self._pending_slot)
+
+    def run(self):
+        """Folds all pending samples into the filter state; returns [(owner, filtered rssi), ...]."""
+        if self._released:
+            if self._window_slot:
+                self._drop_window(set(self._released))
+            self._free.extend(self._released)
+            self._released = []
+        if not self._pending_slot:
+            return []
+        slots, rssi, times = self._pending_slot, self._pending_rssi, self._pending_time
+        self._clear_pending()
+        carried = 0
+        if self.kind == "median":
+            # The carried-over samples go first, so each device's samples stay in arrival order
+            carried = len(self._window_slot)
+            slots, rssi, times = self._window_slot + slots, self._window_rssi + rssi, self._window_time + times
+        if self.use_numpy and np is None:
+            self.use_numpy = _import_numpy()
+        if self.use_numpy:
+            updated = self._run_numpy(slots, rssi, times, carried)
+        else:
+            updated = self._run_python(slots, rssi, times, carried)
+
+        owners, value = self._owners, self._value
+        return [(owners[slot], value[slot]) for slot in updated if owners[slot] is not None]
+
+    def _drop_window(self, slots):
+        """Forgets the carried-over median samples of `slots`, so a reused slot starts empty."""
+        keep = [i for i, slot in enumerate(self._window_slot) if slot not in slots]
+        self._window_slot = array("q", [self._window_slot[i] for i in keep])
+        self._window_rssi = array("d", [self._window_rssi[i] for i in keep])
+        self._window_time = array("d", [self._window_time[i] for i in keep])
+
+    # -----------------------------------------------------------------------
+    # NumPy: every device at once
+    # -----------------------------------------------------------------------
+
+    def _run_numpy(self, slots, rssi, times, carried=0):
+        slots = np.frombuffer(slots, dtype=np.int64)
+        order = np.argsort(slots, kind="stable")  # stable keeps each device's samples in arrival order
+        slots = slots[order]
+        rssi = np.frombuffer(rssi, dtype=np.float64)[order]
+        times = np.frombuffer(times, dtype=np.float64)[order]
+
+        first = np.empty(len(slots), dtype=bool)
+        first[0] = True
+        np.not_equal(slots[1:], slots[:-1], out=first[1:])
+        starts = np.flatnonzero(first)
+        ends = np.r_[starts[1:], len(slots)] - 1
+        group = np.cumsum(first) - 1
+        unique = slots[starts]
+
+        value = np.frombuffer(self._value, dtype=np.float64)
+        variance = np.frombuffer(self._variance, dtype=np.float64)
+        state_time = np.frombuffer(self._time, dtype=np.float64)
+
+        if self.kind == "median":
+            fresh = np.bincount(group, weights=order >= carried) > 0  # devices with samples since the last run
+            self._median_numpy(slots, rssi, times, group, ends, unique, value)
+            state_time[unique] = times[ends]
+            return unique[fresh].tolist()
+        else:
+            # Time since the previous sample of the same device (NaN for a device's very first sample)
+            previous = np.empty(len(times))
+            previous[1:] = times[:-1]
+            previous[starts] = np.where(np.isnan(value[unique]), np.nan, state_time[unique])
+            dt = np.maximum(times - previous, 0.0)
+            if self.kind == "ema":
+                self._ema_numpy(rssi, times, dt, previous[starts], group, ends, unique, value)
+            else:
+                self._kalman_numpy(rssi, dt, group, starts, unique, value, variance)
+        state_time[unique] = times[ends]
+        return unique.tolist()
+
+    def _ema_numpy(self, rssi, times, dt, state_time, group, ends, unique, value):
+        # Closed form of the sequential update x += (1 - exp(-dt / tau)) * (r - x) over each device's samples:
+        # every sample, and the previous state, decays by exp(-(t_last - t) / tau) by the end of the batch
+        alpha = np.where(np.isnan(dt), 1.0, -np.expm1(-np.nan_to_num(dt) / self.tau))
+        end = times[ends]
+        decay = np.exp(-np.maximum(end[group] - times, 0.0) / self.tau)
+        weighted = np.bincount(group, weights=alpha * decay * rssi)
+        # Devices without a previous state (NaN) start from their first sample, which gets alpha = 1
+        previous = value[unique]
+        since = np.maximum(np.nan_to_num(end - state_time), 0.0)
+        carried = np.where(np.isnan(previous), 0.0, np.nan_to_num(previous) * np.exp(-since / self.tau))
+        value[unique] = weighted + carried
+
+    def _kalman_numpy(self, rssi, dt, group, starts, unique, value, variance):
+        # Sequential in time, vectorized across devices: round k updates every device's k-th sample
+        rank = np.arange(len(rssi)) - starts[group]
+        by_rank = np.argsort(rank, kind="stable")
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2))
+        x = value[unique].copy()
+        p = variance[unique].copy()
+        for k in range(len(bounds) - 1):
+            index = by_rank[bounds[k]:bounds[k + 1]]
+            g = group[index]
+            z = rssi[index]
+            fresh = np.isnan(x[g])
+            predicted = p[g] + self.process_noise * np.nan_to_num(dt[index])
+            gain = predicted / (predicted + self.measurement_noise)
+            x[g] = np.where(fresh, z, x[g] + gain * (z - x[g]))
+            p[g] = np.where(fresh, self.measurement_noise, (1.0 - gain) * predicted)
+        value[unique] = x
+        variance[unique] = p
+
+    def _median_numpy(self, slots, rssi, times, group, ends, unique, value):
+        recent = times >= times[ends][group] - self.window
+        # Carried over to the next run, in arrival order per device
+        self._window_slot = array("q", slots[recent].tobytes())
+        self._window_rssi = array("d", rssi[recent].tobytes())
+        self._window_time = array("d", times[recent].tobytes())
+
+        rssi, group = rssi[recent], group[recent]
+        order = np.lexsort((rssi, group))
+        ordered = rssi[order]
+        counts = np.bincount(group, minlength=len(unique))
+        begin = np.r_[0, np.cumsum(counts)[:-1]]
+        value[unique] = (ordered[begin + (counts - 1) // 2] + ordered[begin + counts // 2]) / 2.0
+
+    # -----------------------------------------------------------------------
+    # Pure Python fallback: the same filters, one device at a time
+    # -----------------------------------------------------------------------
+
+    def _run_python(self, slots, rssi, times, carried=0):
+        fresh = set(slots[carried:]) if carried else None  # devices with samples since the last run
+        samples = {}
+        for slot, r, t in zip(slots, rssi, times):
+            entry = samples.get(slot)
+            if entry is None:
+                samples[slot] = [(r, t)]
+            else:
+                entry.append((r, t))
+
+        value, variance, state_time = self._value, self._variance, self._time
+        if self.kind == "median":
+            self._window_slot, self._window_rssi, self._window_time = array("q"), array("d"), array("d")
+        for slot, entry in samples.items():
+            if self.kind == "median":
+                latest = entry[-1][1]
+                window = [(r, t) for r, t in entry if t >= latest - self.window]
+                # Carried over to the next run
+                self._window_slot.extend([slot] * len(window))
+                self._window_rssi.extend(r for r, _ in window)
+                self._window_time.extend(t for _, t in window)
+                recent = sorted(r for r, _ in window)
+                value[slot] = (recent[(len(recent) - 1) // 2] + recent[len(recent) // 2]) / 2.0
+            else:
+                x, p, last = value[slot], variance[slot], state_time[slot]
+                for r, t in entry:
+                    if math.isnan(x):
+                        x, p = r, self.measurement_noise
+                    elif self.kind == "ema":
+                        x += -math.expm1(-max(t - last, 0.0) / self.tau) * (r - x)
+                    else:
+                        predicted = p + self.process_noise * max(t - last, 0.0)
+                        gain = predicted / (predicted + self.measurement_noise)
+                        x += gain * (r - x)
+                        p = (1.0 - gain) * predicted
+                    last = t
+                value[slot], variance[slot] = x, p
+            state_time[slot] = entry[-1][1]
+        return list(samples) if fresh is None else [slot for slot in samples if slot in fresh]
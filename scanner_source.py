@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import random
+import struct
+import time
+from collections import namedtuple
+
+# Pluggable advertisement sources for scan_ble_devices().
+#
+# Every source is constructed with the scan callback and exposes the part of
+# the BleakScanner interface the gateway uses: `await start()` / `await stop()`.
+# SCANNER_BACKEND=bleak wraps BleakScanner; SCANNER_BACKEND=fake replays a
+# generated or recorded advert stream through the same callback at a fixed rate,
+# so the scan path can be run and benchmarked without a Bluetooth adapter.
+#
+# Recordings are JSON lines, one advert per line:
+#   {"t": 0.125, "address": "AA:BB:CC:DD:EE:FF", "name": null, "rssi": -61,
+#    "manufacturer_data": {"76": "0215..."}, "service_data": {"<uuid>": "a101..."},
+#    "service_uuids": ["<uuid>"]}
+# `t` is the offset in seconds from the start of the recording.
+
+# Stand-ins for bleak's BLEDevice and AdvertisementData, with the fields the callback reads
+FakeDevice = namedtuple("FakeDevice", ("address", "name"))
+FakeAdvertisement = namedtuple(
+    "FakeAdvertisement", ("local_name", "rssi", "manufacturer_data", "service_data", "service_uuids", "tx_power")
+)
+
+FFE1_SERVICE_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+PHONE_SERVICE_UUIDS = ["0000fe9f-0000-1000-8000-00805f9b34fb", "0000fd6f-0000-1000-8000-00805f9b34fb"]
+IBEACON_UUIDS = [bytes.fromhex("e2c56db5dffb48d2b060d0f5a71096e0"), bytes.fromhex("f7826da64fa24e988024bc5b71e0893e")]
+
+# Generated device mix: (kind, share of devices)
+DEVICE_MIX = (("ibeacon", 0.35), ("ca05", 0.15), ("ca00", 0.10), ("a101", 0.15), ("a701", 0.10), ("phone", 0.15))
+
+_IBEACON = struct.Struct(">2s16sHHb")
+_CA05 = struct.Struct(">2s3xhH")
+_CA00 = struct.Struct(">2s6xB")
+_A101 = struct.Struct(">2sBhH")
+_A701 = struct.Struct(">2sHHHHHbBBB")
+
+
+def _address(index):
+    return ":".join(f"{(index >> shift) & 0xFF:02X}" for shift in (40, 32, 24, 16, 8, 0))
+
+
+def _frame(kind, rng, index):
+    """Returns (name, manufacturer_data, service_data, service_uuids) for one advert."""
+    if kind == "ibeacon":
+        frame = _IBEACON.pack(b"\x02\x15", IBEACON_UUIDS[index % len(IBEACON_UUIDS)], index // 1000, index % 1000, -59)
+        return None, {76: frame}, {}, []
+    if kind == "ca05":
+        temperature = int(rng.uniform(18, 30) * 256)
+        humidity = int(rng.uniform(30, 70) * 256)
+        return f"ETX-{index % 1000}", {1593: _CA05.pack(b"\xca\x05", temperature, humidity)}, {}, []
+    if kind == "ca00":
+        return f"ETX-{index % 1000}", {1593: _CA00.pack(b"\xca\x00", rng.randint(20, 100))}, {}, []
+    if kind == "a101":
+        frame = _A101.pack(b"\xa1\x01", rng.randint(20, 100), int(rng.uniform(18, 30) * 256), int(rng.uniform(30, 70) * 256))
+        return None, {}, {FFE1_SERVICE_UUID: frame}, [FFE1_SERVICE_UUID]
+    if kind == "a701":
+        frame = _A701.pack(
+            b"\xa7\x01", rng.randint(400, 1500), rng.randint(0, 100), rng.randint(0, 500), rng.randint(0, 80),
+            rng.randint(0, 120), rng.randint(18, 30), rng.randint(0, 99), rng.randint(30, 70), rng.randint(0, 99),
+        )
+        return None, {}, {FFE1_SERVICE_UUID: frame}, [FFE1_SERVICE_UUID]
+    return None, {6: rng.randbytes(10)}, {}, list(PHONE_SERVICE_UUIDS)
+
+
+def generate_adverts(device_count=500, variants=4, seed=0):
+    """
+    Builds a pool of `device_count * variants` (FakeDevice, FakeAdvertisement) pairs covering
+    iBeacon, company 1593 ca05/ca00, ffe1 a101/a701 and phone-style adverts.
+    Each device gets `variants` frames with different readings and RSSI values.
+    """
+    rng = random.Random(seed)
+    kinds = []
+    for kind, share in DEVICE_MIX:
+        kinds += [kind] * max(1, round(device_count * share))
+    kinds = kinds[:device_count]
+    kinds += ["phone"] * (device_count - len(kinds))
+
+    pool = []
+    for variant in range(variants):
+        for index, kind in enumerate(kinds):
+            name, manufacturer_data, service_data, service_uuids = _frame(kind, rng, index)
+            pool.append((
+                FakeDevice(_address(index), name),
+                FakeAdvertisement(name, rng.randint(-95, -40), manufacturer_data, service_data, service_uuids, None),
+            ))
+    return pool
+
+
+def load_recording(path):
+    """Reads a JSON lines recording into a list of (offset, FakeDevice, FakeAdvertisement)."""
+    adverts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            manufacturer_data = {int(key): bytes.fromhex(value) for key, value in record.get("manufacturer_data", {}).items()}
+            service_data = {key: bytes.fromhex(value) for key, value in record.get("service_data", {}).items()}
+            adverts.append((
+                float(record.get("t", 0.0)),
+                FakeDevice(record["address"], record.get("name")),
+                FakeAdvertisement(record.get("name"), record["rssi"], manufacturer_data, service_data,
+                                  record.get("service_uuids", []), record.get("tx_power")),
+            ))
+    adverts.sort(key=lambda advert: advert[0])
+    return adverts
+
+
+def record_advert(file, offset, device, advertisement_data):
+    """Appends one advert to an open recording file."""
+    file.write(json.dumps({
+        "t": round(offset, 4),
+        "address": device.address,
+        "name": device.name,
+        "rssi": advertisement_data.rssi,
+        "manufacturer_data": {str(key): bytes(value).hex() for key, value in advertisement_data.manufacturer_data.items()},
+        "service_data": {key: bytes(value).hex() for key, value in advertisement_data.service_data.items()},
+        "service_uuids": list(advertisement_data.service_uuids),
+    }) + "\n")
+
+
+class FakeScanner:
+    """
+    Replays adverts through `callback` on the event loop, cycling through the pool at
+    `rate` adverts per second. With `rate` 0 a recording keeps its own timing instead
+    (scaled by `speed`). Either way the stream loops from the start when exhausted.
+    """
+
+    def __init__(self, callback, rate=1000.0, device_count=500, recording=None, speed=1.0, seed=0, tick=0.01):
+        self.callback = callback
+        self.rate = rate
+        self.speed = speed
+        self.tick = tick
+        self.emitted = 0
+        self._task = None
+        if recording:
+            self._recording = load_recording(recording)
+            self._pool = [(device, advertisement) for _, device, advertisement in self._recording]
+            logging.info(f"scanner:: Replaying {len(self._pool)} recorded adverts from {recording}")
+        else:
+            self._recording = None
+            self._pool = generate_adverts(device_count, seed=seed)
+        if not self._pool:
+            raise ValueError("FakeScanner has no adverts to replay")
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_recording() if self._recording and not self.rate else self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        # Emit whatever the elapsed time allows, so the rate holds even when a tick runs late
+        pool, callback = self._pool, self.callback
+        position = self.emitted % len(pool)
+        started = time.perf_counter()
+        budget = 0
+        while True:
+            await asyncio.sleep(self.tick)
+            due = int((time.perf_counter() - started) * self.rate) - budget
+            budget += due
+            for _ in range(due):
+                device, advertisement = pool[position]
+                callback(device, advertisement)
+                position += 1
+                if position == len(pool):
+                    position = 0
+            self.emitted += due
+
+    async def _run_recording(self):
+        recording, callback = self._recording, self.callback
+        duration = recording[-1][0] + self.tick
+        while True:
+            started = time.perf_counter()
+            for offset, device, advertisement in recording:
+                delay = offset / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                callback(device, advertisement)
+                self.emitted += 1
+            await asyncio.sleep(max(0.0, duration / self.speed - (time.perf_counter() - started)))
+
+
+class RecordingScanner:
+    """Wraps another source and appends every advert it delivers to a JSON lines file."""
+
+    def __init__(self, create_source, callback, path):
+        self._file = open(path, "a", encoding="utf-8")
+        self._started = time.monotonic()
+
+        def recording_callback(device, advertisement_data):
+            try:
+                record_advert(self._file, time.monotonic() - self._started, device, advertisement_data)
+            except Exception as e:
+                logging.error(f"scanner:: Could not record advert: {e}")
+            callback(device, advertisement_data)
+
+        self._source = create_source(recording_callback)
+
+    async def start(self):
+        await self._source.start()
+
+    async def stop(self):
+        await self._source.stop()
+        self._file.flush()
+
+
+def create_scanner(callback, backend="bleak", rate=1000.0, device_count=500, recording=None, speed=1.0, record_path=None):
+    """Returns the advert source selected by SCANNER_BACKEND (`bleak` or `fake`)."""
+    if backend == "fake":
+        create = lambda cb: FakeScanner(cb, rate=rate, device_count=device_count, recording=recording, speed=speed)
+    elif backend == "bleak":
+        from bleak import BleakScanner
+        create = BleakScanner
+    else:
+        raise ValueError(f"Unknown scanner backend '{backend}' (expected bleak or fake)")
+
+    if record_path:
+        return RecordingScanner(create, callback, record_path)
+    return create(callback)
@@ -0,0 +1,54 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+# Serialize-once report snapshots.
+#
+# Every report cycle turns each recent device into its to_json() dict once and
+# each dict into JSON text once. The same text is used for the device's own
+# retained topic and, joined, for the gateway payload, which is byte-for-byte
+# what json.dumps(payload) would produce. The result is kept as an immutable
+# Snapshot that /api serves until the next cycle: with an ETag so pollers that
+# already have it get a 304, and gzip-compressed at most once per snapshot.
+
+
+class Snapshot:
+    """One report cycle's gateway payload and per-device messages, already serialized."""
+
+    def __init__(self, cycle, payload, body, device_messages):
+        self.cycle = cycle
+        self.created = time.time()
+        self.payload = payload  # the gateway payload dict; treat as read-only
+        self.body = body  # payload as JSON bytes
+        self.device_messages = device_messages  # address -> JSON text of device.to_json()
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self._gzip = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, cycle, payload, records):
+        """
+        Serializes `records` ([(device, device.to_json()), ...], most recent first) and the
+        gateway payload, whose "reported" list must be the leading records' dicts.
+        Runs off the event loop; nothing here touches the devices themselves.
+        """
+        messages = [json.dumps(record) for _, record in records]
+        reported = len(payload["reported"])
+        head = json.dumps({key: value for key, value in payload.items() if key != "reported"})
+        items = ", ".join(messages[:reported])
+        body = f'{head[:-1]}, "reported": [{items}]}}' if head != "{}" else f'{{"reported": [{items}]}}'
+        device_messages = {device.address: message for (device, _), message in zip(records, messages)}
+        return cls(cycle, payload, body.encode("utf-8"), device_messages)
+
+    def gzip_body(self):
+        """The body gzip-compressed; compressed on first use and shared by all later requests."""
+        if self._gzip is None:
+            with self._lock:
+                if self._gzip is None:
+                    self._gzip = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self._gzip
+
+    def age(self, now=None):
+        return (now if now is not None else time.time()) - self.created
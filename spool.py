@@ -0,0 +1,193 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+import threading
+import time
+
+# Store-and-forward spool for telemetry that could not be published.
+#
+# Messages go into an append-only SQLite table in WAL mode, capped at `max_bytes`
+# of payload; when the cap is exceeded the oldest messages are evicted first
+# (down to 90% of the cap, so a full spool does not evict on every insert).
+# SpoolReplayer drains the spool oldest-first at a limited rate once the broker
+# is reachable again. Messages are replayed through the publish pipeline
+# (MqttPublisher.submit), and a row is deleted only once the broker has acknowledged
+# it; paho accepting a publish only means it was queued. A message lost with the
+# connection (or to a restart) before its acknowledgement therefore stays spooled
+# and is replayed again, so delivery is at-least-once. SQLite reads and deletes
+# run in a worker thread, so a large backlog never stalls the event loop (and with
+# it the scanner's ingest queue). The replayer only talks to the broker through the
+# `submit` and `is_connected` callables it is given, so any stand-in can replace it.
+
+
+class Spool:
+    """Disk-backed FIFO of (topic, payload, qos, retain) messages with a byte cap."""
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " topic TEXT NOT NULL,"
+            " payload BLOB NOT NULL,"
+            " qos INTEGER NOT NULL,"
+            " retain INTEGER NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._count, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM spool"
+        ).fetchone()
+        self.spooled = 0
+        self.replayed = 0
+        self.evicted = 0
+
+    def put(self, topic, payload, qos=0, retain=False):
+        """Appends one message, evicting the oldest ones if the byte cap is exceeded."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO spool (topic, payload, qos, retain, created) VALUES (?, ?, ?, ?, ?)",
+                (topic, payload, qos, int(retain), time.time()),
+            )
+            self._count += 1
+            self._bytes += len(payload)
+            self.spooled += 1
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def peek(self, limit, after_id=0):
+        """Returns up to `limit` of the oldest messages after row `after_id` as (id, topic, payload, qos, retain)."""
+        with self._lock:
+            return [
+                (row_id, topic, payload, qos, bool(retain))
+                for row_id, topic, payload, qos, retain in self._conn.execute(
+                    "SELECT id, topic, payload, qos, retain FROM spool WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_id, limit),
+                )
+            ]
+
+    def ack(self, row_ids):
+        """Removes messages that have been delivered."""
+        if not row_ids:
+            return
+        with self._lock:
+            placeholders = ",".join("?" * len(row_ids))
+            removed, size = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM spool WHERE id IN ({placeholders})",
+                row_ids,
+            ).fetchone()
+            self._conn.execute(f"DELETE FROM spool WHERE id IN ({placeholders})", row_ids)
+            self._count -= removed
+            self._bytes -= size
+            self.replayed += removed
+
+    def _evict(self):
+        # Drop oldest rows down to 90% of the cap, so a full spool evicts in batches
+        excess = self._bytes - int(self.max_bytes * 0.9)
+        freed = removed = 0
+        last_id = None
+        for row_id, size in self._conn.execute("SELECT id, LENGTH(payload) FROM spool ORDER BY id"):
+            freed += size
+            removed += 1
+            last_id = row_id
+            if freed >= excess:
+                break
+        if last_id is None:
+            return
+        self._conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+        self._count -= removed
+        self._bytes -= freed
+        self.evicted += removed
+        logging.warning(f"spool:: Evicted {removed} oldest messages ({freed} bytes) to stay under {self.max_bytes} bytes")
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        """Returns the spool counters as a JSON-serializable dictionary."""
+        return {
+            "messages": self._count,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "evicted": self.evicted,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SpoolReplayer:
+    """
+    Publishes spooled messages oldest-first at no more than `rate` messages per second
+    while `is_connected()` is true. `submit(topic, payload, qos, retain, on_delivered=...)`
+    queues a message for publishing (MqttPublisher.submit) and later calls
+    `on_delivered(True)` once the broker acknowledged it, or `on_delivered(False)`.
+    """
+
+    def __init__(self, spool, submit, is_connected, rate=5.0, poll_interval=1.0):
+        self.spool = spool
+        self.submit = submit
+        self.is_connected = is_connected
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self._cursor = 0  # Newest row id submitted; rows after it have not been sent yet
+        self._inflight = set()  # Row ids submitted and not yet acknowledged
+        self._acked = set()  # Row ids acknowledged and not yet deleted
+
+    def _delivered(self, row_id, ok):
+        self._inflight.discard(row_id)
+        if ok:
+            self._acked.add(row_id)
+        else:
+            # Lost before the broker acknowledged it; send it again on the next pass
+            self._cursor = min(self._cursor, row_id - 1)
+
+    async def flush(self):
+        """Deletes the rows acknowledged so far; returns how many."""
+        if not self._acked:
+            return 0
+        acked, self._acked = list(self._acked), set()
+        await asyncio.to_thread(self.spool.ack, acked)
+        return len(acked)
+
+    async def replay_once(self, limit):
+        """Submits messages until `limit` are awaiting acknowledgement; returns how many were submitted."""
+        await self.flush()
+        room = limit - len(self._inflight)
+        if room <= 0 or not self.is_connected():
+            return 0
+        rows = await asyncio.to_thread(self.spool.peek, room + len(self._inflight), self._cursor)
+        submitted = 0
+        for row_id, topic, payload, qos, retain in rows:
+            if submitted == room or not self.is_connected():
+                break
+            if row_id in self._inflight or row_id in self._acked:
+                continue
+            self._inflight.add(row_id)
+            self._cursor = max(self._cursor, row_id)
+            await self.submit(topic, payload, qos, retain, on_delivered=functools.partial(self._delivered, row_id))
+            submitted += 1
+        return submitted
+
+    async def run(self):
+        batch = max(1, int(self.rate * self.poll_interval))
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                delivered = await self.flush()
+                if delivered:
+                    logging.info(f"spool:: Replayed {delivered} spooled messages, {len(self.spool)} left")
+                if len(self.spool) and self.is_connected():
+                    await self.replay_once(batch)
+            except Exception as e:
+                logging.error(f"spool:: Replay error: {e}")
@@ -0,0 +1,108 @@
+import json
+import queue
+import threading
+
+import metrics
+
+# Live device updates for /api/stream.
+#
+# The event loop publishes one Update per tick with the devices that changed
+# since the previous tick. Each device is serialized once per update, and the
+# NDJSON and SSE framings are each built at most once, however many clients
+# are connected. Every client has its own bounded queue, filled from the event
+# loop without blocking. A client that falls `queue_size` updates behind is
+# dropped and its stream ends, so a slow reader never holds anyone else up.
+
+STREAM_FORMATS = ("ndjson", "sse")
+
+STREAM_CLIENTS_DROPPED = metrics.counter(
+    "eazytrax_stream_clients_dropped_total", "Stream clients disconnected for falling behind"
+).labels()
+STREAM_UPDATES = metrics.counter("eazytrax_stream_updates_total", "Device update batches fanned out to stream clients").labels()
+
+
+class Update:
+    """One tick's device records as JSON text, framed lazily per stream format."""
+
+    __slots__ = ("messages", "_ndjson", "_sse")
+
+    def __init__(self, messages):
+        self.messages = messages  # JSON text of each device record
+        self._ndjson = None
+        self._sse = None
+
+    @classmethod
+    def from_records(cls, records):
+        return cls([json.dumps(record) for record in records])
+
+    def encode(self, fmt):
+        # Building the same bytes twice in a race is harmless, so no lock
+        if fmt == "sse":
+            if self._sse is None:
+                self._sse = "".join(f"event: device\ndata: {message}\n\n" for message in self.messages).encode("utf-8")
+            return self._sse
+        if self._ndjson is None:
+            self._ndjson = "".join(f"{message}\n" for message in self.messages).encode("utf-8")
+        return self._ndjson
+
+
+class Subscription:
+    """A client's bounded queue of pending updates."""
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.dropped = False
+
+    def offer(self, update):
+        """Queues `update` without blocking; returns False when the client is too far behind."""
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+    def next(self, timeout):
+        """The next update, or None after `timeout` seconds without one."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class StreamHub:
+    """Fans updates out to every subscribed client."""
+
+    def __init__(self, queue_size=64, max_clients=16):
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self._clients = set()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def subscribe(self):
+        """Returns a new Subscription, or None when max_clients are already connected."""
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                return None
+            subscription = Subscription(self.queue_size)
+            self._clients.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._clients.discard(subscription)
+
+    def publish(self, update):
+        """Offers `update` to every client, dropping the ones whose queue is full."""
+        with self._lock:
+            clients = list(self._clients)
+        for subscription in clients:
+            if not subscription.offer(update):
+                self.unsubscribe(subscription)
+                self.dropped += 1
+                STREAM_CLIENTS_DROPPED.inc()
+        STREAM_UPDATES.inc()
+
+    def __len__(self):
+        return len(self._clients)
@@ -0,0 +1,463 @@
+import json
+import struct
+import time
+import zlib
+
+# Wire formats for the Gateways/{mac}/Telemetry payload.
+#
+# "json" is the original format and is sent unchanged. Every other format starts
+# with a 5-byte header so consumers can tell them apart from JSON (which always
+# starts with "{"):
+#
+#   magic   3 bytes  b"EZT"
+#   version 1 byte   SCHEMA_VERSION
+#   format  1 byte   FORMAT_PACKED | FORMAT_MSGPACK | FORMAT_CBOR
+#
+# "msgpack" and "cbor" encode the same dict as JSON and need the optional msgpack
+# or cbor2 package. "packed" is a dependency-free struct-of-records layout:
+#
+#   uint32 header length, header JSON (every top-level key except "reported")
+#   uint32 record count, then per record:
+#     uint16 flags, uint32 last_seen
+#     address: 6 raw bytes if FLAG_ADDRESS_BINARY else uint8 length + ASCII
+#     then, in flag order, each field whose flag is set (FLAG_* and SENSOR_SLOTS)
+#     uint16 length + extras JSON if FLAG_EXTRAS (anything without a fixed slot)
+#
+# Large encoded messages can additionally be compressed and split into chunks by
+# frame_message(). Every frame then starts with a 13-byte chunk header:
+#
+#   magic       3 bytes  b"EZC"
+#   version     1 byte   CHUNK_VERSION
+#   compression 1 byte   COMPRESSION_NONE | COMPRESSION_ZLIB | COMPRESSION_ZSTD
+#   message id  uint32   same for every chunk of one message
+#   sequence    uint16   0-based chunk index
+#   total       uint16   number of chunks in the message
+#
+# Concatenating the chunk bodies in sequence order and decompressing yields the
+# encoded message; Reassembler does this for consumers. Messages below both the
+# compression threshold and the chunk size are sent unframed, exactly as before.
+#
+# This module is also the reference decoder: decode_payload() accepts any of the
+# formats above and returns the same dict the gateway serialized. Packed float
+# sensors travel as float32; see _short_float() for how they are recovered.
+
+MAGIC = b"EZT"
+SCHEMA_VERSION = 1
+
+FORMAT_PACKED = 1
+FORMAT_MSGPACK = 2
+FORMAT_CBOR = 3
+
+FORMATS = {"json": None, "packed": FORMAT_PACKED, "msgpack": FORMAT_MSGPACK, "cbor": FORMAT_CBOR}
+
+CHUNK_MAGIC = b"EZC"
+CHUNK_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+FLAG_ADDRESS_BINARY = 1 << 0
+FLAG_NAME = 1 << 1            # uint8 length + UTF-8, length NAME_NULL means null
+FLAG_RSSI = 1 << 2
+FLAG_IBEACON_ID = 1 << 11      # uuid, major, minor and rssi_1m together
+FLAG_IBEACON_RSSI = 1 << 12
+FLAG_EXTRAS = 1 << 13
+FLAG_SENSORS_KEY = 1 << 14     # record has a "sensors" dict (possibly empty)
+FLAG_IBEACON_KEY = 1 << 15     # record has an "ibeacon" dict (possibly empty)
+
+# Fixed-slot sensors: (flag, key under "sensors", struct). A value whose type does
+# not match its slot (e.g. an int temperature from a plugin) is sent in the extras.
+SENSOR_SLOTS = (
+    (1 << 3, "temperature", struct.Struct(">f")),
+    (1 << 4, "humidity", struct.Struct(">f")),
+    (1 << 5, "battery", struct.Struct(">h")),
+    (1 << 6, "co2", struct.Struct(">H")),
+    (1 << 7, "formaldehyde", struct.Struct(">H")),
+    (1 << 8, "tvoc", struct.Struct(">H")),
+    (1 << 9, "pm25", struct.Struct(">H")),
+    (1 << 10, "pm10", struct.Struct(">H")),
+)
+
+NAME_NULL = 0xFF
+
+_HEADER = struct.Struct(">3sBB")
+_UINT8 = struct.Struct(">B")
+_UINT16 = struct.Struct(">H")
+_UINT32 = struct.Struct(">I")
+_RECORD_HEAD = struct.Struct(">HI")
+_RSSI = struct.Struct(">h")
+_IBEACON_ID = struct.Struct(">16sHHb")
+_IBEACON_RSSI = struct.Struct(">h")
+_FLOAT = struct.Struct(">f")
+_CHUNK_HEADER = struct.Struct(">3sBBIHH")
+
+
+def available_formats():
+    """Returns the format names usable in this environment."""
+    formats = ["json", "packed"]
+    try:
+        import msgpack  # noqa: F401
+        formats.append("msgpack")
+    except ImportError:
+        pass
+    try:
+        import cbor2  # noqa: F401
+        formats.append("cbor")
+    except ImportError:
+        pass
+    return formats
+
+
+def available_compressions():
+    """Returns the compression names usable in this environment."""
+    compressions = ["none", "zlib"]
+    try:
+        import zstandard  # noqa: F401
+        compressions.append("zstd")
+    except ImportError:
+        pass
+    return compressions
+
+
+def encode_payload(payload, fmt="json"):
+    """Encodes a telemetry payload dict to bytes in the requested wire format."""
+    if fmt == "json":
+        return json.dumps(payload).encode("utf-8")
+    if fmt == "packed":
+        return _HEADER.pack(MAGIC, SCHEMA_VERSION, FORMAT_PACKED) + _encode_packed(payload)
+    if fmt == "msgpack":
+        import msgpack
+        return _HEADER.pack(MAGIC, SCHEMA_VERSION, FORMAT_MSGPACK) + msgpack.packb(payload, use_bin_type=True)
+    if fmt == "cbor":
+        import cbor2
+        return _HEADER.pack(MAGIC, SCHEMA_VERSION, FORMAT_CBOR) + cbor2.dumps(payload)
+    raise ValueError(f"Unknown telemetry format: {fmt}")
+
+
+def decode_payload(data):
+    """Decodes bytes produced by encode_payload() in any format back into a dict."""
+    data = bytes(data)
+    if data[:3] != MAGIC:
+        return json.loads(data)
+
+    _, version, fmt = _HEADER.unpack_from(data)
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported telemetry schema version: {version}")
+
+    body = memoryview(data)[_HEADER.size:]
+    if fmt == FORMAT_PACKED:
+        return _decode_packed(body)
+    if fmt == FORMAT_MSGPACK:
+        import msgpack
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    if fmt == FORMAT_CBOR:
+        import cbor2
+        return cbor2.loads(body)
+    raise ValueError(f"Unknown telemetry format code: {fmt}")
+
+
+# ---------------------------------------------------------------------------
+# Packed layout
+# ---------------------------------------------------------------------------
+
+def _encode_packed(payload):
+    header = json.dumps({k: v for k, v in payload.items() if k != "reported"}).encode("utf-8")
+    records = payload.get("reported", [])
+    parts = [_UINT32.pack(len(header)), header, _UINT32.pack(len(records))]
+    parts.extend(_encode_record(record) for record in records)
+    return b"".join(parts)
+
+
+def _encode_record(record):
+    flags = 0
+    parts = []
+    extras = {k: v for k, v in record.items()
+              if k not in ("address", "name", "rssi", "last_seen", "sensors", "ibeacon")}
+
+    address = record["address"]
+    try:
+        raw_address = bytes.fromhex(address)
+    except ValueError:
+        raw_address = None
+    if raw_address is not None and len(raw_address) == 6 and raw_address.hex().upper() == address:
+        flags |= FLAG_ADDRESS_BINARY
+        parts.append(raw_address)
+    else:
+        encoded = address.encode("ascii")
+        parts.append(_UINT8.pack(len(encoded)) + encoded)
+
+    if "name" in record:
+        name = record["name"]
+        encoded = name.encode("utf-8") if isinstance(name, str) else None
+        if name is None:
+            flags |= FLAG_NAME
+            parts.append(_UINT8.pack(NAME_NULL))
+        elif encoded is not None and len(encoded) < NAME_NULL:
+            flags |= FLAG_NAME
+            parts.append(_UINT8.pack(len(encoded)) + encoded)
+        else:
+            extras["name"] = name
+
+    if "rssi" in record:
+        if _fits(_RSSI, record["rssi"]):
+            flags |= FLAG_RSSI
+            parts.append(_RSSI.pack(record["rssi"]))
+        else:
+            extras["rssi"] = record["rssi"]
+
+    sensors = record.get("sensors")
+    if sensors is not None:
+        flags |= FLAG_SENSORS_KEY
+        extra_sensors = dict(sensors)
+        for flag, key, layout in SENSOR_SLOTS:
+            value = extra_sensors.get(key)
+            if value is not None and _fits(layout, value):
+                flags |= flag
+                parts.append(layout.pack(value))
+                del extra_sensors[key]
+        if extra_sensors:
+            extras["sensors"] = extra_sensors
+
+    ibeacon = record.get("ibeacon")
+    if ibeacon is not None:
+        flags |= FLAG_IBEACON_KEY
+        extra_ibeacon = dict(ibeacon)
+        try:
+            uuid = bytes.fromhex(ibeacon["uuid"])
+            if len(uuid) == 16 and uuid.hex() == ibeacon["uuid"]:
+                parts.append(_IBEACON_ID.pack(uuid, ibeacon["major"], ibeacon["minor"], ibeacon["rssi_1m"]))
+                flags |= FLAG_IBEACON_ID
+                for key in ("uuid", "major", "minor", "rssi_1m"):
+                    del extra_ibeacon[key]
+        except (KeyError, TypeError, ValueError, struct.error):
+            pass
+        if "rssi" in extra_ibeacon and _fits(_IBEACON_RSSI, extra_ibeacon["rssi"]):
+            flags |= FLAG_IBEACON_RSSI
+            parts.append(_IBEACON_RSSI.pack(extra_ibeacon.pop("rssi")))
+        if extra_ibeacon:
+            extras["ibeacon"] = extra_ibeacon
+
+    if extras:
+        encoded = json.dumps(extras).encode("utf-8")
+        flags |= FLAG_EXTRAS
+        parts.append(_UINT16.pack(len(encoded)) + encoded)
+
+    return _RECORD_HEAD.pack(flags, record.get("last_seen", 0)) + b"".join(parts)
+
+
+def _fits(layout, value):
+    """True when `value` packs into `layout` without losing its type."""
+    if isinstance(value, bool):
+        return False
+    if layout.format.endswith("f"):
+        return isinstance(value, float)
+    if not isinstance(value, int):
+        return False
+    try:
+        layout.pack(value)
+        return True
+    except struct.error:
+        return False
+
+
+def _short_float(value):
+    """
+    Recovers the sensor value behind a float32. Values that are exact multiples of
+    1/256 (what the fixed-point sensor frames produce) are returned as-is; anything
+    else becomes the shortest decimal that packs to the same float32.
+    """
+    if (value * 256).is_integer():
+        return value
+    packed = _FLOAT.pack(value)
+    for digits in range(1, 10):
+        candidate = round(value, digits)
+        if _FLOAT.pack(candidate) == packed:
+            return candidate
+    return value
+
+
+def _decode_packed(body):
+    offset = 0
+    (header_length,) = _UINT32.unpack_from(body, offset)
+    offset += _UINT32.size
+    payload = json.loads(bytes(body[offset:offset + header_length]))
+    offset += header_length
+
+    (count,) = _UINT32.unpack_from(body, offset)
+    offset += _UINT32.size
+    reported = []
+    for _ in range(count):
+        record, offset = _decode_record(body, offset)
+        reported.append(record)
+
+    payload["reported"] = reported
+    return payload
+
+
+def _decode_record(body, offset):
+    flags, last_seen = _RECORD_HEAD.unpack_from(body, offset)
+    offset += _RECORD_HEAD.size
+    record = {}
+
+    if flags & FLAG_ADDRESS_BINARY:
+        record["address"] = bytes(body[offset:offset + 6]).hex().upper()
+        offset += 6
+    else:
+        length = body[offset]
+        record["address"] = bytes(body[offset + 1:offset + 1 + length]).decode("ascii")
+        offset += 1 + length
+
+    if flags & FLAG_NAME:
+        length = body[offset]
+        if length == NAME_NULL:
+            record["name"] = None
+            offset += 1
+        else:
+            record["name"] = bytes(body[offset + 1:offset + 1 + length]).decode("utf-8")
+            offset += 1 + length
+
+    if flags & FLAG_RSSI:
+        (record["rssi"],) = _RSSI.unpack_from(body, offset)
+        offset += _RSSI.size
+
+    record["last_seen"] = last_seen
+
+    if flags & FLAG_SENSORS_KEY:
+        sensors = record["sensors"] = {}
+        for flag, key, layout in SENSOR_SLOTS:
+            if flags & flag:
+                (value,) = layout.unpack_from(body, offset)
+                sensors[key] = _short_float(value) if layout.format.endswith("f") else value
+                offset += layout.size
+
+    if flags & FLAG_IBEACON_KEY:
+        ibeacon = record["ibeacon"] = {}
+        if flags & FLAG_IBEACON_ID:
+            uuid, major, minor, rssi_1m = _IBEACON_ID.unpack_from(body, offset)
+            ibeacon.update({"uuid": uuid.hex(), "major": major, "minor": minor})
+            offset += _IBEACON_ID.size
+        if flags & FLAG_IBEACON_RSSI:
+            (ibeacon["rssi"],) = _IBEACON_RSSI.unpack_from(body, offset)
+            offset += _IBEACON_RSSI.size
+        if flags & FLAG_IBEACON_ID:
+            ibeacon["rssi_1m"] = rssi_1m
+
+    if flags & FLAG_EXTRAS:
+        (length,) = _UINT16.unpack_from(body, offset)
+        offset += _UINT16.size
+        extras = json.loads(bytes(body[offset:offset + length]))
+        offset += length
+        for key, value in extras.items():
+            if isinstance(value, dict) and isinstance(record.get(key), dict):
+                record[key].update(value)
+            else:
+                record[key] = value
+
+    return record, offset
+
+
+# ---------------------------------------------------------------------------
+# Compression and chunking
+# ---------------------------------------------------------------------------
+
+def compress(data, compression):
+    """Compresses `data` with the named algorithm ("none", "zlib" or "zstd")."""
+    if compression == "none":
+        return data
+    if compression == "zlib":
+        return zlib.compress(data, 6)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def decompress(data, compression_code):
+    """Reverses compress() for a COMPRESSION_* code from a chunk header."""
+    if compression_code == COMPRESSION_NONE:
+        return bytes(data)
+    if compression_code == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression_code == COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression code: {compression_code}")
+
+
+def frame_message(message, message_id, compression="none", compress_threshold=0, max_chunk_size=0):
+    """
+    Splits an encoded message into the frames to publish.
+    The message is compressed when it is at least `compress_threshold` bytes (0 = never)
+    and split into bodies of at most `max_chunk_size` bytes (0 = never). A message that
+    needs neither is returned unframed as the only element.
+    """
+    use_compression = compression != "none" and compress_threshold and len(message) >= compress_threshold
+    if not use_compression and (not max_chunk_size or len(message) <= max_chunk_size):
+        return [message]
+
+    body = compress(message, compression) if use_compression else message
+    code = COMPRESSIONS[compression] if use_compression else COMPRESSION_NONE
+    chunk_size = max_chunk_size or len(body) or 1
+    total = max(1, -(-len(body) // chunk_size))
+    if total > 0xFFFF:
+        raise ValueError(f"Message of {len(body)} bytes needs more than 65535 chunks of {chunk_size} bytes")
+
+    message_id &= 0xFFFFFFFF
+    return [
+        _CHUNK_HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, code, message_id, seq, total)
+        + body[seq * chunk_size:(seq + 1) * chunk_size]
+        for seq in range(total)
+    ]
+
+
+class Reassembler:
+    """
+    Reference consumer-side reassembly of frame_message() output.
+    feed() returns the complete encoded message once all chunks have arrived, or None.
+    Incomplete messages are dropped after `timeout` seconds or when more than
+    `max_pending` are in flight.
+    """
+
+    def __init__(self, timeout=60.0, max_pending=16):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._pending = {}  # message id -> [first seen, total, compression, {seq: body}]
+        self.dropped = 0
+
+    def feed(self, frame, now=None):
+        frame = bytes(frame)
+        if frame[:3] != CHUNK_MAGIC:
+            return frame
+
+        _, version, compression, message_id, seq, total = _CHUNK_HEADER.unpack_from(frame)
+        if version != CHUNK_VERSION:
+            raise ValueError(f"Unsupported chunk version: {version}")
+        body = frame[_CHUNK_HEADER.size:]
+        now = time.monotonic() if now is None else now
+
+        if total == 1:
+            return decompress(body, compression)
+
+        self._expire(now)
+        entry = self._pending.get(message_id)
+        if entry is None:
+            if len(self._pending) >= self.max_pending:
+                oldest = min(self._pending, key=lambda key: self._pending[key][0])
+                del self._pending[oldest]
+                self.dropped += 1
+            entry = self._pending[message_id] = [now, total, compression, {}]
+        entry[3][seq] = body
+
+        if len(entry[3]) < entry[1]:
+            return None
+        del self._pending[message_id]
+        return decompress(b"".join(entry[3][i] for i in range(entry[1])), entry[2])
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._pending.items() if now - entry[0] > self.timeout]
+        for key in expired:
+            del self._pending[key]
+        self.dropped += len(expired)
@@ -0,0 +1,133 @@
+import gc
+import random
+import time
+import tracemalloc
+
+import pytest
+
+import aggregation
+import decoders
+import devices
+import filters
+import history
+import rssi_filter
+
+TAG_PREFIX = "AC:23:3F"
+FFE1 = "0000ffe1-0000-1000-8000-00805f9b34fb"
+
+
+def advert(address, timestamp, name=None, manufacturer_data=None, service_data=None, service_uuids=()):
+    """One IngestQueue.drain() entry for a single advert."""
+    return {address: [name, [-60], manufacturer_data or {}, service_data or {}, list(service_uuids), timestamp,
+                      [timestamp], None]}
+
+
+def random_address(rng):
+    return ":".join(f"{rng.randrange(256):02X}" for _ in range(6))
+
+
+@pytest.fixture
+def table():
+    saved = devices.max_devices, devices.pin_rules, devices.rssi_filter, devices.sensor_history, devices.sensor_aggregator
+    devices.clear_devices()
+    devices.rssi_filter = devices.sensor_history = devices.sensor_aggregator = None
+    yield
+    devices.clear_devices()
+    devices.max_devices, devices.pin_rules, devices.rssi_filter, devices.sensor_history, devices.sensor_aggregator = saved
+
+
+def test_flood_never_evicts_pinned_while_unpinned_remain(table):
+    devices.set_capacity(1000)
+    devices.pin_rules = filters.RuleSet(addresses=TAG_PREFIX)
+    rng = random.Random(1)
+    now = time.time()
+    tags = [f"{TAG_PREFIX}:00:00:{i:02X}" for i in range(100)]
+    for tag in tags:
+        devices.apply_adverts(advert(tag, now))
+    pinned_evictions = devices.DEVICES_EVICTED_PINNED.value
+
+    # MAC-randomizing phones flood the table long after the tags last advertised
+    for i in range(5000):
+        devices.apply_adverts(advert(random_address(rng), now + 1 + i / 1000))
+
+    assert len(devices.ble_devices_array) == 1000
+    assert devices.pinned_count == 100
+    assert all(tag in devices.ble_devices_array for tag in tags)
+    assert devices.DEVICES_EVICTED_PINNED.value == pinned_evictions
+    assert len(devices.unpinned_devices) == 900
+
+
+def test_pinned_evicted_only_when_nothing_else_is_left(table):
+    devices.set_capacity(10)
+    devices.pin_rules = filters.RuleSet(addresses=TAG_PREFIX)
+    now = time.time()
+    tags = [f"{TAG_PREFIX}:00:00:{i:02X}" for i in range(11)]
+    for i, tag in enumerate(tags):
+        devices.apply_adverts(advert(tag, now + i))
+
+    assert len(devices.ble_devices_array) == 10
+    assert devices.pinned_count == 10
+    assert tags[0] not in devices.ble_devices_array
+
+
+def test_device_pinned_by_a_later_advert(table):
+    devices.set_capacity(10)
+    devices.pin_rules = filters.RuleSet(companies="1593", name="^EazyTrax")
+    now = time.time()
+    devices.apply_adverts(advert("11:22:33:44:55:66", now))
+    devices.apply_adverts(advert("11:22:33:44:55:77", now))
+    assert devices.pinned_count == 0
+
+    # The manufacturer data comes in a scan response, the name in a later advert
+    devices.apply_adverts(advert("11:22:33:44:55:66", now + 1, manufacturer_data={1593: b"\x00"}))
+    devices.apply_adverts(advert("11:22:33:44:55:77", now + 1, name="EazyTrax-7"))
+
+    assert devices.pinned_count == 2
+    assert devices.ble_devices_array["11:22:33:44:55:66"].pinned
+    assert not devices.unpinned_devices
+    devices.evict_device()
+    assert devices.pinned_count == 1
+
+
+def sensor_tag_adverts(count, now, rng):
+    """EazyTrax sensor tags: every one keeps a filter slot, an aggregation window and a history."""
+    return {
+        f"{i:012X}": [f"ETX-{i % 100}", [rng.randint(-95, -40)], {1593: bytes.fromhex("ca05") + rng.randbytes(7)},
+                      {FFE1: bytes.fromhex("a101") + rng.randbytes(5)}, [FFE1], now, [now], None]
+        for i in range(count)
+    }
+
+
+def test_memory_budget_covers_the_enabled_per_device_state(table, monkeypatch):
+    monkeypatch.setattr(decoders, "DECODE_CACHE_SIZE", 0)  # bounded on its own, not per device
+    budget = 4 * 1024 * 1024
+    base = devices.set_capacity(0, budget)
+    devices.rssi_filter = rssi_filter.RssiFilterBank("ema", use_numpy=False)
+    devices.sensor_aggregator = aggregation.SensorAggregator("mean")
+    devices.sensor_history = history.SensorHistory(600, resolution=5, max_devices=100_000)
+    count = devices.set_capacity(0, budget)
+    assert count < base
+
+    # Histories stop growing at their own bound, so a small history bound leaves room for more devices
+    devices.sensor_history.max_devices = 100
+    assert count < devices.set_capacity(0, budget) < base
+    devices.sensor_history.max_devices = 100_000
+    devices.set_capacity(0, budget)
+
+    rng = random.Random(2)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        batch = sensor_tag_adverts(count, time.time(), rng)
+        devices.apply_adverts(batch)
+        devices.filter_rssi()
+        del batch
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert devices.sensor_history.stats()["devices"] == count
+    assert traced <= budget
+    # Counting only the table entry would have put well over the budget in memory
+    assert traced * (budget // devices.DEVICE_BYTES_ESTIMATE) / count > 1.5 * budget
@@ -0,0 +1,65 @@
+import math
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+import profiling
+
+
+def test_overhead_cap_holds_with_a_slow_sampler(monkeypatch):
+    current_frames = sys._current_frames
+
+    def slow_current_frames():
+        time.sleep(0.01)
+        return current_frames()
+
+    monkeypatch.setattr(profiling.sys, "_current_frames", slow_current_frames)
+    profiler = profiling.SamplingProfiler(interval=0.001, max_overhead=0.05)
+    profiler.start(1.0)
+    profiler._thread.join(5)
+    report = profiler.report()
+
+    assert not report["running"]
+    assert report["samples"] >= 2
+    # Stretching the interval never runs the session past its duration
+    assert report["seconds"] < 1.1
+    assert profiler.busy / report["seconds"] <= 0.05
+    assert report["interval"] >= 0.01 / 0.05
+
+
+def test_second_start_raises_while_running():
+    profiler = profiling.SamplingProfiler()
+    profiler.start(5)
+    try:
+        with pytest.raises(RuntimeError):
+            profiler.start(5)
+    finally:
+        report = profiler.stop()
+    assert not report["running"]
+    assert report["seconds"] < 5
+
+
+@pytest.mark.parametrize("seconds", [0, -1, math.nan, math.inf])
+def test_bad_durations_are_rejected(seconds):
+    with pytest.raises(ValueError):
+        profiling.SamplingProfiler().start(seconds)
+    with pytest.raises(ValueError):
+        profiling.AllocationTracer().start(seconds)
+    assert not tracemalloc.is_tracing()
+
+
+def test_allocation_tracer_stops_at_the_memory_cap():
+    tracer = profiling.AllocationTracer(max_memory=1)
+    tracer.start(30)
+    assert tracemalloc.is_tracing()
+    garbage = [bytes(100) for _ in range(1000)]
+    tracer._thread.join(5)
+    report = tracer.report()
+
+    assert not report["running"]
+    assert report["stop_reason"] == "memory cap"
+    assert report["seconds"] < 30
+    assert not tracemalloc.is_tracing()
+    assert garbage
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+from publisher import MqttPublisher
+
+
+class SilentBroker:
+    """A connected client whose broker never acknowledges anything (half-open link)."""
+
+    def __init__(self):
+        self.published = []
+        self.on_publish = None
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        self.published.append(topic)
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=len(self.published))
+
+
+def test_supersedable_messages_never_wait_for_a_silent_broker():
+    publisher = MqttPublisher(max_inflight=20, queue_size=200, ack_timeout=30)
+    broker = SilentBroker()
+    publisher.attach(broker)
+    topics = [f"Bles/{i:012X}/Gateways/GW/Telemetry" for i in range(300)]
+
+    async def two_reports():
+        publisher.start()
+        started = time.perf_counter()
+        accepted = [publisher.submit_nowait(topic, b"first", retain=True) for topic in topics]
+        await asyncio.sleep(0.1)  # the worker fills the in-flight window, then waits for acks forever
+        accepted += [publisher.submit_nowait(topic, b"second", retain=True) for topic in topics]
+        return time.perf_counter() - started - 0.1, accepted
+
+    elapsed, accepted = asyncio.run(two_reports())
+    assert elapsed < 0.05
+    assert len(broker.published) == 20
+    stats = publisher.stats()
+    assert stats["queued"] == 200
+    # Still-queued device messages were replaced, not queued twice; the rest were dropped
+    assert publisher.superseded >= 170
+    assert publisher.dropped == accepted.count(False)
+    assert publisher.superseded + publisher.dropped + publisher.submitted == 600
+    assert all(message[1] == b"second" for message in publisher._latest.values() if message[0] in topics[20:170])
+
+
+def test_report_to_a_silent_broker_does_not_block():
+    import app
+
+    broker = SilentBroker()
+    app.mqtt_client_instance = broker
+    app.gateway_mac = "TESTGATEWAY"
+    devices = [SimpleNamespace(address=f"{i:012X}") for i in range(300)]
+    messages = {device.address: '{"rssi": -60}' for device in devices}
+
+    async def reports():
+        app.publisher.attach(broker)
+        app.publisher.start()
+        started = time.perf_counter()
+        for _ in range(3):
+            await asyncio.wait_for(app.publish_each_device_to_mqtt(devices, messages), timeout=1)
+            await asyncio.sleep(0)
+        return time.perf_counter() - started
+
+    try:
+        assert asyncio.run(reports()) < 0.5
+        assert app.publisher.stats()["queued"] <= app.publisher._queue_size
+    finally:
+        app.mqtt_client_instance = None
@@ -0,0 +1,60 @@
+import pytest
+
+import rssi_filter
+from rssi_filter import RssiFilterBank
+
+USE_NUMPY = [False, pytest.param(True, marks=pytest.mark.skipif(not rssi_filter.HAVE_NUMPY, reason="NumPy not installed"))]
+
+
+@pytest.mark.parametrize("use_numpy", USE_NUMPY)
+def test_median_covers_the_window_across_runs(use_numpy):
+    bank = RssiFilterBank("median", window=5.0, use_numpy=use_numpy)
+    slot = bank.acquire("tag")
+    other = bank.acquire("phone")
+    results = []
+    # One sample per run, as when presence and /api/stream run the filter every second
+    for i, rssi in enumerate([-50, -50, -50, -90, -90]):
+        bank.add_samples(slot, [rssi], [100.0 + i])
+        results.append(bank.run())
+    assert results[0] == [("tag", -50.0)]
+    assert results[-1] == [("tag", -50.0)]
+
+    # Devices without new samples are not reported again
+    bank.add_samples(other, [-70], [104.5])
+    assert bank.run() == [("phone", -70.0)]
+
+    # Samples older than the window drop out
+    bank.add_samples(slot, [-90], [106.0])
+    assert bank.run() == [("tag", -90.0)]  # -50 (102), -90, -90, -90
+    bank.add_samples(slot, [-60], [112.0])
+    assert bank.run() == [("tag", -60.0)]
+
+
+@pytest.mark.parametrize("use_numpy", USE_NUMPY)
+def test_released_slot_does_not_inherit_the_window(use_numpy):
+    bank = RssiFilterBank("median", window=5.0, use_numpy=use_numpy)
+    slot = bank.acquire("old")
+    for i in range(3):
+        bank.add_samples(slot, [-40], [100.0 + i])
+        bank.run()
+    bank.release(slot)
+    bank.run()
+    reused = bank.acquire("new")
+    assert reused == slot
+    bank.add_samples(reused, [-80], [103.0])
+    assert bank.run() == [("new", -80.0)]
+
+
+def test_numpy_and_python_medians_agree():
+    if not rssi_filter.HAVE_NUMPY:
+        pytest.skip("NumPy not installed")
+    banks = [RssiFilterBank("median", window=2.0, use_numpy=use_numpy) for use_numpy in (False, True)]
+    slots = [[bank.acquire(f"d{i}") for i in range(20)] for bank in banks]
+    for tick in range(10):
+        outputs = []
+        for bank, owned in zip(banks, slots):
+            for i, slot in enumerate(owned):
+                if (tick + i) % 3:
+                    bank.add_samples(slot, [-40 - (tick * 7 + i * 3) % 50, -45 - i], [tick + 0.1, tick + 0.5])
+            outputs.append(sorted(bank.run()))
+        assert outputs[0] == outputs[1]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import app
+import filters
+import scanner_source
+
+
+@pytest.fixture
+def scanner_starts(monkeypatch):
+    """Runs the continuous-mode scan loop on the fake scanner; returns how often it was started."""
+    starts = []
+    create_scanner = scanner_source.create_scanner
+
+    def counting_create_scanner(*args, **kwargs):
+        scanner = create_scanner(*args, **kwargs)
+        start = scanner.start
+
+        async def counted_start():
+            starts.append(1)
+            await start()
+
+        scanner.start = counted_start
+        return scanner
+
+    monkeypatch.setattr(scanner_source, "create_scanner", counting_create_scanner)
+    monkeypatch.setattr(app, "scanner_backend", "fake")
+    monkeypatch.setattr(app, "scan_mode", "continuous")
+    monkeypatch.setattr(app, "scan_window", 0.2)
+    monkeypatch.setattr(app, "report_interval", 60)
+
+    def run(seconds):
+        async def scan():
+            task = asyncio.create_task(app.scan_ble_devices())
+            await asyncio.sleep(seconds)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(scan())
+        return len(starts)
+
+    return run
+
+
+def test_allowlist_matching_nothing_does_not_restart_the_scanner(scanner_starts, monkeypatch):
+    monkeypatch.setattr(app, "advert_filter", filters.AdvertFilter(allow=filters.RuleSet(addresses="FF:FF:FF:FF")))
+    received = app.ingest_queue.received
+    checked = app.advert_filter.checked
+
+    assert scanner_starts(1.0) == 1
+    assert app.ingest_queue.received == received  # every advert was filtered out
+    assert app.advert_filter.checked > checked
+
+
+def test_silent_radio_restarts_the_scanner(scanner_starts, monkeypatch):
+    monkeypatch.setenv("FAKE_ADVERT_RATE", "0")
+    assert scanner_starts(1.0) >= 3
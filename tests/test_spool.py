@@ -0,0 +1,174 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from publisher import MqttPublisher
+from spool import Spool, SpoolReplayer
+
+
+class FakeBroker:
+    """Stands in for the MQTT client: records publishes and acknowledges them only when told to."""
+
+    def __init__(self, connected=False, auto_ack=False):
+        self.connected = connected
+        self.auto_ack = auto_ack
+        self.received = []
+        self.unacked = []
+        self.on_publish = None
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        self.received.append((topic, payload, qos, retain))
+        mid = len(self.received)
+        if self.auto_ack:
+            self.on_publish(self, None, mid)
+        else:
+            self.unacked.append(mid)
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=mid)
+
+    def ack_all(self):
+        for mid in self.unacked:
+            self.on_publish(self, None, mid)
+        self.unacked = []
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"), max_bytes=1000)
+    yield spool
+    spool.close()
+
+
+def fill(spool, count, size=10):
+    for i in range(count):
+        spool.put(f"topic/{i}", bytes([i % 256]) * size, qos=1, retain=False)
+
+
+def replayer_for(spool, broker, ack_timeout=30.0, **kwargs):
+    publisher = MqttPublisher(ack_timeout=ack_timeout)
+    publisher.attach(broker)
+    return publisher, SpoolReplayer(spool, publisher.submit, broker.is_connected, **kwargs)
+
+
+async def settle():
+    # Lets the publisher worker hand queued messages over and process acknowledgements
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+
+def test_nothing_delivered_while_disconnected(spool):
+    fill(spool, 5)
+    broker = FakeBroker(connected=False)
+    publisher, replayer = replayer_for(spool, broker)
+
+    async def replay():
+        publisher.start()
+        return await replayer.replay_once(10)
+
+    assert asyncio.run(replay()) == 0
+    assert broker.received == []
+    assert len(spool) == 5
+
+
+def test_rows_deleted_only_once_acknowledged(spool):
+    fill(spool, 5)
+    broker = FakeBroker(connected=True)
+    publisher, replayer = replayer_for(spool, broker)
+
+    async def replay():
+        publisher.start()
+        assert await replayer.replay_once(3) == 3
+        await settle()
+        # Handed to the connection, not yet acknowledged: nothing may be deleted
+        assert await replayer.flush() == 0
+        assert len(spool) == 5
+        # The window is full until the broker acknowledges
+        assert await replayer.replay_once(3) == 0
+        broker.ack_all()
+        await settle()
+        assert await replayer.replay_once(3) == 2
+        await settle()
+        broker.ack_all()
+        await settle()
+        await replayer.flush()
+
+    asyncio.run(replay())
+    assert [topic for topic, _, _, _ in broker.received] == [f"topic/{i}" for i in range(5)]
+    assert broker.received[0][2:] == (1, False)
+    assert len(spool) == 0
+    assert spool.stats()["replayed"] == 5
+    assert spool.stats()["bytes"] == 0
+
+
+def test_broker_disconnecting_before_acknowledging_keeps_the_rows(spool):
+    fill(spool, 3)
+    broker = FakeBroker(connected=True)
+    publisher, replayer = replayer_for(spool, broker, ack_timeout=0.05)
+
+    async def replay():
+        publisher.start()
+        assert await replayer.replay_once(3) == 3
+        await settle()
+        # The link drops with the PUBACKs still outstanding
+        broker.connected = False
+        broker.unacked = []
+        await asyncio.sleep(1.2)  # the publisher times the messages out
+        await replayer.flush()
+        assert len(spool) == 3
+        assert spool.stats()["replayed"] == 0
+        assert publisher.timed_out == 3
+
+        broker.connected = True
+        broker.auto_ack = True
+        assert await replayer.replay_once(3) == 3
+        await settle()
+        await replayer.flush()
+
+    asyncio.run(replay())
+    # Replayed again oldest-first after the reconnect, then deleted
+    assert [topic for topic, _, _, _ in broker.received] == [f"topic/{i}" for i in (0, 1, 2, 0, 1, 2)]
+    assert len(spool) == 0
+    assert spool.stats()["replayed"] == 3
+
+
+def test_byte_cap_evicts_oldest(spool):
+    fill(spool, 100, size=100)
+    stats = spool.stats()
+    assert stats["bytes"] <= spool.max_bytes
+    assert stats["messages"] == len(spool) == stats["bytes"] // 100
+    assert stats["spooled"] == 100
+    assert stats["evicted"] == 100 - stats["messages"]
+    # The newest messages survive
+    assert [topic for _, topic, _, _, _ in spool.peek(100)][-1] == "topic/99"
+    assert spool.peek(1)[0][1] == f"topic/{stats['evicted']}"
+    assert spool.peek(1, after_id=spool.peek(1)[0][0])[0][1] == f"topic/{stats['evicted'] + 1}"
+
+
+def test_run_is_rate_limited_and_keeps_the_loop_responsive(spool):
+    fill(spool, 50)
+    broker = FakeBroker(connected=True, auto_ack=True)
+    publisher, replayer = replayer_for(spool, broker, rate=20, poll_interval=0.05)
+
+    async def replay_for(seconds):
+        publisher.start()
+        task = asyncio.create_task(replayer.run())
+        started = time.monotonic()
+        ticks = 0
+        # The loop keeps ticking while batches are replayed
+        while time.monotonic() - started < seconds:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        task.cancel()
+        await replayer.flush()
+        return ticks
+
+    ticks = asyncio.run(replay_for(0.5))
+    # One message per 0.05 s poll: at most 20 messages/s
+    assert 1 <= len(broker.received) <= 11
+    assert len(spool) == 50 - len(broker.received)
+    assert ticks > 20